@@ -1,17 +1,57 @@
-from tensorflow.keras.models import Sequential
-from tensorflow.keras.layers import Dense ,Conv2D, MaxPooling2D, Flatten, Input
 import math
+import os
 import pickle
 import random
+import threading
 import numpy as np
 import time
+from collections import deque
+from replay import ReplayMemory, MemmapReplayMemory, PrioritizedReplayMemory, CompactReplayMemory
+from checkpoint import CheckpointManager, load_checkpoint
+from seeding import seed_tensorflow
+from metrics import Metrics
+
+
+def checkpoint_name(conv, num_inputs):
+    # Directory of the checkpoints under checkpoint_dir, conv networks with the default 11x11 view
+    # keep the name they always had
+    if not conv:
+        return 'mlp'
+    return 'conv' if num_inputs == 11 else f'conv_{num_inputs}'
 
 
 class DeepQNetwork:
-    def __init__(self, num_inputs, num_actions, reset_weights):
+    def __init__(self, num_inputs, num_actions, reset_weights, fused_train=False, double_dqn=False, huber=False,
+                 checkpoint_dir='checkpoints', keep_checkpoints=3, capacity=100_000, replay_dir=None,
+                 prioritized=False, seed=None, metrics=None, loss_history=100_000, conv=None,
+                 compact_replay=None, polyak=None, batch_size=512, e_start=1, e_end=0.1, e_decay=0.00001,
+                 future_discount=0.99, update_target_every=300):
         self.num_inputs = num_inputs
         self.num_actions = num_actions    # number of possible actions
-        if num_inputs < 10:
+        # fused_train: compute Q values, loss and gradients in one compiled call instead of predict + fit
+        # double_dqn: pick the future action with the online model and value it with the target model
+        # huber: use Huber loss instead of mean squared error
+        # prioritized: sample experiences by TD error (PrioritizedReplayMemory)
+        # seed: seeds random actions, replay sampling and weight initialisation, unseeded if None
+        # conv: convolutional network on a num_inputs square view, by default if num_inputs > 9
+        # compact_replay: observations per experience of a CompactReplayMemory, None for ReplayMemory
+        # polyak: move the target model this fraction of the way to the online model after every
+        # train step, instead of copying it every update_target_every train steps
+        # metrics: Metrics timing push, sample, train and target_sync, loss_history: losses kept in train_loss
+        # batch_size, e_start, e_end, e_decay, future_discount, update_target_every: hyperparameters, set
+        # here as the fused train step keeps the discount it was built with
+        self.fused_train = fused_train
+        self.prioritized = prioritized
+        self.double_dqn = double_dqn
+        self.loss = 'huber' if huber else 'mse'
+        self.metrics = Metrics() if metrics is None else metrics
+        self.rng = random.Random(seed)
+        self.np_rng = np.random.default_rng(seed)
+        if seed is not None:
+            seed_tensorflow(seed)
+        if conv is None:
+            conv = num_inputs > 9
+        if not conv:
             self.model = self.create_model()
             self.target_model = self.create_model()
             self.conv = False
@@ -22,30 +62,56 @@ class DeepQNetwork:
 
         print(self.model.summary())
 
+        # replay_dir: keep the replay memory in memory-mapped files in this directory instead of RAM
+        self.capacity = capacity
+        self.replay_dir = replay_dir
+        self.compact_replay = compact_replay
+        # MLP and conv networks are checkpointed separately, as are conv networks of other view sizes
+        self.checkpoints = CheckpointManager(os.path.join(checkpoint_dir, checkpoint_name(self.conv, num_inputs)),
+                                             keep_checkpoints)
         if reset_weights:
-            self.memory = []
+            self.memory = self.create_memory()
             self.push_count = 0
-            self.train_loss = []
+            train_loss = []
             self.q_preds = [[], [], [], []]
         else:
-            weights, self.memory, self.push_count, self.train_loss, self.q_preds = self.load_data()
+            weights, self.memory, self.push_count, train_loss, self.q_preds = self.load_data()
             self.model.set_weights(weights)
-            
+        # Only the latest losses are kept so checkpoints stay the same size
+        self.train_loss = deque(train_loss, maxlen=loss_history)
+
         print(f'Push Count:{self.push_count}')
-        self.capacity = 100_000
         # e is epsilon, the probability that an action will be random
-        self.e_start = 1    
-        self.e_end = 0.1
-        self.e_decay = 0.00001
-        self.batch_size = 512
+        self.e_start = e_start
+        self.e_end = e_end
+        self.e_decay = e_decay
+        self.batch_size = batch_size
         self.target_model.set_weights(self.model.get_weights())
         self.target_update_counter = 0
-        self.future_discount = 0.99
-        self.update_target_every = 300
+        self.train_count = 0    # Number of gradient steps taken
+        self.future_discount = future_discount
+        self.update_target_every = update_target_every
+        self.polyak = polyak
+        self.sync_target = self.create_target_sync()
         self.test_states = []
+        if fused_train:
+            self.train_step = self.create_train_step()
+        # Background learner (see start_learner). The memory lock is held while pushing and sampling,
+        # the train lock for a whole train step so checkpoints are never taken part way through one
+        self.learner = None
+        self.learner_error = None
+        self.memory_lock = threading.Lock()
+        self.train_lock = threading.Lock()
+        # numpy_inference: greedy actions from a NumpyPolicy of the weights instead of the Keras model
+        self.numpy_inference = False
+        self.policy = None
+        self.policy_train_count = None
        
 
+    # TensorFlow is only imported once a network is built so importing this module stays cheap
     def create_model(self):
+        from tensorflow.keras.models import Sequential
+        from tensorflow.keras.layers import Dense, Input
         model = Sequential()
         model.add(Input(shape=(self.num_inputs,)))
         model.add(Dense(64, 'relu'))
@@ -55,10 +121,12 @@ class DeepQNetwork:
         model.add(Dense(128, 'relu'))
         model.add(Dense(64, 'relu'))
         model.add(Dense(self.num_actions))
-        model.compile(loss="mse", optimizer='Adam', metrics=['accuracy'])
+        model.compile(loss=self.loss, optimizer='Adam', metrics=['accuracy'])
         return model
 
     def create_model_conv(self):
+        from tensorflow.keras.models import Sequential
+        from tensorflow.keras.layers import Dense ,Conv2D, MaxPooling2D, Flatten
         model = Sequential()
         shape = (self.num_inputs, self.num_inputs, 1)
         model.add(Conv2D(32, (3, 3), activation='relu', input_shape=shape, padding='same'))
@@ -71,19 +139,38 @@ class DeepQNetwork:
         model.add(Dense(256, activation='relu'))
         model.add(Dense(64, activation='relu'))
         model.add(Dense(self.num_actions))
-        model.compile(loss="mse", optimizer='Adam', metrics=['accuracy'])
+        model.compile(loss=self.loss, optimizer='Adam', metrics=['accuracy'])
         return model
 
+    def create_memory(self):
+        if self.compact_replay is not None:
+            if self.prioritized or self.replay_dir is not None:
+                raise ValueError('Compact replay memory cannot be prioritized or memory-mapped')
+            return CompactReplayMemory(self.capacity, self.np_rng, self.compact_replay)
+        if self.prioritized:
+            if self.replay_dir is not None:
+                raise ValueError('Prioritized replay memory cannot be memory-mapped')
+            return PrioritizedReplayMemory(self.capacity, self.np_rng)
+        if self.replay_dir is None:
+            return ReplayMemory(self.capacity, self.np_rng)
+        return MemmapReplayMemory(self.capacity, self.replay_dir, self.np_rng)
+
     def push_to_memory(self, experience):
-        # Saves an experience to memory
+        # Saves an experience to memory, overwriting the oldest once full
         self.push_count += 1
-        if len(self.memory) < self.capacity:
-            # Append directly to memory
-            self.memory.append(experience)
-        else: 
-            # Add new experience to memory, overwriting from start (1002 % 1000 = 2)
-            i = self.push_count % self.capacity
-            self.memory[i] = experience
+        with self.metrics.timer('push'), self.memory_lock:
+            self.memory.push(experience)
+
+    def game_mode(self, exploit, explore):
+        # Exploit and explore flags of the next game while training
+        # Once the memory is half full 10% of games are played greedily and 18% at random
+        if self.push_count <= self.capacity/2:
+            return exploit, explore
+        if self.rng.random() < 0.1:
+            return True, False
+        elif self.rng.random() < 0.2:
+            return False, True
+        return False, False
 
 
     def get_action(self, state, exploit, explore):
@@ -91,12 +178,14 @@ class DeepQNetwork:
         self.e = self.e_end + (self.e_start - self.e_end) * \
                     math.exp(-1. * self.push_count * self.e_decay) 
 
-        if (self.e > random.random() or explore) and not exploit:
+        if (self.e > self.rng.random() or explore) and not exploit:
             # Execute a random action to explore the environment
-            action = random.randrange(self.num_actions)
+            action = self.rng.randrange(self.num_actions)
             return action
         else: 
             # Use NN to predict action to exploit environment
+            if self.numpy_inference:
+                return self.numpy_policy().act(state)
             inputs = state
             if self.conv:
                 inputs = np.reshape(state, (1, self.num_inputs, self.num_inputs, 1))
@@ -107,80 +196,275 @@ class DeepQNetwork:
             action = np.argmax(outputs)
             return action
 
+    def get_actions(self, states, exploit, explore):
+        # get_action for a batch of states from many games
+        # exploit and explore are single flags or one flag per state
+        # Random actions are chosen per row and only the greedy rows go through the network, in one call
+        self.e = self.e_end + (self.e_start - self.e_end) * \
+                    math.exp(-1. * self.push_count * self.e_decay)
+        states = np.asarray(states)
+        num_states = len(states)
+        exploit = np.broadcast_to(exploit, num_states)
+        explore = np.broadcast_to(explore, num_states)
+        random_rows = ((self.e > self.np_rng.random(num_states)) | explore) & ~exploit
+        actions = self.np_rng.integers(self.num_actions, size=num_states)
+        greedy = np.flatnonzero(~random_rows)
+        if len(greedy) and self.numpy_inference:
+            actions[greedy] = self.numpy_policy().acts(states[greedy])
+        elif len(greedy):
+            inputs = states[greedy]
+            if self.conv:
+                inputs = np.expand_dims(inputs, axis=3)
+            outputs = self.model(inputs, training=False)
+            actions[greedy] = np.argmax(outputs, axis=1)
+        return actions
+
+    def numpy_policy(self):
+        # NumpyPolicy of the current weights (see policy.py), rebuilt once the network has trained since
+        if self.policy is None or self.policy_train_count != self.train_count:
+            from policy import NumpyPolicy
+            with self.train_lock:
+                self.policy = NumpyPolicy(self.model.get_weights())
+                self.policy_train_count = self.train_count
+        return self.policy
+
     def train(self):
+        # With the learner thread running training happens there, this only passes on its errors
+        # and waits while the learner is more than learner_lag batches behind replay_ratio
+        if self.learner is not None:
+            with self.learner_progress:
+                self.learner_progress.wait_for(lambda: self.learner_debt() <= self.learner_lag*self.batch_size
+                                               or self.learner_error is not None)
+            if self.learner_error is not None:
+                raise self.learner_error
+            return
+
         # check if memory is large enough to take a batch
         if len(self.memory) < self.batch_size*2:
             return
 
         # Only train 20 times for every batch size added to replay memory
-        if not self.push_count % (self.batch_size//20) == 1:
+        interval = max(1, self.batch_size//20)
+        if self.push_count % interval != 1 % interval:
             return
 
-        batch = random.sample(self.memory, self.batch_size)
-
-        # Extract features from memory
-        current_states =    np.array([item[0] for item in batch])
-        actions =           np.array([item[1] for item in batch])
-        new_states =        np.array([item[2] for item in batch])
-        rewards =           np.array([item[3] for item in batch])
-        alives =             np.array([item[4] for item in batch])
+        self.train_batch()
 
-        if self.conv:
-            current_states = np.expand_dims(current_states, axis=3)
-            new_states = np.expand_dims(new_states, axis=3)
+    def train_batch(self):
+        # Sample a batch from memory and take one gradient step
+        with self.metrics.timer('sample'), self.memory_lock:
+            if self.prioritized:
+                indices, weights = self.memory.sample_indices(self.batch_size)
+                current_states, actions, new_states, rewards, alives = self.memory.gather(indices)
+            else:
+                current_states, actions, new_states, rewards, alives = self.memory.sample(self.batch_size)
+                weights = np.ones(self.batch_size, dtype=np.float32)
 
-        # Get Q values (note different models)
-        # Returns a list of lists with shape = (batch_size, num_actions)
-        current_qs_list = self.model.predict(current_states)
-        future_qs_list = self.target_model.predict(new_states)
+            if self.conv:
+                current_states = np.expand_dims(current_states, axis=3)
+                new_states = np.expand_dims(new_states, axis=3)
 
+        with self.metrics.timer('train'):
+            if self.fused_train:
+                loss, td_errors = self.train_step(current_states, actions, new_states, rewards.astype(np.float32),
+                                                  alives.astype(np.float32), weights)
+                self.train_loss.append(float(loss))
+            else:
+                td_errors = self.fit_batch(current_states, actions, new_states, rewards, alives,
+                                           weights if self.prioritized else None)
 
+            if self.prioritized:
+                with self.memory_lock:
+                    self.memory.update_priorities(indices, np.asarray(td_errors))
+        self.metrics.observe('loss', self.train_loss[-1])
+        self.metrics.count('train_steps')
 
-        X = current_states
-        Y = []
-
-        for i in range(self.batch_size):
-            if alives[i]:
-                # Get the max q value from prediction 
-                # This is the total future reward if the AI follows the policy until game ends
-                max_future_q = np.max(future_qs_list[i])
-                new_q = rewards[i] + self.future_discount*max_future_q
-            else:
-                # If the snake is dead then the max_future_q must be zero since no further 
-                # rewards can be obtained
-                new_q = rewards[i]
-
-            # insert the new q value into training data
-            # Eg current_qs = [1, 2, 3], new_q = 10, action = 0
-            # insert new q at the index of the action
-            # becomes >> [10, 2, 3] 
-            current_qs = current_qs_list[i]
-            current_qs[actions[i]] = new_q
-
-            # Append to training data
-            Y.append(current_qs)
-
-        history = self.model.fit(X, np.array(Y), batch_size=self.batch_size, verbose=0, shuffle=False)
-        self.train_loss.append(history.history['loss'])
+        self.train_count += 1
+        if self.polyak is not None:
+            with self.metrics.timer('target_sync'):
+                self.sync_target()
+            return
         # Update target model every 
         self.target_update_counter += 1
         if self.target_update_counter > self.update_target_every:
             print('Update model')
             self.target_update_counter = 0
-            self.target_model.set_weights(self.model.get_weights())
+            with self.metrics.timer('target_sync'):
+                self.sync_target()
 
+    def start_learner(self, replay_ratio=20, lag=4):
+        # Train on a background thread from now on
+        # The learner samples replay_ratio experiences for every experience pushed (train() takes a
+        # batch every 25 pushes, about 20) and waits for pushes when ahead. The thread pushing only
+        # waits, in train(), once the learner is more than lag batches behind, so it does not wait
+        # for every train step but cannot outrun the learner either. TensorFlow releases the GIL while
+        # it computes
+        self.replay_ratio = replay_ratio
+        self.learner_lag = lag
+        self.learner_pushes = self.push_count
+        self.learner_trains = self.train_count
+        self.learner_progress = threading.Condition()
+        self.learner_stop = threading.Event()
+        self.learner = threading.Thread(target=self.learn, daemon=True)
+        self.learner.start()
 
-    def save_data(self):
-        filename = 'Snake_Memory_Conv' if self.conv else 'Snake_Memory'
-        object_to_save = [self.model.get_weights(), self.memory, self.push_count, self.train_loss, self.q_preds]
-        with open(f'{filename}.pkl', 'wb') as file:
-            pickle.dump(object_to_save, file)
+    def learner_debt(self):
+        # Experiences the learner has yet to sample to be at replay_ratio, counted from when the
+        # memory could first give a batch
+        if len(self.memory) < self.batch_size*2:
+            return 0
+        sampled = self.batch_size*(self.train_count - self.learner_trains)
+        return self.replay_ratio*(self.push_count - self.learner_pushes) - sampled
+
+    def learn(self):
+        # Learner thread, trains while at least a batch behind replay_ratio
+        try:
+            while not self.learner_stop.is_set():
+                if len(self.memory) < self.batch_size*2:
+                    self.learner_pushes = self.push_count
+                    self.learner_trains = self.train_count
+                if self.learner_debt() < self.batch_size:
+                    self.learner_stop.wait(0.001)
+                    continue
+                with self.train_lock:
+                    self.train_batch()
+                with self.learner_progress:
+                    self.learner_progress.notify_all()
+        except Exception as error:
+            self.learner_error = error
+            with self.learner_progress:
+                self.learner_progress.notify_all()
+
+    def stop_learner(self):
+        # Finish the current train step and stop the learner thread, train() trains again
+        if self.learner is None:
+            return
+        self.learner_stop.set()
+        self.learner.join()
+        self.learner = None
+        if self.learner_error is not None:
+            raise self.learner_error
+
+    def create_target_sync(self):
+        # Copies the online weights into the target model in one graph call, without the round trip
+        # through numpy of set_weights(get_weights()), or moves them polyak of the way there
+        import tensorflow as tf
+        pairs = list(zip(self.target_model.weights, self.model.weights))
+        polyak = self.polyak
+
+        @tf.function
+        def sync_target():
+            for target, online in pairs:
+                if polyak is None:
+                    target.assign(online)
+                else:
+                    target.assign(polyak*online + (1 - polyak)*target)
+
+        return sync_target
+
+    def fit_batch(self, current_states, actions, new_states, rewards, alives, weights=None):
+        # Weights scale the loss of each experience, returns the TD error of each experience
+        # Get Q values (note different models)
+        # Calling the models directly on one batch avoids the overhead of predict
+        # Returns arrays with shape = (batch_size, num_actions)
+        batch_size = len(actions)
+        if self.double_dqn:
+            # One pass of the online model over both current and new states
+            qs = np.array(self.model(np.concatenate([current_states, new_states]), training=False))
+            current_qs = qs[:batch_size]
+            future_actions = np.argmax(qs[batch_size:], axis=1)
+            future_qs = np.array(self.target_model(new_states, training=False))
+            max_future_qs = future_qs[np.arange(batch_size), future_actions]
+        else:
+            current_qs = np.array(self.model(current_states, training=False))
+            future_qs = np.array(self.target_model(new_states, training=False))
+            max_future_qs = np.max(future_qs, axis=1)
 
+        # The max future q value is the total future reward if the AI follows the policy until game ends
+        # If the snake is dead it must be zero since no further rewards can be obtained
+        new_qs = np.where(alives, rewards + self.future_discount*max_future_qs, rewards)
 
+        # Insert each new q value at the index of its action
+        # Eg current_qs = [1, 2, 3], new_q = 10, action = 0 becomes >> [10, 2, 3]
+        X = current_states
+        Y = current_qs
+        td_errors = new_qs - Y[np.arange(batch_size), actions]
+        Y[np.arange(batch_size), actions] = new_qs
+
+        history = self.model.fit(X, Y, batch_size=batch_size, sample_weight=weights, verbose=0, shuffle=False)
+        self.train_loss.append(history.history['loss'][0])
+        return td_errors
+
+    def create_train_step(self):
+        # Graph compiled train step, equivalent to fit_batch but in a single call
+        # Targets only differ from the online Q values at the taken action, as in fit_batch,
+        # so the loss matches the one reported by fit
+        # Returns the loss, weighted per experience by weights, and the TD error of each experience
+        import tensorflow as tf
+        model = self.model
+        target_model = self.target_model
+        optimizer = self.model.optimizer
+        loss_fn = tf.keras.losses.get(self.loss)
+        num_actions = self.num_actions
+        future_discount = self.future_discount
+        double_dqn = self.double_dqn
+
+        @tf.function
+        def train_step(current_states, actions, new_states, rewards, alives, weights):
+            future_qs = target_model(new_states, training=False)
+            if double_dqn:
+                # Forward only pass of the online model, nothing is backpropagated through it
+                future_actions = tf.argmax(model(new_states, training=False), axis=1)
+                max_future_qs = tf.gather(future_qs, future_actions, batch_dims=1)
+            else:
+                max_future_qs = tf.reduce_max(future_qs, axis=1)
+            new_qs = rewards + future_discount*max_future_qs*alives
+            with tf.GradientTape() as tape:
+                current_qs = model(current_states, training=True)
+                mask = tf.one_hot(actions, num_actions)
+                targets = tf.stop_gradient(current_qs*(1 - mask) + new_qs[:, None]*mask)
+                loss = tf.reduce_mean(weights*loss_fn(targets, current_qs))
+            gradients = tape.gradient(loss, model.trainable_variables)
+            optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+            td_errors = new_qs - tf.reduce_sum(current_qs*mask, axis=1)
+            return loss, td_errors
+
+        return train_step
+
+
+    def save_data(self, block=False):
+        # Checkpoints are written in the background, block waits for the write to finish
+        # The learner thread is paused while the network and memory are copied
+        with self.train_lock:
+            self.checkpoints.save(self)
+        if block:
+            self.checkpoints.wait()
 
     def load_data(self):
-        filename = 'Snake_Memory.pkl'
+        # Load the latest checkpoint, or the pickle saved by older versions if there is none
+        path = self.checkpoints.latest()
+        if path is None:
+            return self.load_pickle()
+        print(f'Loading {path}')
+        meta, weights, train_loss, arrays = load_checkpoint(path)
+        if 'memory_directory' in meta:
+            memory = MemmapReplayMemory.open(meta['memory_directory'], self.capacity,
+                                             meta['memory_position'], meta['memory_size'], self.np_rng,
+                                             meta.get('memory_generation'), meta.get('memory_flushes'))
+        else:
+            memory = self.create_memory()
+            memory.load(arrays, meta['memory_position'])
+        return weights, memory, meta['push_count'], train_loss.tolist(), meta['q_preds']
+
+    def load_pickle(self):
+        filename = 'Snake_Memory_Conv.pkl' if self.conv else 'Snake_Memory.pkl'
         with open(filename, 'rb') as file:
-            saved = pickle.load(file)
-        return saved
-        
\ No newline at end of file
+            weights, memory, push_count, train_loss, q_preds = pickle.load(file)
+        if isinstance(memory, list):
+            # Memory saved as a list of experiences
+            memory = ReplayMemory.from_list(memory, self.capacity)
+        converted = self.create_memory()
+        converted.load(memory.arrays(), memory.position)
+        # Losses were saved as one item lists
+        train_loss = [loss[0] if isinstance(loss, list) else loss for loss in train_loss]
+        return weights, converted, push_count, train_loss, q_preds
@@ -0,0 +1,828 @@
+import argparse
+import json
+import os
+import pickle
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import deque
+import numpy as np
+from replay import ReplayMemory, MemmapReplayMemory, CompactReplayMemory, FIELDS
+from snake import Snake, parse_board_size
+'''
+Micro benchmarks for the parts of the training loop that dominate run time
+
+Usage:  python benchmark.py replay [--capacity N] [--batch-size N] [--conv]
+        python benchmark.py train [--steps N] [--batch-size N] [--conv] [--double-dqn] [--huber]
+        python benchmark.py state [--lengths 3 50 200] [--steps N]
+        python benchmark.py apple [--fills 0.1 0.5 0.9 0.99]
+        python benchmark.py checkpoint [--capacity N] [--conv]
+        python benchmark.py memmap [--capacities 1000000 10000000] [--conv] [--directory DIR]
+        python benchmark.py per [--env-steps N] [--target SCORE]
+        python benchmark.py step [--games N] [--conv]
+        python benchmark.py boards [--boards 10x10 20x12 30x17 60x34] [--games N] [--conv] [--view-radius 5]
+        python benchmark.py compact [--experiences N] [--ratios 2 1.5] [--conv]
+        python benchmark.py learner [--steps N] [--conv] [--fused] [--replay-ratio 20] [--polyak 0.005]
+        python benchmark.py policy [--states N] [--batch-size N] [--conv]
+        python benchmark.py suite [--quick] [--runs N] [--output results.json] [--only env agent replay]
+        python benchmark.py compare baseline.json results.json [--threshold 0.25]
+
+suite measures env steps/s (Snake and FastSnake), get_action latency, train steps/s and replay
+push and sample rates for the MLP and conv models, and can write them as JSON with the commit and
+machine they ran on. compare exits with status 1 if any result is worse than the baseline by more
+than the threshold, so it can gate a CI job. --runs N keeps the best of N runs of each result. On a
+shared machine results still vary between runs (by up to 30% on one shared core, even with --runs 3)
+so set the threshold from repeated runs on the CI machine itself
+'''
+
+
+def list_nbytes(memory):
+    # Approximate memory held by a list of experiences of python objects
+    total = sys.getsizeof(memory)
+    for experience in memory:
+        total += sys.getsizeof(experience)
+        for item in experience:
+            total += sys.getsizeof(item)
+            if isinstance(item, list):
+                total += sum(sys.getsizeof(x) for x in item)
+    return total
+
+
+def random_experience(conv):
+    if conv:
+        state = np.random.choice([-1., 0., 1.], size=(11, 11))
+        next_state = np.random.choice([-1., 0., 1.], size=(11, 11))
+        action = random.randrange(4)
+    else:
+        state = [random.random() for _ in range(9)]
+        next_state = [random.random() for _ in range(9)]
+        action = random.randrange(3)
+    return [state, action, next_state, random.choice([1, -1, 0.05, 0]), random.random() < 0.9]
+
+
+def bench_replay(capacity, batch_size, conv, repeats):
+    experiences = [random_experience(conv) for _ in range(capacity)]
+
+    # Previous implementation, a list of experiences assembled into arrays on every batch
+    start = time.perf_counter()
+    for _ in range(repeats):
+        batch = random.sample(experiences, batch_size)
+        current_states = np.array([item[0] for item in batch])
+        actions = np.array([item[1] for item in batch])
+        new_states = np.array([item[2] for item in batch])
+        rewards = np.array([item[3] for item in batch])
+        alives = np.array([item[4] for item in batch])
+    list_time = (time.perf_counter() - start)/repeats
+
+    memory = ReplayMemory(capacity)
+    start = time.perf_counter()
+    for experience in experiences:
+        memory.push(experience)
+    push_time = (time.perf_counter() - start)/capacity
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        memory.sample(batch_size)
+    array_time = (time.perf_counter() - start)/repeats
+
+    print(f'Replay memory, capacity {capacity}, batch size {batch_size}, conv {conv}')
+    print(f'List memory:   {list_nbytes(experiences)/1e6:.1f} MB, {list_time*1e3:.3f} ms per batch')
+    print(f'Array memory:  {memory.nbytes/1e6:.1f} MB, {array_time*1e3:.3f} ms per batch, {push_time*1e6:.2f} us per push')
+
+
+def bench_train(steps, batch_size, conv, double_dqn, huber):
+    # Compare train steps per second of predict + fit against the compiled fused train step
+    from DQN import DeepQNetwork
+    input_dims, num_actions = (11, 4) if conv else (9, 3)
+    for fused in (False, True):
+        DQN = DeepQNetwork(input_dims, num_actions, True, fused_train=fused, double_dqn=double_dqn, huber=huber)
+        DQN.batch_size = batch_size
+        for _ in range(batch_size*2):
+            DQN.push_to_memory(random_experience(conv))
+        # First call traces and builds everything
+        DQN.train_batch()
+        start = time.perf_counter()
+        for _ in range(steps):
+            DQN.train_batch()
+        elapsed = time.perf_counter() - start
+        name = 'fused train step' if fused else 'predict + fit'
+        print(f'{name}: {steps/elapsed:.1f} train steps/s ({elapsed/steps*1e3:.2f} ms per step)')
+
+
+def cycle_path(width, height):
+    # Closed path visiting every block of a width x height area (width must be even)
+    path = [[x, 0] for x in range(width)]
+    for i, x in enumerate(range(width-1, -1, -1)):
+        ys = range(1, height) if i % 2 == 0 else range(height-1, 0, -1)
+        path += [[x, y] for y in ys]
+    return path
+
+
+def snake_on_cycle(length, incremental):
+    # A snake of the given length following a cycle that leaves the last column empty
+    # The apple is put in that column so the snake never eats it and the length stays fixed
+    snake = Snake(1, 1000, 600, False, incremental=incremental)
+    path = cycle_path(snake.game_width_blocks - 2, snake.game_height_blocks)
+    snake.body = deque(list(block) for block in path[:length])
+    snake.pos = list(path[length-1])
+    dx = path[length-1][0] - path[length-2][0]
+    dy = path[length-1][1] - path[length-2][1]
+    snake.direction = [[0, -1], [1, 0], [0, 1], [-1, 0]].index([dx, dy])
+    snake.apple = [snake.game_width_blocks - 1, 0]
+    snake.repaint_board()
+    snake.rebuild_free_blocks()
+    snake.update_state()
+    return snake, path
+
+
+def bench_state(lengths, steps):
+    # Steps per second of move + update_board + update_state for fixed body lengths
+    for length in lengths:
+        results = []
+        for incremental in (False, True):
+            snake, path = snake_on_cycle(length, incremental)
+            i = length - 1
+            start = time.perf_counter()
+            for _ in range(steps):
+                i = (i + 1) % len(path)
+                dx = path[i][0] - snake.pos[0]
+                dy = path[i][1] - snake.pos[1]
+                direction = [[0, -1], [1, 0], [0, 1], [-1, 0]].index([dx, dy])
+                action = (direction - snake.direction + 1) % 4    # Left (0), continue (1), right (2)
+                snake.move(action)
+                snake.update_board()
+                snake.update_state()
+                snake.move_counter = 0
+            results.append(steps/(time.perf_counter() - start))
+            assert snake.alive and len(snake.body) == length
+        print(f'Body length {length}: repaint {results[0]:.0f} steps/s, incremental {results[1]:.0f} steps/s')
+
+
+def bench_apple(fills, repeats):
+    # Time to place an apple when the body covers a fraction of the board
+    for fill in fills:
+        snake = Snake(1, 1000, 600, False)
+        path = cycle_path(snake.game_width_blocks, snake.game_height_blocks)
+        snake.body = deque(list(block) for block in path[:int(fill*len(path))])
+        snake.rebuild_free_blocks()
+
+        # Previous implementation, rejection sampling against the body list
+        start = time.perf_counter()
+        for _ in range(repeats):
+            while True:
+                new_apple_pos = [random.randint(0, snake.game_width_blocks-1), random.randint(0, snake.game_height_blocks-1)]
+                if new_apple_pos not in snake.body:
+                    break
+        rejection_time = (time.perf_counter() - start)/repeats
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            snake.place_apple()
+        free_list_time = (time.perf_counter() - start)/repeats
+        print(f'Body covers {fill:.0%}: rejection sampling {rejection_time*1e6:.1f} us, free list {free_list_time*1e6:.2f} us')
+
+
+def bench_checkpoint(capacity, conv):
+    # Training stall, total write time, size on disk and load time of a checkpoint with a full
+    # replay memory, against pickling everything into one file
+    from DQN import DeepQNetwork
+    directory = tempfile.mkdtemp()
+    DQN = DeepQNetwork(11 if conv else 9, 4 if conv else 3, True, checkpoint_dir=directory)
+    DQN.memory = ReplayMemory(capacity)
+    for experience in (random_experience(conv) for _ in range(capacity)):
+        DQN.push_to_memory(experience)
+
+    pickle_path = os.path.join(directory, 'Snake_Memory.pkl')
+    start = time.perf_counter()
+    with open(pickle_path, 'wb') as file:
+        pickle.dump([DQN.model.get_weights(), DQN.memory, DQN.push_count, DQN.train_loss, DQN.q_preds], file)
+    pickle_time = time.perf_counter() - start
+    start = time.perf_counter()
+    with open(pickle_path, 'rb') as file:
+        pickle.load(file)
+    unpickle_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    DQN.save_data()
+    stall_time = time.perf_counter() - start
+    DQN.checkpoints.wait()
+    write_time = time.perf_counter() - start
+    path = DQN.checkpoints.latest()
+    size = sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+    start = time.perf_counter()
+    DQN.load_data()
+    load_time = time.perf_counter() - start
+
+    print(f'Checkpoint, replay capacity {capacity}, conv {conv}')
+    print(f'Pickle:      {os.path.getsize(pickle_path)/1e6:.1f} MB, {pickle_time*1e3:.0f} ms blocking, {unpickle_time*1e3:.0f} ms to load')
+    print(f'Checkpoint:  {size/1e6:.1f} MB, {stall_time*1e3:.0f} ms blocking, {write_time*1e3:.0f} ms to write, {load_time*1e3:.1f} ms to load')
+
+
+def rss():
+    # Resident set size of this process in bytes (Linux only)
+    with open('/proc/self/status') as file:
+        for line in file:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])*1024
+    return 0
+
+
+def fill_memory(memory, conv, chunk=100_000):
+    # Fill every slot with random experiences, a chunk of slots at a time
+    memory.allocate(random_experience(conv)[0])
+    for start in range(0, memory.capacity, chunk):
+        end = min(start + chunk, memory.capacity)
+        n = end - start
+        shape = (n,) + memory.states.shape[1:]
+        memory.states[start:end] = np.random.choice(np.array([-1, 0, 1], dtype=np.float32), size=shape)
+        memory.next_states[start:end] = np.random.choice(np.array([-1, 0, 1], dtype=np.float32), size=shape)
+        memory.actions[start:end] = np.random.randint(4 if conv else 3, size=n)
+        memory.rewards[start:end] = np.random.choice([1, -1, 0.05, 0], size=n)
+        memory.alives[start:end] = np.random.random(n) < 0.9
+    memory.size = memory.capacity
+
+
+def bench_memmap(capacities, conv, batch_size, repeats, directory):
+    # RSS and sampling latency of full in-memory and memory-mapped replay memories
+    # The memory-mapped files are evicted from the page cache before sampling so the first batches
+    # read from disk. In-memory buffers that would not fit in the available RAM are skipped
+    with open('/proc/meminfo') as file:
+        available = next(int(line.split()[1])*1024 for line in file if line.startswith('MemAvailable:'))
+    state_bytes = 4*(121 if conv else 9)
+    print(f'Replay memory, conv {conv}, batch size {batch_size}')
+    for capacity in capacities:
+        nbytes = capacity*(2*state_bytes + 8 + 8 + 1)
+        for backend in ('memory', 'memmap'):
+            if backend == 'memory':
+                if nbytes > 0.8*available:
+                    print(f'{capacity:>11,} {backend:>7}: {nbytes/1e9:.1f} GB does not fit in {available/1e9:.1f} GB of RAM')
+                    continue
+                memory = ReplayMemory(capacity)
+                fill_memory(memory, conv)
+            else:
+                path = os.path.join(directory, f'replay-{capacity}')
+                memory = MemmapReplayMemory(capacity, path)
+                fill_memory(memory, conv)
+                memory.flush()
+                del memory
+                for name in FIELDS:
+                    fd = os.open(os.path.join(path, name + '.npy'), os.O_RDONLY)
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+                    os.close(fd)
+                memory = MemmapReplayMemory.open(path, capacity, 0, capacity)
+            before = rss()
+            times = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                memory.sample(batch_size)
+                times.append(time.perf_counter() - start)
+            times = np.array(times)*1e3
+            print(f'{capacity:>11,} {backend:>7}: {nbytes/1e9:.2f} GB, RSS {before/1e6:.0f} MB before sampling, '
+                  f'{rss()/1e6:.0f} MB after, sample p50 {np.percentile(times, 50):.2f} ms, '
+                  f'p99 {np.percentile(times, 99):.2f} ms')
+            del memory
+            if backend == 'memmap':
+                shutil.rmtree(path)
+
+
+def gated_experiences(count, conv, seed=0):
+    # Experiences passed by ReplayGate while a parity.py policy, with 30% random moves, plays FastSnake
+    from fast_snake import FastSnake
+    from parity import policy
+    from replay import ReplayGate
+    rng = np.random.default_rng(seed)
+    gate = ReplayGate(rng=random.Random(seed))
+    experiences = []
+    apples = loses = 0
+    game = 0
+    while len(experiences) < count:
+        snake = FastSnake(1, 1000, 600, conv, rng=random.Random(game))
+        game += 1
+        while snake.alive and len(experiences) < count:
+            action = policy(snake.state, conv, rng) if rng.random() > 0.3 else int(rng.integers(4 if conv else 3))
+            snake.move(action)
+            if snake.move_counter < 1000:
+                total = max(len(experiences), 1)
+                for state, action, next_state, reward, alive in gate.filter(snake.get_experience(), 100*apples/total,
+                                                                            100*loses/total):
+                    experiences.append([np.array(state), action, np.array(next_state), reward, alive])
+                    apples += reward == 1
+                    loses += reward == -1
+    return experiences[:count]
+
+
+def bench_compact(count, ratios, conv, batch_size, repeats):
+    # Bytes per experience and push and sample times of ReplayMemory against CompactReplayMemory,
+    # filled with the experiences ReplayGate passes during play, and a check that both give the
+    # same batches from the same seed
+    experiences = gated_experiences(count, conv)
+    # As stored before ReplayMemory: a list of [state, action, next_state, reward, alive] with
+    # float64 states, the MLP state as a list of floats
+    if conv:
+        as_objects = experiences
+    else:
+        as_objects = [[list(map(float, s)), a, list(map(float, n)), r, al] for s, a, n, r, al in experiences]
+    list_bytes = list_nbytes(as_objects) + sum(e[0].nbytes + e[2].nbytes for e in as_objects if conv)
+    print(f'{count} experiences passed by ReplayGate, conv {conv}')
+    print(f'{"list of objects":>26}: {list_bytes/count:7.1f} bytes per experience')
+    memories = [('ReplayMemory', lambda: ReplayMemory(count, np.random.default_rng(0)))]
+    memories += [(f'CompactReplayMemory {ratio:g}', lambda ratio=ratio: CompactReplayMemory(count, np.random.default_rng(0), ratio))
+                 for ratio in ratios]
+    reference = None
+    for name, make in memories:
+        memory = make()
+        start = time.perf_counter()
+        for experience in experiences:
+            memory.push(experience)
+        push = (time.perf_counter() - start)/count
+        sample = 1/best_rate(lambda: memory.sample(batch_size), 1, repeats)
+        memory.rng = np.random.default_rng(1)
+        batches = [memory.sample(batch_size) for _ in range(20)]
+        if reference is None:
+            reference = batches
+            same = ''
+        elif len(memory) < count:
+            same = f', {count - len(memory)} experiences dropped early'
+        else:
+            identical = all(np.array_equal(a, b) and a.dtype == b.dtype
+                            for batch, expected in zip(batches, reference) for a, b in zip(batch, expected))
+            same = ', batches identical' if identical else ', BATCHES DIFFER'
+        extra = ''
+        if isinstance(memory, CompactReplayMemory):
+            extra = f', {memory.observation_count/count:.2f} observations per experience'
+        print(f'{name:>26}: {memory.nbytes/count:7.1f} bytes per experience ({list_bytes/memory.nbytes:4.1f}x smaller '
+              f'than the list), push {push*1e6:.1f} us, sample {sample*1e3:.3f} ms{extra}{same}')
+
+
+def bench_learner(steps, conv, fused, replay_ratio, polyak):
+    # Latency of each step of a main-like loop (action, move, push, train) with training in the loop
+    # against training on the learner thread, with a target copy every 300 steps or a Polyak update
+    # Every experience is pushed, as with prioritized replay, so training keeps up with the loop
+    from DQN import DeepQNetwork
+    from fast_snake import FastSnake
+    from parity import record_game
+    input_dims, num_actions = (11, 4) if conv else (9, 3)
+    # numba compiles FastSnake's kernels on their first calls
+    play_recorded(lambda rng: FastSnake(1, 1000, 600, conv, rng=rng), [(0, record_game(0, conv))], conv)
+    print(f'{steps} env steps, conv {conv}, fused {fused}')
+    for name, thread, tau in (('train in loop', False, None), ('learner thread', True, None),
+                              (f'learner thread, polyak {polyak}', True, polyak)):
+        DQN = DeepQNetwork(input_dims, num_actions, True, fused_train=fused, checkpoint_dir=tempfile.mkdtemp(),
+                           seed=0, polyak=tau)
+        random.seed(0)
+        for _ in range(DQN.batch_size*2):
+            DQN.push_to_memory(random_experience(conv))
+        # First calls trace and build everything
+        DQN.train_batch()
+        DQN.sync_target()
+        if thread:
+            DQN.start_learner(replay_ratio)
+        pushes = DQN.push_count
+        trains = DQN.train_count
+        snake = FastSnake(1, 1000, 600, conv, rng=random.Random(0))
+        latencies = []
+        start = time.perf_counter()
+        for step in range(steps):
+            step_start = time.perf_counter()
+            action = DQN.get_action(snake.state, False, False)
+            snake.move(action)
+            DQN.push_to_memory(snake.get_experience())
+            DQN.train()
+            if not snake.alive:
+                snake = FastSnake(1, 1000, 600, conv, rng=random.Random(step))
+            latencies.append(time.perf_counter() - step_start)
+        elapsed = time.perf_counter() - start
+        DQN.stop_learner()
+        latencies = np.array(latencies)*1e3
+        ratio = (DQN.train_count - trains)*DQN.batch_size/(DQN.push_count - pushes)
+        print(f'{name:>32}: {steps/elapsed:6.0f} env steps/s, step latency p50 {np.percentile(latencies, 50):.2f} ms, '
+              f'p99 {np.percentile(latencies, 99):.2f} ms, p99.9 {np.percentile(latencies, 99.9):.2f} ms, '
+              f'max {latencies.max():.1f} ms, {DQN.train_count - trains} train steps (replay ratio {ratio:.1f})')
+
+
+def bench_policy(num_states, batch_size, conv, repeats):
+    # Q values and actions of NumpyPolicy against the Keras model on the same states, through an
+    # export, and the latency of one greedy action and of a batch with each
+    from DQN import DeepQNetwork
+    from policy import NumpyPolicy, export_weights, read_export
+    input_dims, num_actions = (11, 4) if conv else (9, 3)
+    DQN = DeepQNetwork(input_dims, num_actions, True, checkpoint_dir=tempfile.mkdtemp(), seed=0, conv=conv)
+    path = os.path.join(tempfile.mkdtemp(), 'policy.npz')
+    export_weights(DQN.model.get_weights(), path)
+    policy = NumpyPolicy(read_export(path))
+    rng = np.random.default_rng(0)
+    if conv:
+        states = rng.choice([-1.0, 0.0, 1.0], size=(num_states, 11, 11))
+    else:
+        states = rng.uniform(-1, 1, size=(num_states, 9))
+    keras_qs = np.asarray(DQN.model(states[..., None] if conv else states, training=False))
+    numpy_qs = policy.q_values(states)
+    single_qs = np.array([policy.q_values(state) for state in states[:100]]).reshape(-1, num_actions)
+    print(f'{num_states} states, conv {conv}: max Q difference {np.abs(keras_qs - numpy_qs).max():.2e} batched, '
+          f'{np.abs(keras_qs[:100] - single_qs).max():.2e} one at a time (Q values up to {np.abs(keras_qs).max():.2f}), '
+          f'same action for {np.mean(keras_qs.argmax(1) == numpy_qs.argmax(1)):.1%} of states')
+
+    state = states[0] if conv else list(states[0])
+    batch = states[:batch_size]
+    for name, act, act_batch in (('keras', lambda: DQN.get_action(state, True, False),
+                                  lambda: DQN.get_actions(batch, True, False)),
+                                 ('numpy', lambda: policy.act(state), lambda: policy.acts(batch))):
+        act()
+        calls = repeats if name == 'keras' else repeats*20
+        start = time.perf_counter()
+        for _ in range(calls):
+            act()
+        single = (time.perf_counter() - start)/calls
+        start = time.perf_counter()
+        for _ in range(repeats):
+            act_batch()
+        batched = (time.perf_counter() - start)/repeats
+        print(f'{name:>6}: one action {single*1e6:8.1f} us, batch of {batch_size} {batched*1e3:7.2f} ms')
+
+
+def bench_per(env_steps, num_games, eval_every, eval_games, target, seed):
+    # Environment steps for the MLP DQN to reach an average greedy score of target, filtering
+    # experiences with ReplayGate against pushing all of them to prioritized replay
+    # Both run from the same seeds with the fused train step, greedy scores are averaged over
+    # eval_games fixed games every eval_every steps
+    from DQN import DeepQNetwork
+    from evaluate import play_games
+    from parallel_training import ParallelTrainer
+    from vector_snake import VectorSnake
+    for prioritized in (False, True):
+        DQN = DeepQNetwork(9, 3, True, fused_train=True, prioritized=prioritized, checkpoint_dir=tempfile.mkdtemp(),
+                           seed=seed)
+        trainer = ParallelTrainer(DQN, VectorSnake(num_games, 1000, 600, False, rng=random.Random(seed)))
+        steps = 0
+        reached = None
+        curve = []
+        start = time.perf_counter()
+        while steps < env_steps and reached is None:
+            trainer.step()
+            steps += num_games
+            if steps % eval_every < num_games:
+                results = play_games(DQN.model.get_weights(), range(10**6, 10**6 + eval_games), False)
+                score = sum(result['score'] for result in results)/eval_games
+                curve.append(f'{score:.1f}')
+                if score >= target:
+                    reached = steps
+        name = 'Prioritized replay' if prioritized else 'ReplayGate'
+        result = f'{reached:,} env steps' if reached else f'not reached in {steps:,} env steps'
+        print(f'{name}: average score {target} {result}, {DQN.train_count} train steps, '
+              f'{time.perf_counter() - start:.0f} s, scores every {eval_every:,} steps: {" ".join(curve)}')
+
+
+def bench_step(num_games, conv):
+    # Raw steps per second of Snake against FastSnake, replaying games recorded by parity.py
+    # Only the calls made by the training loop are timed: move, update_board and update_state
+    from fast_snake import FastSnake, njit
+    from parity import record_game
+    games = [(seed, record_game(seed, conv)) for seed in range(num_games)]
+    moves = sum(len(actions) for _, actions in games)
+    implementations = [('Snake', lambda: Snake(1, 1000, 600, conv))]
+    if not conv:
+        implementations.append(('Snake incremental', lambda: Snake(1, 1000, 600, conv, incremental=True)))
+    implementations.append(('FastSnake python', lambda: FastSnake(1, 1000, 600, conv, use_numba=False)))
+    if njit is not None:
+        implementations.append(('FastSnake numba', lambda: FastSnake(1, 1000, 600, conv, use_numba=True)))
+    print(f'{num_games} recorded games, {moves} moves, conv {conv}')
+    reference = None
+    for name, game in implementations:
+        # Play the first game once before timing so numba has compiled every kernel
+        random.seed(games[0][0])
+        snake = game()
+        for action in games[0][1]:
+            snake.move(action)
+        start = time.perf_counter()
+        for seed, actions in games:
+            random.seed(seed)
+            snake = game()
+            for action in actions:
+                snake.move(action)
+                snake.update_board()
+                if conv:
+                    snake.update_state_conv()
+                else:
+                    snake.update_state()
+        rate = moves/(time.perf_counter() - start)
+        reference = reference or rate
+        print(f'{name}: {rate:.0f} steps/s ({rate/reference:.1f}x)')
+
+
+def bench_boards(boards, num_games, conv, view_radius, repeats):
+    # Env steps per second on each board size, replaying games recorded by parity.py on that board
+    # Moves per game grow with the board, so the games are the same for Snake and FastSnake but
+    # differ between boards
+    from fast_snake import FastSnake, njit
+    from parity import record_game
+    implementations = [('Snake', Snake)]
+    if njit is not None:
+        implementations.append(('FastSnake', FastSnake))
+    print(f'{num_games} recorded games per board, conv {conv}, view radius {view_radius}')
+    for board_size in boards:
+        games = [(seed, record_game(seed, conv, board_size, view_radius)) for seed in range(num_games)]
+        moves = sum(len(actions) for _, actions in games)
+        rates = []
+        for name, Game in implementations:
+            def game(rng, Game=Game):
+                return Game(1, 1000, 600, conv, rng=rng, board_size=board_size, view_radius=view_radius)
+            play_recorded(game, games[:1], conv)     # numba compiles on the first game
+            rate = best_rate(lambda: play_recorded(game, games, conv), moves, repeats)
+            rates.append(f'{name} {rate:>8.0f} steps/s ({1e6/rate:5.1f} us/step)')
+        width, height = board_size
+        print(f'{width:>3}x{height:<3} {width*height:>5} blocks, {moves:>6} moves: ' + ', '.join(rates))
+
+
+def best_rate(work, count, repeats):
+    # Rate of the fastest of repeats runs of work(), which does count things
+    # The fastest run is the one least disturbed by anything else on the machine
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        work()
+        times.append(time.perf_counter() - start)
+    return count/min(times)
+
+
+def play_recorded(game, games, conv):
+    # Replay recorded games (seed, actions) on new games made by game(rng)
+    for seed, actions in games:
+        snake = game(random.Random(seed))
+        for action in actions:
+            snake.move(action)
+            snake.update_board()
+            if conv:
+                snake.update_state_conv()
+            else:
+                snake.update_state()
+
+
+def suite_env(results, conv, num_games, repeats):
+    # Steps per second of move + update_board + update_state (or update_state_conv) on recorded
+    # games, for Snake and for FastSnake
+    from fast_snake import FastSnake
+    from parity import record_game
+    name = 'conv' if conv else 'mlp'
+    games = [(seed, record_game(seed, conv)) for seed in range(num_games)]
+    moves = sum(len(actions) for _, actions in games)
+    implementations = [('snake', lambda rng: Snake(1, 1000, 600, conv, rng=rng)),
+                       ('fast_snake', lambda rng: FastSnake(1, 1000, 600, conv, rng=rng))]
+    for implementation, game in implementations:
+        play_recorded(game, games[:1], conv)    # Compiles FastSnake's kernels with numba
+        results[f'env.{name}.{implementation}.steps_per_sec'] = best_rate(
+            lambda: play_recorded(game, games, conv), moves, repeats)
+
+
+def suite_agent(results, conv, calls, train_steps, batch_size, repeats):
+    # get_action latency and train steps per second, with predict + fit and the fused train step
+    from DQN import DeepQNetwork
+    name = 'conv' if conv else 'mlp'
+    input_dims, num_actions = (11, 4) if conv else (9, 3)
+    random.seed(0)
+    for fused in (False, True):
+        DQN = DeepQNetwork(input_dims, num_actions, True, fused_train=fused, checkpoint_dir=tempfile.mkdtemp(), seed=0)
+        DQN.batch_size = batch_size
+        for _ in range(batch_size*2):
+            DQN.push_to_memory(random_experience(conv))
+        if not fused:
+            states = DQN.memory.states[:calls]
+            DQN.get_action(states[0], True, False)
+            latencies = []
+            for state in states:
+                start = time.perf_counter()
+                DQN.get_action(state, True, False)
+                latencies.append(time.perf_counter() - start)
+            results[f'agent.{name}.get_action.p50_us'] = float(np.percentile(latencies, 50))*1e6
+            results[f'agent.{name}.get_action.p99_us'] = float(np.percentile(latencies, 99))*1e6
+        DQN.train_batch()   # First call traces and builds everything
+
+        def train():
+            for _ in range(train_steps):
+                DQN.train_batch()
+        results[f'agent.{name}.{"fused_train" if fused else "train"}.steps_per_sec'] = best_rate(
+            train, train_steps, repeats)
+
+
+def suite_replay(results, conv, capacity, batch_size, samples, repeats):
+    # Replay memory pushes and sampled batches per second
+    name = 'conv' if conv else 'mlp'
+    random.seed(0)
+    experiences = [random_experience(conv) for _ in range(capacity)]
+    memory = ReplayMemory(capacity, np.random.default_rng(0))
+
+    def push():
+        for experience in experiences:
+            memory.push(experience)
+
+    def sample():
+        for _ in range(samples):
+            memory.sample(batch_size)
+    results[f'replay.{name}.push_per_sec'] = best_rate(push, capacity, repeats)
+    results[f'replay.{name}.sample_per_sec'] = best_rate(sample, samples, repeats)
+
+
+def environment():
+    # What the results were measured on, to tell apart differences between commits and machines
+    import platform
+    import subprocess
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    versions = {'python': platform.python_version(), 'numpy': np.__version__}
+    for module in ('tensorflow', 'numba'):
+        if module in sys.modules:
+            versions[module] = sys.modules[module].__version__
+    return {
+        'commit': commit,
+        'time': time.time(),
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'versions': versions,
+    }
+
+
+def better(key, a, b):
+    # Rates (per_sec) are better higher, latencies (_us) lower
+    return max(a, b) if key.endswith('per_sec') else min(a, b)
+
+
+def bench_suite(quick, output, only, runs):
+    # Every suite benchmark, printed and optionally written as JSON for compare
+    # quick shrinks every benchmark to run in about a minute on a CI machine
+    # The whole suite is run runs times keeping the best of each result, since a busy or shared
+    # machine slows down some runs but never speeds one up
+    sizes = {
+        'games': 10 if quick else 50,
+        'repeats': 3 if quick else 5,
+        'calls': 200 if quick else 1000,
+        'train_steps': 10 if quick else 50,
+        'capacity': 20_000 if quick else 100_000,
+        'batch_size': 512,
+    }
+    suites = {
+        'env': lambda results, conv: suite_env(results, conv, sizes['games'], sizes['repeats']),
+        'agent': lambda results, conv: suite_agent(results, conv, sizes['calls'], sizes['train_steps'],
+                                                   sizes['batch_size'], sizes['repeats']),
+        'replay': lambda results, conv: suite_replay(results, conv, sizes['capacity'], sizes['batch_size'],
+                                                     sizes['calls'], sizes['repeats']),
+    }
+    results = {}
+    for _ in range(runs):
+        run_results = {}
+        for name, suite in suites.items():
+            if only and name not in only:
+                continue
+            for conv in (False, True):
+                suite(run_results, conv)
+        for key, value in run_results.items():
+            results[key] = better(key, results[key], value) if key in results else value
+    for key, value in results.items():
+        print(f'{key}: {value:.1f}')
+    if output:
+        with open(output, 'w') as file:
+            json.dump({'environment': environment(), 'sizes': sizes, 'runs': runs, 'results': results}, file, indent=2)
+
+
+def compare(baseline_path, path, threshold):
+    # Relative change of every result against a baseline, returns the names of the results that
+    # got worse by more than threshold. Rates (per_sec) should go up, latencies (_us) down
+    with open(baseline_path) as file:
+        baseline = json.load(file)['results']
+    with open(path) as file:
+        results = json.load(file)['results']
+    regressions = []
+    for key in sorted(set(baseline) & set(results)):
+        change = results[key]/baseline[key] - 1
+        worse = -change if key.endswith('per_sec') else change
+        flag = ''
+        if worse > threshold:
+            regressions.append(key)
+            flag = '  REGRESSION'
+        print(f'{key}: {baseline[key]:.1f} -> {results[key]:.1f} ({change:+.1%}){flag}')
+    for key in sorted(set(baseline) ^ set(results)):
+        print(f'{key}: only in {baseline_path if key in baseline else path}')
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Snake DQN benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    replay_parser = subparsers.add_parser('replay', help='Replay memory footprint and batch assembly time')
+    replay_parser.add_argument('--capacity', type=int, default=100_000)
+    replay_parser.add_argument('--batch-size', type=int, default=512)
+    replay_parser.add_argument('--conv', action='store_true')
+    replay_parser.add_argument('--repeats', type=int, default=200)
+
+    train_parser = subparsers.add_parser('train', help='Train steps per second, fit against the fused train step')
+    train_parser.add_argument('--steps', type=int, default=200)
+    train_parser.add_argument('--batch-size', type=int, default=512)
+    train_parser.add_argument('--conv', action='store_true')
+    train_parser.add_argument('--double-dqn', action='store_true')
+    train_parser.add_argument('--huber', action='store_true')
+
+    state_parser = subparsers.add_parser('state', help='Snake steps per second at fixed body lengths')
+    state_parser.add_argument('--lengths', type=int, nargs='+', default=[3, 50, 200])
+    state_parser.add_argument('--steps', type=int, default=20_000)
+
+    apple_parser = subparsers.add_parser('apple', help='Apple placement time as the board fills')
+    apple_parser.add_argument('--fills', type=float, nargs='+', default=[0.1, 0.5, 0.9, 0.99])
+    apple_parser.add_argument('--repeats', type=int, default=1000)
+
+    checkpoint_parser = subparsers.add_parser('checkpoint', help='Checkpoint save and load time against pickle')
+    checkpoint_parser.add_argument('--capacity', type=int, default=100_000)
+    checkpoint_parser.add_argument('--conv', action='store_true')
+
+    memmap_parser = subparsers.add_parser('memmap', help='RSS and sampling latency of in-memory and memory-mapped replay')
+    memmap_parser.add_argument('--capacities', type=int, nargs='+', default=[1_000_000, 10_000_000])
+    memmap_parser.add_argument('--conv', action='store_true')
+    memmap_parser.add_argument('--batch-size', type=int, default=512)
+    memmap_parser.add_argument('--repeats', type=int, default=200)
+    memmap_parser.add_argument('--directory', default=tempfile.gettempdir(), help='where the memory-mapped files are written')
+
+    per_parser = subparsers.add_parser('per', help='Env steps to reach a score, ReplayGate against prioritized replay')
+    per_parser.add_argument('--env-steps', type=int, default=500_000)
+    per_parser.add_argument('--games', type=int, default=32, help='games played at once')
+    per_parser.add_argument('--eval-every', type=int, default=25_000)
+    per_parser.add_argument('--eval-games', type=int, default=20)
+    per_parser.add_argument('--target', type=float, default=5)
+    per_parser.add_argument('--seed', type=int, default=0)
+
+    step_parser = subparsers.add_parser('step', help='Raw steps per second of Snake against FastSnake')
+    step_parser.add_argument('--games', type=int, default=50)
+    step_parser.add_argument('--conv', action='store_true')
+
+    boards_parser = subparsers.add_parser('boards', help='Env steps per second on each board size')
+    boards_parser.add_argument('--boards', type=parse_board_size, nargs='+',
+                               default=[(10, 10), (20, 12), (30, 17), (60, 34)])
+    boards_parser.add_argument('--games', type=int, default=20)
+    boards_parser.add_argument('--conv', action='store_true')
+    boards_parser.add_argument('--view-radius', type=int, default=5)
+    boards_parser.add_argument('--repeats', type=int, default=3)
+
+    compact_parser = subparsers.add_parser('compact', help='Bytes per experience of ReplayMemory and CompactReplayMemory')
+    compact_parser.add_argument('--experiences', type=int, default=50_000)
+    compact_parser.add_argument('--ratios', type=float, nargs='+', default=[2.0, 1.5],
+                                help='observations per experience of each CompactReplayMemory')
+    compact_parser.add_argument('--conv', action='store_true')
+    compact_parser.add_argument('--batch-size', type=int, default=64)
+    compact_parser.add_argument('--repeats', type=int, default=100)
+
+    learner_parser = subparsers.add_parser('learner', help='Env step latency with training in the loop or on a thread')
+    learner_parser.add_argument('--steps', type=int, default=20_000)
+    learner_parser.add_argument('--conv', action='store_true')
+    learner_parser.add_argument('--fused', action='store_true')
+    learner_parser.add_argument('--replay-ratio', type=float, default=20)
+    learner_parser.add_argument('--polyak', type=float, default=0.005)
+
+    policy_parser = subparsers.add_parser('policy', help='NumpyPolicy against the Keras model, accuracy and latency')
+    policy_parser.add_argument('--states', type=int, default=10_000)
+    policy_parser.add_argument('--batch-size', type=int, default=256)
+    policy_parser.add_argument('--conv', action='store_true')
+    policy_parser.add_argument('--repeats', type=int, default=200)
+
+    suite_parser = subparsers.add_parser('suite', help='Env, agent and replay throughput, optionally as JSON')
+    suite_parser.add_argument('--quick', action='store_true', help='smaller sizes, about a minute on one core')
+    suite_parser.add_argument('--output', help='write the results and the machine they ran on to this JSON file')
+    suite_parser.add_argument('--only', nargs='+', choices=['env', 'agent', 'replay'])
+    suite_parser.add_argument('--runs', type=int, default=1, help='keep the best result of this many runs')
+
+    compare_parser = subparsers.add_parser('compare', help='Compare suite results against a baseline')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('results')
+    compare_parser.add_argument('--threshold', type=float, default=0.25, help='relative change counted as a regression')
+
+    args = parser.parse_args()
+    if args.benchmark == 'replay':
+        bench_replay(args.capacity, args.batch_size, args.conv, args.repeats)
+    elif args.benchmark == 'train':
+        bench_train(args.steps, args.batch_size, args.conv, args.double_dqn, args.huber)
+    elif args.benchmark == 'state':
+        bench_state(args.lengths, args.steps)
+    elif args.benchmark == 'apple':
+        bench_apple(args.fills, args.repeats)
+    elif args.benchmark == 'checkpoint':
+        bench_checkpoint(args.capacity, args.conv)
+    elif args.benchmark == 'memmap':
+        bench_memmap(args.capacities, args.conv, args.batch_size, args.repeats, args.directory)
+    elif args.benchmark == 'per':
+        bench_per(args.env_steps, args.games, args.eval_every, args.eval_games, args.target, args.seed)
+    elif args.benchmark == 'step':
+        bench_step(args.games, args.conv)
+    elif args.benchmark == 'boards':
+        bench_boards(args.boards, args.games, args.conv, args.view_radius, args.repeats)
+    elif args.benchmark == 'compact':
+        bench_compact(args.experiences, args.ratios, args.conv, args.batch_size, args.repeats)
+    elif args.benchmark == 'learner':
+        bench_learner(args.steps, args.conv, args.fused, args.replay_ratio, args.polyak)
+    elif args.benchmark == 'policy':
+        bench_policy(args.states, args.batch_size, args.conv, args.repeats)
+    elif args.benchmark == 'suite':
+        bench_suite(args.quick, args.output, args.only, args.runs)
+    elif args.benchmark == 'compare':
+        sys.exit(1 if compare(args.baseline, args.results, args.threshold) else 0)
@@ -0,0 +1,153 @@
+import json
+import os
+import shutil
+import threading
+import time
+import numpy as np
+from replay import MemmapReplayMemory
+'''
+Versioned checkpoints of a DeepQNetwork
+
+Each save creates a directory named after its sequence number and the push count:
+
+    <directory>/ckpt-000007-000000050000/
+        meta.json       counters, sequence number, replay memory position and format version
+        weights.npz     model weights as saved by model.get_weights(), in order
+        train_loss.npy
+        memory/         one .npy file per replay memory field, only the filled rows (for a
+                        CompactReplayMemory the observation ring and the fields of each experience)
+
+The replay memory files are opened memory-mapped on load so they are only read from disk as
+they are used. A MemmapReplayMemory is already on disk, so it is flushed and the checkpoint
+records its directory (memory_directory in meta.json) instead of copying it, with the generation
+and flush count of its files. Those files keep changing after the save, so only a checkpoint whose
+generation and flush count still match them (the newest, unless more was pushed after it) can be
+loaded, see MemmapReplayMemory. Saving copies the weights and memory on the calling thread, then
+writes them on a background thread into a temporary directory which is renamed into place once
+complete. Only the newest keep checkpoints are kept.
+
+Checkpoints are ordered by the sequence number, one more than the newest checkpoint in the directory,
+not by push count: a run started over with reset weights counts pushes from 0 again and its
+checkpoints must still be the newest. Checkpoints written before sequence numbers count as 0, in
+order of their save time.
+'''
+
+FORMAT_VERSION = 1
+
+
+class CheckpointManager:
+    def __init__(self, directory, keep=3):
+        self.directory = directory
+        self.keep = keep
+        self.thread = None
+
+    def save(self, DQN, block=False):
+        # Snapshot the network now and write it in the background (or straight away if block)
+        self.wait()
+        memory = DQN.memory
+        sequence = self.next_sequence()
+        snapshot = {
+            'meta': {
+                'version': FORMAT_VERSION,
+                'sequence': sequence,
+                'time': time.time(),
+                'conv': DQN.conv,
+                'num_inputs': DQN.num_inputs,
+                'num_actions': DQN.num_actions,
+                'push_count': DQN.push_count,
+                'train_count': DQN.train_count,
+                'q_preds': DQN.q_preds,
+                'memory_position': memory.position,
+                'memory_size': len(memory),
+            },
+            'weights': DQN.model.get_weights(),
+            'train_loss': np.array(DQN.train_loss, dtype=np.float32),
+            'memory': {},
+        }
+        if isinstance(memory, MemmapReplayMemory):
+            memory.flush()
+            snapshot['meta']['memory_directory'] = memory.directory
+            snapshot['meta']['memory_generation'] = memory.generation
+            snapshot['meta']['memory_flushes'] = memory.flushes
+        else:
+            snapshot['memory'] = {name: array.copy() for name, array in memory.arrays().items()}
+        name = f'ckpt-{sequence:06d}-{DQN.push_count:012d}'
+        self.thread = threading.Thread(target=self.write, args=(name, snapshot))
+        self.thread.start()
+        if block:
+            self.wait()
+
+    def wait(self):
+        # Block until the last checkpoint has been written
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def write(self, name, snapshot):
+        path = os.path.join(self.directory, name)
+        temp_path = os.path.join(self.directory, '.' + name + '.tmp')
+        try:
+            shutil.rmtree(temp_path, ignore_errors=True)
+            os.makedirs(os.path.join(temp_path, 'memory'))
+            np.savez(os.path.join(temp_path, 'weights.npz'), *snapshot['weights'])
+            np.save(os.path.join(temp_path, 'train_loss.npy'), snapshot['train_loss'])
+            for field, array in snapshot['memory'].items():
+                np.save(os.path.join(temp_path, 'memory', field + '.npy'), array)
+            # meta.json is written last so a checkpoint with one is complete
+            with open(os.path.join(temp_path, 'meta.json'), 'w') as file:
+                json.dump(snapshot['meta'], file)
+            shutil.rmtree(path, ignore_errors=True)
+            os.rename(temp_path, path)
+            self.prune()
+        except OSError as error:
+            print(f'Failed to write checkpoint {path}: {error}')
+
+    def checkpoints(self):
+        # Complete checkpoint directories, oldest first
+        return [path for _, path in self.ordered()]
+
+    def ordered(self):
+        # (sequence, save time) and path of every complete checkpoint, oldest first
+        if not os.path.isdir(self.directory):
+            return []
+        checkpoints = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not name.startswith('ckpt-') or not os.path.exists(os.path.join(path, 'meta.json')):
+                continue
+            with open(os.path.join(path, 'meta.json')) as file:
+                meta = json.load(file)
+            checkpoints.append(((meta.get('sequence', 0), meta.get('time', 0)), path))
+        return sorted(checkpoints)
+
+    def next_sequence(self):
+        checkpoints = self.ordered()
+        return checkpoints[-1][0][0] + 1 if checkpoints else 1
+
+    def latest(self):
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def prune(self):
+        for path in self.checkpoints()[:-self.keep]:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def load_weights(path):
+    # List of weight arrays in the order expected by model.set_weights
+    with np.load(os.path.join(path, 'weights.npz')) as data:
+        return [data[f'arr_{i}'] for i in range(len(data.files))]
+
+
+def load_checkpoint(path):
+    # Returns meta, weights, train_loss and the replay memory fields (memory-mapped, copy on write)
+    with open(os.path.join(path, 'meta.json')) as file:
+        meta = json.load(file)
+    if meta['version'] > FORMAT_VERSION:
+        raise ValueError(f'Checkpoint {path} has format version {meta["version"]}, newer than {FORMAT_VERSION}')
+    memory = {}
+    memory_path = os.path.join(path, 'memory')
+    for filename in os.listdir(memory_path):
+        memory[filename[:-len('.npy')]] = np.load(os.path.join(memory_path, filename), mmap_mode='c')
+    train_loss = np.load(os.path.join(path, 'train_loss.npy'))
+    return meta, load_weights(path), train_loss, memory
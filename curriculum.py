@@ -0,0 +1,93 @@
+import time
+from collections import defaultdict
+from snake import parse_board_size
+'''
+Board size curriculum
+
+Training starts on small boards, where apples are found quickly, and moves to larger ones in the
+same session. A stage is written WxH:steps, the board size in blocks and the number of environment
+steps to play on it, and the last stage can leave out the steps to run until training stops:
+
+    python main.py 1 1 1 --curriculum 10x10:100000 20x12:200000 30x17
+
+A stage only ends between games, so no game changes board part way. The network sees the same
+state on every board (9 values, or the view around the head) so one network plays all of them.
+
+Every stage reports its environment steps per second, training included, and the summary at the
+end gives the rate of every board size so the cost of larger boards can be compared. For the
+cost of the game alone per board size see python benchmark.py boards.
+'''
+
+
+def parse_stage(text):
+    # '20x12:200000' to ((20, 12), 200000), '30x17' to ((30, 17), None)
+    size, _, steps = text.partition(':')
+    return parse_board_size(size), int(steps) if steps else None
+
+
+class Curriculum:
+    def __init__(self, stages):
+        # stages: 'WxH:steps' strings or ((width, height), steps) pairs, steps None to run on
+        self.stages = [parse_stage(stage) if isinstance(stage, str) else (tuple(stage[0]), stage[1])
+                       for stage in stages]
+        if not self.stages:
+            raise ValueError('A curriculum needs at least one stage')
+        self.stage = 0
+        self.stage_steps = 0
+        # Steps played and seconds spent on each board size, over all its stages
+        self.steps = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.stage_start = None     # Set by the first step so start up is not counted
+        print(f'Curriculum stage 1 of {len(self.stages)}: {self.describe(0)}')
+
+    @property
+    def board_size(self):
+        return self.stages[self.stage][0]
+
+    def describe(self, stage):
+        (width, height), steps = self.stages[stage]
+        return f'board {width}x{height}, ' + (f'{steps} steps' if steps is not None else 'until stopped')
+
+    def count(self, n=1):
+        # Environment steps played on the current board
+        if self.stage_start is None:
+            self.stage_start = time.perf_counter()
+        self.stage_steps += n
+        self.steps[self.board_size] += n
+
+    def advance(self):
+        # Call between games, moves to the next stage once this one has played its steps
+        # Returns True if the board size changed
+        steps = self.stages[self.stage][1]
+        if steps is None or self.stage_steps < steps or self.stage + 1 == len(self.stages):
+            return False
+        previous = self.board_size
+        self.end_stage()
+        self.stage += 1
+        self.stage_steps = 0
+        print(f'Curriculum stage {self.stage + 1} of {len(self.stages)}: {self.describe(self.stage)}')
+        return self.board_size != previous
+
+    def end_stage(self):
+        now = time.perf_counter()
+        elapsed = now - self.stage_start
+        self.seconds[self.board_size] += elapsed
+        self.stage_start = now
+        width, height = self.board_size
+        print(f'Board {width}x{height}: {self.stage_steps} steps in {elapsed:.0f} s '
+              f'({self.stage_steps/elapsed:.0f} steps/s)')
+
+    def rates(self):
+        # Steps, seconds and steps/s of every board size played, in the order first played
+        seconds = dict(self.seconds)
+        if self.stage_start is not None:
+            seconds[self.board_size] = seconds.get(self.board_size, 0.0) + time.perf_counter() - self.stage_start
+        return [{'board': f'{width}x{height}', 'blocks': width*height, 'steps': self.steps[(width, height)],
+                 'seconds': seconds[(width, height)],
+                 'steps_per_second': self.steps[(width, height)]/seconds[(width, height)]}
+                for width, height in self.steps if seconds.get((width, height))]
+
+    def report(self):
+        for rate in self.rates():
+            print(f'Board {rate["board"]:>7} ({rate["blocks"]:>4} blocks): {rate["steps"]} steps in '
+                  f'{rate["seconds"]:.0f} s, {rate["steps_per_second"]:.0f} steps/s')
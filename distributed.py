@@ -0,0 +1,246 @@
+import multiprocessing as mp
+import queue
+import random
+import time
+'''
+Headless actor/learner training
+
+Several actor processes each play Snake with their own copy of the DQN weights and stream the
+experiences that pass their ReplayGate to a single learner process (the one calling
+train_distributed), which owns the DeepQNetwork and replay memory and does all the training.
+Every sync_every train steps the learner sends the latest weights, push count (for epsilon) and
+memory reward percentages to the actors. The board size of new games is sent along with them, so a
+curriculum (see curriculum.py) run by the learner moves every actor to the next board at its next game.
+
+Usage:  python main.py 1 1 0 --actors 4 --sync-every 100
+'''
+
+win_width = 1000
+win_height = 600
+
+
+def dims(use_conv, view_radius=5):
+    # Input dimensions and number of actions of the DQN
+    return (2*view_radius + 1, 4) if use_conv else (9, 3)
+
+
+def reward_percentages(memory):
+    return memory.reward_percent(1), memory.reward_percent(-1)
+
+
+def actor(actor_id, use_conv, run_seed, experience_queue, weights_queue, send_every, capacity, prioritized, fast=False,
+          board_size=None, view_radius=5):
+    # Runs in its own process, plays games with the latest weights received from the learner
+    # Every send_every steps the experiences to push, the number of steps taken and the scores of
+    # finished games are sent to the learner as one message
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(1)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    if fast:
+        from fast_snake import game_class
+        Snake = game_class(fast, use_conv)
+    else:
+        from snake import Snake
+    from DQN import DeepQNetwork
+    from replay import ReplayGate, PassThroughGate
+    from seeding import derive_seed, GameSeeds
+
+    input_dims, num_actions = dims(use_conv, view_radius)
+    # The actor's memory is never used, capacity is only needed for the mix of games below
+    DQN = DeepQNetwork(input_dims, num_actions, True, capacity=capacity,
+                       seed=derive_seed(run_seed, 'actor', actor_id), conv=use_conv)
+    game_seeds = GameSeeds(run_seed, 'actor', actor_id)
+    snake = Snake(1, win_width, win_height, use_conv, rng=random.Random(game_seeds.next()), board_size=board_size,
+                  view_radius=view_radius)
+    # With prioritized replay the learner's memory handles sparse rewards so every experience is sent
+    gate = PassThroughGate() if prioritized else ReplayGate(rng=DQN.rng)
+    percent_apple = 0
+    percent_lose = 0
+    exploit = False
+    explore = False
+    experiences = []
+    scores = []
+    steps = 0
+
+    while True:
+        if steps % send_every == 0:
+            if steps:
+                experience_queue.put((actor_id, send_every, experiences, scores))
+                experiences = []
+                scores = []
+            # Pick up new weights if the learner has sent any
+            try:
+                message = weights_queue.get_nowait()
+            except queue.Empty:
+                message = False
+            if message is None:
+                break
+            elif message:
+                weights, DQN.push_count, percent_apple, percent_lose, board_size = message
+                DQN.model.set_weights(weights)
+
+        action = DQN.get_action(snake.state, exploit, explore)
+        snake.move(action)
+        snake.update_board()
+        if use_conv:
+            snake.update_state_conv()
+        else:
+            snake.update_state()
+        steps += 1
+
+        if snake.move_counter < 1000:
+            experiences += gate.filter(snake.get_experience(), percent_apple, percent_lose)
+
+        if not snake.alive:
+            scores.append(snake.score)
+            snake = Snake(1, win_width, win_height, use_conv, rng=random.Random(game_seeds.next()),
+                          board_size=board_size, view_radius=view_radius)
+            # Same mix of exploit/explore games as main
+            exploit, explore = DQN.game_mode(exploit, explore)
+
+
+def publish(DQN, weights_queues, board_size=None):
+    # Replace whatever each actor has not picked up yet with the latest weights
+    # The train lock keeps a learner thread from changing them part way through
+    with DQN.train_lock:
+        weights = DQN.model.get_weights()
+    message = (weights, DQN.push_count) + reward_percentages(DQN.memory) + (board_size,)
+    for weights_queue in weights_queues:
+        try:
+            weights_queue.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            weights_queue.put_nowait(message)
+        except queue.Full:
+            pass    # The actor is mid-way through taking a message
+
+
+def next_message(experience_queue, actors, timeout=1):
+    # Waits for the next message of any actor. Actors only stop when told to, so raises once one
+    # has exited (its traceback is printed by the actor) instead of waiting forever
+    while True:
+        try:
+            return experience_queue.get(timeout=timeout)
+        except queue.Empty:
+            for i, process in enumerate(actors):
+                if process.exitcode is not None:
+                    raise RuntimeError(f'Actor {i} exited with code {process.exitcode}')
+
+
+def train_distributed(num_actors, sync_every, reset_weights, use_conv=False, send_every=100,
+                      max_steps=None, report_every=10, save_every=500_000, seed=None, capacity=100_000,
+                      replay_dir=None, prioritized=False, fast=False, metrics_path=None, metrics_port=None,
+                      board_size=None, view_radius=5, curriculum=None, compact_replay=None, replay_ratio=None,
+                      polyak=None):
+    # Learner loop, runs until max_steps environment steps (forever if None) or Ctrl-C
+    # curriculum: list of 'WxH:steps' stages, overrides board_size. Steps are counted as they reach
+    # the learner so a few games in flight at a stage change are counted to the wrong board
+    # replay_ratio: train on a thread of the learner process so taking experiences off the queue
+    # never waits for a train step (see DeepQNetwork.start_learner)
+    from DQN import DeepQNetwork
+    from seeding import new_run_seed, derive_seed
+    from metrics import Metrics
+    from curriculum import Curriculum
+
+    if curriculum:
+        curriculum = Curriculum(curriculum)
+        board_size = curriculum.board_size
+
+    if seed is None:
+        seed = new_run_seed()
+    print(f'Run seed: {seed}')
+    input_dims, num_actions = dims(use_conv, view_radius)
+    # The learner's metrics time push, sample and train, actors only report steps and scores
+    metrics = Metrics(metrics_path, metrics_port)
+    DQN = DeepQNetwork(input_dims, num_actions, reset_weights, capacity=capacity, replay_dir=replay_dir,
+                       prioritized=prioritized, seed=derive_seed(seed, 'learner'), metrics=metrics, conv=use_conv,
+                       compact_replay=compact_replay, polyak=polyak)
+    if replay_ratio:
+        DQN.start_learner(replay_ratio)
+
+    # TensorFlow is not fork safe so actors are started fresh
+    context = mp.get_context('spawn')
+    experience_queue = context.Queue(maxsize=4*num_actors)
+    weights_queues = [context.Queue(maxsize=1) for _ in range(num_actors)]
+    actors = [context.Process(target=actor, args=(i, use_conv, seed, experience_queue, weights_queues[i], send_every,
+                                                  capacity, prioritized, fast, board_size, view_radius),
+                              daemon=True)
+              for i in range(num_actors)]
+    for process in actors:
+        process.start()
+    publish(DQN, weights_queues, board_size)
+
+    env_steps = 0
+    last_sync = DQN.train_count
+    last_save = 0
+    report_steps = 0
+    report_trains = DQN.train_count
+    report_time = time.time()
+    scores = []
+    try:
+        while max_steps is None or env_steps < max_steps:
+            metrics.tick()
+            actor_id, steps, experiences, actor_scores = next_message(experience_queue, actors)
+            env_steps += steps
+            scores += actor_scores
+            metrics.count('env_steps', steps)
+            metrics.count('episodes', len(actor_scores))
+            for score in actor_scores:
+                metrics.observe('score', score)
+            if curriculum:
+                curriculum.count(steps)
+            for experience in experiences:
+                DQN.push_to_memory(experience)
+                DQN.train()
+
+            board_changed = curriculum and curriculum.advance()
+            if board_changed:
+                board_size = curriculum.board_size
+            if board_changed or DQN.train_count - last_sync >= sync_every:
+                publish(DQN, weights_queues, board_size)
+                last_sync = DQN.train_count
+                metrics.gauge('memory_size', len(DQN.memory))
+                metrics.gauge('push_count', DQN.push_count)
+
+            if time.time() - report_time > report_every:
+                elapsed = time.time() - report_time
+                env_rate = (env_steps - report_steps)/elapsed
+                train_rate = (DQN.train_count - report_trains)/elapsed
+                average = sum(scores)/len(scores) if scores else 0
+                print(f'Env steps/s: {env_rate:.0f}, Train steps/s: {train_rate:.1f}, Games: {len(scores)}, '
+                      f'Average score: {average:.1f}, Push Count: {DQN.push_count}')
+                report_steps = env_steps
+                report_trains = DQN.train_count
+                report_time = time.time()
+                scores = []
+
+            if env_steps - last_save >= save_every:
+                DQN.save_data()
+                last_save = env_steps
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for weights_queue in weights_queues:
+            try:
+                weights_queue.get_nowait()
+            except queue.Empty:
+                pass
+            weights_queue.put(None)
+        # Keep draining so no actor blocks on a full queue while shutting down
+        deadline = time.time() + 10
+        while any(process.is_alive() for process in actors) and time.time() < deadline:
+            try:
+                experience_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for process in actors:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+        DQN.stop_learner()
+        DQN.save_data(block=True)
+        if curriculum:
+            curriculum.report()
+        metrics.close()
+    return DQN
@@ -0,0 +1,174 @@
+import argparse
+import csv
+import json
+import multiprocessing as mp
+import os
+import pickle
+import random
+import time
+import numpy as np
+from snake import Snake, parse_board_size
+import checkpoint
+from trajectory import TrajectoryWriter
+from policy import NumpyPolicy, read_export
+'''
+Headless evaluation of a trained DQN, without pygame
+
+Plays games greedily (no random actions), game i starting from seed + i so results are repeatable,
+and reports score and episode length statistics. --record saves every game to a trajectory file
+to replay or render later (see trajectory.py)
+
+The checkpoint is a checkpoint directory, a directory of checkpoints (the latest is used) or a
+pickle saved by older versions. It defaults to the latest checkpoint in checkpoints/mlp or checkpoints/conv
+(checkpoints/conv_<2R+1> for another view radius R). --board plays on another board size than the
+window's 30x17 blocks, any size works for the same network
+
+--numpy plays with the NumPy forward pass of policy.py and never imports TensorFlow. The checkpoint can
+then also be a .npz written by python policy.py export
+
+Usage:  python evaluate.py [--checkpoint checkpoints/mlp] [--games 100] [--seed 0] [--processes 1]
+                           [--conv] [--fast] [--output results.json|results.csv]
+                           [--record games.snk] [--board WxH] [--view-radius 5] [--numpy]
+'''
+
+win_width = 1000
+win_height = 600
+
+
+def load_weights(path):
+    if path.endswith('.npz'):
+        return read_export(path)
+    if not os.path.isdir(path):
+        # Weights are the first item pickled by older versions of DeepQNetwork.save_data
+        with open(path, 'rb') as file:
+            saved = pickle.load(file)
+        return saved[0]
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        latest = checkpoint.CheckpointManager(path).latest()
+        if latest is None:
+            raise FileNotFoundError(f'No checkpoints in {path}')
+        path = latest
+    return checkpoint.load_weights(path)
+
+
+def play_games(weights, seeds, use_conv, fast=False, actions=False, board_size=None, view_radius=5,
+               numpy_inference=False):
+    # Play one greedy game per seed, returns the score and length of each, and the actions if actions
+    # All games are played in lockstep so each move needs only one call to the network for every
+    # game still alive. Each game has its own random number generator so its result only depends on its seed
+    # numpy_inference plays with a NumpyPolicy, without TensorFlow
+    if numpy_inference:
+        policy = NumpyPolicy(weights)
+        choose = policy.acts
+    else:
+        from DQN import DeepQNetwork
+        input_dims, num_actions = (2*view_radius + 1, 4) if use_conv else (9, 3)
+        DQN = DeepQNetwork(input_dims, num_actions, True, conv=use_conv)
+        DQN.model.set_weights(weights)
+        choose = lambda states: DQN.get_actions(states, True, False)
+    Game = Snake
+    if fast:
+        from fast_snake import game_class
+        Game = game_class(fast, use_conv)
+    snakes = [Game(1, win_width, win_height, use_conv, rng=random.Random(seed), board_size=board_size,
+                   view_radius=view_radius) for seed in seeds]
+    played = [[] for _ in snakes]
+    playing = list(range(len(snakes)))
+    while playing:
+        chosen = choose([snakes[i].state for i in playing])
+        for i, action in zip(playing, chosen):
+            snake = snakes[i]
+            snake.move(action)
+            snake.update_board()
+            if use_conv:
+                snake.update_state_conv()
+            else:
+                snake.update_state()
+            played[i].append(action)
+        playing = [i for i in playing if snakes[i].alive]
+    results = []
+    for seed, snake, game_actions in zip(seeds, snakes, played):
+        result = {'seed': seed, 'score': snake.score, 'length': len(game_actions)}
+        if actions:
+            result['actions'] = game_actions
+        results.append(result)
+    return results
+
+
+def summarise(results, elapsed):
+    scores = np.array([result['score'] for result in results])
+    lengths = np.array([result['length'] for result in results])
+    summary = {
+        'games': len(results),
+        'mean_score': float(scores.mean()),
+        'median_score': float(np.median(scores)),
+        'min_score': int(scores.min()),
+        'max_score': int(scores.max()),
+        'mean_length': float(lengths.mean()),
+        'median_length': float(np.median(lengths)),
+        'games_per_sec': len(results)/elapsed,
+        'moves_per_sec': float(lengths.sum())/elapsed,
+    }
+    for percentile in (10, 25, 75, 90, 99):
+        summary[f'p{percentile}_score'] = float(np.percentile(scores, percentile))
+    return summary
+
+
+def write_results(path, summary, results):
+    # JSON holds the summary and every game, CSV one row per game
+    if path.endswith('.csv'):
+        with open(path, 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=['seed', 'score', 'length'])
+            writer.writeheader()
+            writer.writerows(results)
+    else:
+        with open(path, 'w') as file:
+            json.dump({'summary': summary, 'games': results}, file, indent=2)
+
+
+def evaluate(path, games, seed=0, processes=1, use_conv=False, fast=False, record=None, board_size=None,
+             view_radius=5, numpy_inference=False):
+    weights = load_weights(path)
+    seeds = list(range(seed, seed + games))
+    start = time.time()
+    if processes > 1:
+        # TensorFlow is not fork safe so workers are started fresh
+        chunks = [seeds[i::processes] for i in range(processes)]
+        with mp.get_context('spawn').Pool(processes) as pool:
+            chunk_results = pool.starmap(play_games, [(weights, chunk, use_conv, fast, bool(record), board_size,
+                                                       view_radius, numpy_inference) for chunk in chunks])
+        results = sorted((r for chunk in chunk_results for r in chunk), key=lambda r: r['seed'])
+    else:
+        results = play_games(weights, seeds, use_conv, fast, bool(record), board_size, view_radius, numpy_inference)
+    summary = summarise(results, time.time() - start)
+    if record:
+        recorder = TrajectoryWriter(record, use_conv, win_width, win_height, view_radius)
+        for result in results:
+            recorder.write(result['seed'], result['score'], result.pop('actions'), board_size)
+        recorder.close()
+    return summary, results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Headless evaluation of a trained snake DQN')
+    parser.add_argument('--checkpoint', help='defaults to checkpoints/mlp, or checkpoints/conv with --conv')
+    parser.add_argument('--games', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first game, game i uses seed + i')
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--conv', action='store_true')
+    parser.add_argument('--fast', action='store_true', help='play FastSnake, same games as Snake')
+    parser.add_argument('--record', help='record every game to this trajectory file')
+    parser.add_argument('--output', help='write results to this .json or .csv file')
+    parser.add_argument('--board', type=parse_board_size, help='board size in blocks as WxH, default fits the window')
+    parser.add_argument('--view-radius', type=int, default=5, help='view radius of the conv network')
+    parser.add_argument('--numpy', action='store_true', help='play with NumPy instead of TensorFlow')
+    args = parser.parse_args()
+
+    from DQN import checkpoint_name
+    path = args.checkpoint or os.path.join('checkpoints', checkpoint_name(args.conv, 2*args.view_radius + 1))
+    summary, results = evaluate(path, args.games, args.seed, args.processes, args.conv, args.fast, args.record,
+                                args.board, args.view_radius, args.numpy)
+    for key, value in summary.items():
+        print(f'{key}: {round(value, 2)}')
+    if args.output:
+        write_results(args.output, summary, results)
@@ -0,0 +1,357 @@
+import math
+import random
+import numpy as np
+from snake import Snake, layout
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+'''
+Fast drop-in replacement for snake.Snake
+
+FastSnake plays by the same rules, gives the same rewards and states and draws random numbers in
+the same order as Snake, so both give identical games from the same seed (see parity.py).
+
+The whole game lives in one flat integer array: a header of scalars (head, direction, apple, sizes
+and the offsets of everything else) followed by the padded board, the body as a ring buffer of
+x, y pairs and the free block list with the index of each block in it. A move is one call to
+the advance kernel, plus a call to place_apple when the apple is eaten since the new apple is
+drawn with python's random (or the game's rng). Rays are walked along the flat board with a fixed stride.
+
+The kernels are compiled with numba when it is installed. Without numba the same kernels run as
+plain python, on a list for the MLP game since lists are much faster to index from python than
+numpy arrays.
+
+move() also computes the new state, update_board, update_state and update_state_conv do nothing
+so FastSnake can be used wherever Snake is.
+
+Without numba the python kernels are still about 3x faster than Snake for the MLP game, but the
+conv game runs at about 0.4x Snake, which paints its board incrementally, so game_class, used by
+--fast, plays Snake instead.
+'''
+
+# Header of the game array
+(X, Y, DIRECTION, TAIL, LENGTH, NUM_FREE, APPLE_X, APPLE_Y, APPLE_DISTANCE, WIDTH, HEIGHT, BORDER, RADIUS,
+ CONV, CAPACITY, BOARD, BODY, FREE_BLOCKS, FREE_INDEX) = range(19)
+HEADER = 19
+# Ray directions in global order [N, NE, E, SE, S, SW, W, NW]
+RAY_X = (0, 1, 1, 1, 0, -1, -1, -1)
+RAY_Y = (-1, -1, 0, 1, 1, 1, 0, -1)
+
+
+def make_kernels(jit):
+    # Returns the observe, advance and place_apple kernels, compiled by jit
+
+    @jit
+    def observe(data, state):
+        # Write the state of Snake.update_state (9 values) or Snake.update_state_conv (the window
+        # around the head) into state, nothing if state is empty
+        h = data[HEIGHT]
+        b = data[BORDER]
+        hp = h + 2*b
+        x = data[X]
+        y = data[Y]
+        board = data[BOARD]
+        if len(state) == 9:
+            direction = data[DIRECTION]
+            centre = board + (x + b)*hp + y + b
+            for k in range(8):
+                stride = RAY_X[k]*hp + RAY_Y[k]
+                i = centre + stride
+                distance = 1
+                while data[i] == 0:
+                    i += stride
+                    distance += 1
+                if distance > 20:
+                    distance = 20
+                # Global [N, NE, E, SE, S, SW, W, NW] to local [F, FR, R, BR, B, BL, L, FL] without B
+                j = (k - 2*direction) % 8
+                if j != 4:
+                    state[j if j < 4 else j - 1] = data[i]*(1 - distance/20)
+
+            # Angle to apple, +ve clockwise from ahead and continuous between -1 and 1
+            dx = data[APPLE_X] - x
+            dy = y - data[APPLE_Y]
+            glob_angle = 2*math.atan2(dx, dy)/math.pi
+            locl_angle = glob_angle - direction
+            if locl_angle < -2:
+                locl_angle += 4
+            state[7] = locl_angle/2
+            state[8] = data[LENGTH]/100
+        elif len(state) > 0:
+            r = data[RADIUS]
+            size = 2*r + 1
+            for i in range(size):
+                row = board + (x + b - r + i)*hp + y + b - r
+                for j in range(size):
+                    state.flat[i*size + j] = data[row + j]
+
+    @jit
+    def advance(data, action, state):
+        # Turn, move, remove the tail, check for collisions and observe, as Snake.move
+        # Returns the reward, whether the apple was eaten and whether the snake died
+        w = data[WIDTH]
+        h = data[HEIGHT]
+        b = data[BORDER]
+        hp = h + 2*b
+        board = data[BOARD]
+        body = data[BODY]
+        free_blocks = data[FREE_BLOCKS]
+        free_index = data[FREE_INDEX]
+        cap = data[CAPACITY]
+        if data[CONV]:
+            direction = action
+        else:
+            direction = data[DIRECTION] + action - 1
+            if direction == -1:
+                direction = 3
+            elif direction == 4:
+                direction = 0
+        data[DIRECTION] = direction
+        x = data[X]
+        y = data[Y]
+        if direction == 0:
+            y -= 1
+        elif direction == 1:
+            x += 1
+        elif direction == 2:
+            y += 1
+        else:
+            x -= 1
+        ax = data[APPLE_X]
+        ay = data[APPLE_Y]
+
+        ate = x == ax and y == ay
+        reward = 1.0
+        if not ate:
+            # Remove the tail
+            t = data[TAIL]
+            tx = data[body + 2*t]
+            ty = data[body + 2*t + 1]
+            data[TAIL] = (t + 1) % cap
+            data[LENGTH] -= 1
+            n = tx*h + ty
+            data[free_index + n] = data[NUM_FREE]
+            data[free_blocks + data[NUM_FREE]] = n
+            data[NUM_FREE] += 1
+            data[board + (tx + b)*hp + ty + b] = 1 if tx == ax and ty == ay else 0
+            if data[CONV]:
+                # Apple in view
+                reward = 0.05 if max(abs(x - ax), abs(y - ay)) <= data[RADIUS] else 0.0
+            else:
+                # Closer to the apple
+                distance = abs(x - ax) + abs(y - ay)
+                reward = 0.05 if distance < data[APPLE_DISTANCE] else 0.0
+                data[APPLE_DISTANCE] = distance
+
+        # Collisions with wall then body
+        dead = not (0 <= x < w and 0 <= y < h)
+        if not dead:
+            n = x*h + y
+            i = data[free_index + n]
+            dead = i == -1
+            if not dead:
+                # Swap the last free block into this one's place
+                data[NUM_FREE] -= 1
+                last = data[free_blocks + data[NUM_FREE]]
+                data[free_blocks + i] = last
+                data[free_index + last] = i
+                data[free_index + n] = -1
+        if dead:
+            reward = -1.0
+
+        # Add the new head and paint it, the apple stays on top
+        head = (data[TAIL] + data[LENGTH]) % cap
+        data[body + 2*head] = x
+        data[body + 2*head + 1] = y
+        data[LENGTH] += 1
+        data[X] = x
+        data[Y] = y
+        if not dead:
+            data[board + (x + b)*hp + y + b] = 1 if ate else -1
+        observe(data, state)
+        return reward, ate, dead
+
+    @jit
+    def place_apple(data, n, state):
+        # Move the apple to block n and observe again
+        h = data[HEIGHT]
+        b = data[BORDER]
+        data[APPLE_X] = n // h
+        data[APPLE_Y] = n % h
+        data[data[BOARD] + (n//h + b)*(h + 2*b) + n % h + b] = 1
+        # The old apple is under the head
+        data[data[BOARD] + (data[X] + b)*(h + 2*b) + data[Y] + b] = -1
+        observe(data, state)
+
+    return observe, advance, place_apple
+
+
+python_kernels = make_kernels(lambda function: function)
+numba_kernels = make_kernels(njit) if njit is not None else None
+
+
+def game_class(fast, conv):
+    # The game class to play with --fast, FastSnake unless it would be slower than Snake
+    if not fast:
+        return Snake
+    if njit is None and conv:
+        print('numba is not installed, --fast plays Snake for the conv game since FastSnake is slower without it')
+        return Snake
+    return FastSnake
+
+
+class FastSnake:
+    def __init__(self, gamemode, win_width, win_height, conv, use_numba=None, rng=None, board_size=None,
+                 view_radius=5):
+        # use_numba: None uses numba if it is installed
+        # rng: random.Random the game draws its start and apples from, the random module if None
+        self.rng = random if rng is None else rng
+        if use_numba is None:
+            use_numba = njit is not None
+        elif use_numba and njit is None:
+            raise ImportError('numba is not installed')
+        self.use_numba = use_numba
+        # board_size and view_radius as Snake
+        layout(self, win_width, win_height, board_size)
+        self.gamemode = gamemode
+        self.conv = conv
+        self.view_radius = view_radius
+        self.board_border = view_radius + 2   # CNN view radius plus 2
+        w = self.game_width_blocks
+        h = self.game_height_blocks
+        b = self.board_border
+        hp = h + 2*b
+
+        # Same random draws as Snake.__init__
+        x = self.rng.randint(2, w-1)
+        y = self.rng.randint(0, h-1)
+        apple = [self.rng.randint(0, w-1), self.rng.randint(0, h-1)]
+
+        board = [-1]*((w + 2*b)*hp)
+        for i in range(w):
+            board[(i + b)*hp + b:(i + b)*hp + b + h] = [0]*h
+        capacity = w*h + 2
+        body = [0]*(2*capacity)
+        body[:6] = [x-2, y, x-1, y, x, y]
+        free_blocks = list(range(w*h))
+        free_index = list(range(w*h))
+        num_free = w*h
+        for i in (x-2, x-1, x):
+            n = i*h + y
+            j = free_index[n]
+            num_free -= 1
+            last = free_blocks[num_free]
+            free_blocks[j] = last
+            free_index[last] = j
+            free_index[n] = -1
+            board[(i + b)*hp + y + b] = -1
+        board[(apple[0] + b)*hp + apple[1] + b] = 1
+
+        header = [0]*HEADER
+        header[X:APPLE_DISTANCE+1] = [x, y, 1, 0, 3, num_free, apple[0], apple[1], abs(x - apple[0]) + abs(y - apple[1])]
+        header[WIDTH:CAPACITY+1] = [w, h, b, self.view_radius, int(conv), capacity]
+        header[BOARD] = HEADER
+        header[BODY] = header[BOARD] + len(board)
+        header[FREE_BLOCKS] = header[BODY] + len(body)
+        header[FREE_INDEX] = header[FREE_BLOCKS] + len(free_blocks)
+        data = header + board + body + free_blocks + free_index
+
+        # The conv game without numba keeps a numpy array so the view is copied with one slice
+        if use_numba or conv:
+            data = np.array(data, dtype=np.int64)
+            self.board_view = data[HEADER:HEADER + len(board)].reshape(w + 2*b, hp)
+        self.data = data
+        observe, self.advance, self.place_apple = numba_kernels if use_numba else python_kernels
+        self.score = 0
+        self.alive = True
+        self.reward = 0
+        self.move_counter = 0
+        state = self.new_state()
+        observe(data, state)
+        self.set_state(state)
+        self.previous_state = self.state
+
+    def new_state(self):
+        # Buffer the kernels write the state into
+        if not self.conv:
+            return np.empty(9) if self.use_numba else [0.0]*9
+        size = 2*self.view_radius + 1
+        return np.empty((size, size)) if self.use_numba else []
+
+    def set_state(self, state):
+        # Without numba conv states are copied from the board with one slice
+        if self.conv and not self.use_numba:
+            r = self.view_radius
+            x = int(self.data[X]) + self.board_border
+            y = int(self.data[Y]) + self.board_border
+            state = self.board_view[x-r:x+r+1, y-r:y+r+1].astype(np.float64)
+        self.state = state
+
+    def move(self, action):
+        # Store action for experience replay
+        self.action = action
+        data = self.data
+        if not self.alive:
+            # Snake only keeps turning once dead
+            if self.conv:
+                data[DIRECTION] = action
+            else:
+                data[DIRECTION] = (data[DIRECTION] + action - 1) % 4
+            return
+        state = self.new_state()
+        reward, ate, dead = self.advance(data, action, state)
+        self.reward = reward
+        if dead:
+            self.alive = False
+        if ate:
+            self.move_counter = 0
+            self.score += 1
+            # New apple from the blocks not covered by the body
+            if data[NUM_FREE] == 0:
+                self.alive = False  # The snake fills the board
+            else:
+                n = data[data[FREE_BLOCKS] + self.rng.randrange(data[NUM_FREE])]
+                self.place_apple(data, n, state)
+        self.move_counter += 1
+        if self.move_counter > 1000:
+            self.alive = False
+        self.set_state(state)
+
+    # move() keeps the board and state up to date
+    def update_board(self):
+        pass
+
+    def update_state(self):
+        pass
+
+    def update_state_conv(self):
+        pass
+
+    def get_experience(self):
+        experience = [self.previous_state, self.action, self.state, self.reward, self.alive]
+        self.previous_state = self.state
+        return experience
+
+    # Same attributes as Snake for the renderer and anything else reading the game
+    @property
+    def pos(self):
+        return [int(self.data[X]), int(self.data[Y])]
+
+    @property
+    def apple(self):
+        return [int(self.data[APPLE_X]), int(self.data[APPLE_Y])]
+
+    @property
+    def direction(self):
+        return int(self.data[DIRECTION])
+
+    @property
+    def body(self):
+        # Tail first, head last
+        data = self.data
+        blocks = []
+        for k in range(int(data[LENGTH])):
+            i = data[BODY] + 2*((data[TAIL] + k) % data[CAPACITY])
+            blocks.append([int(data[i]), int(data[i + 1])])
+        return blocks
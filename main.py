@@ -1,17 +1,26 @@
-from snake import Snake
+from snake import Snake, parse_board_size
+from vector_snake import VectorSnake
 from DQN import DeepQNetwork
-import pygame
+from replay import ReplayGate, PassThroughGate
+from seeding import new_run_seed, derive_seed, GameSeeds
+from trajectory import TrajectoryWriter
+from metrics import Metrics, Profiler
+from curriculum import Curriculum
+from parallel_training import ParallelTrainer
 import random
 import pickle
 import time
-import sys
+import argparse
+import signal
 '''
 This is the main game loop to run, play and train snake snake
 By default it will load DQN with saved weights and test
 
 Keyboard inputs - Use 'Q' to quit running
                 - Use 'T' to toggle training on and off
-                - Use 'D' to toggle display on and off (faster training when off)
+                - Use 'D' to toggle display on and off
+                The window is drawn by a separate process (see render.py), while training the game runs at
+                full speed and the window shows the latest frame, otherwise the game runs at the frame rate
                 - Use arrow keys as input if playing yourself
 
 Arguments 
@@ -26,18 +35,51 @@ train:          Boolean
 
 reset_weights:  Boolean
                 True = reinitialise DQN and replay memory
-                False = Load from saved file 'Saved_Data/Snake_Memory'
+                False = Load the latest checkpoint in 'checkpoints/mlp' (or 'checkpoints/conv')
 
 use_pygame:     Boolean
                 True = Use Pygame (needed to see output and end game safely)
-                False = Don't use Pygame (Used for training in google colab)
+                False = Don't use Pygame (Used for training in google colab), --headless
+                Without a window Ctrl-C ends the run, saving as Q does
 
 use_conv:       Boolean
                 True = Use a Convolutional Neural Network for DQN (not yet functioning)
                 False = Use regular MLP for DQN
+
+Command line:   python main.py [gamemode train reset_weights] [--conv] [--actors N] [--sync-every N]
+                               [--parallel-games N] [--capacity N] [--replay-dir DIR] [--prioritized]
+                               [--fast] [--seed N] [--record FILE] [--metrics FILE] [--metrics-port PORT]
+                               [--profile N] [--board WxH] [--view-radius R] [--curriculum WxH:steps ...]
+                               [--compact-replay [N]] [--replay-ratio N] [--polyak TAU] [--numpy]
+                --actors N trains headless with N actor processes feeding one learner (see distributed.py)
+                --parallel-games N plays N games at once headless, choosing all N actions with one DQN call
+                --capacity N sets the replay memory capacity, --replay-dir DIR keeps the replay memory in
+                memory-mapped files in DIR instead of RAM (needed for capacities of millions of conv states)
+                --prioritized pushes every experience to a prioritized replay memory, sampled by TD error,
+                instead of filtering experiences with ReplayGate
+                --fast plays FastSnake (fast_snake.py), compiled with numba when it is installed
+                --seed N repeats a run, every run prints its seed (see seeding.py)
+                --record FILE records the seed and actions of every game to FILE (see trajectory.py)
+                --metrics FILE writes phase timings and counters every 10 seconds to a .jsonl or .csv FILE,
+                --metrics-port PORT serves them as Prometheus text on localhost:PORT/metrics (see metrics.py)
+                --profile N profiles N loop iterations, after the first 1000, with cProfile into profile.prof
+                --board WxH plays on a board of W by H blocks, scaled to fit the window, instead of the
+                30x17 blocks that fit in the window, --view-radius R sets the conv view to 2R+1 blocks square
+                --curriculum WxH:steps ... trains on each board size in turn (see curriculum.py)
+                --compact-replay stores each observation once, conv views as int8, in a ring of N (default 2)
+                observations per experience (see CompactReplayMemory in replay.py)
+                --replay-ratio N trains on a background thread, sampling N experiences per experience pushed,
+                so the game loop only pushes (training in the loop samples about 20)
+                --polyak TAU moves the target network TAU of the way to the online network every train step
+                instead of copying it every 300 train steps
+                --numpy chooses greedy actions with a NumPy forward pass of the network instead of TensorFlow
+                (see policy.py), with a single game or --parallel-games
 '''
 
-def main(gamemode=1, train=False, reset_weights=False, use_pygame=True, use_conv=False):
+def main(gamemode=1, train=False, reset_weights=False, use_pygame=True, use_conv=False, capacity=100_000,
+         replay_dir=None, prioritized=False, fast=False, seed=None, record=None, metrics_path=None,
+         metrics_port=None, profile=0, board_size=None, view_radius=5, curriculum=None, compact_replay=None,
+         replay_ratio=None, polyak=None, numpy_inference=False):
     start_time = time.time()
     # Initialise parameters
     run = True
@@ -46,50 +88,80 @@ def main(gamemode=1, train=False, reset_weights=False, use_pygame=True, use_conv
     instant_restart = bool(gamemode)
     display = True
 
-    # Window dimensions (Changes size of game board)
+    # Window dimensions (Changes size of game board unless board_size is given)
     win_width = 1000
     win_height = 600
+    # curriculum: list of 'WxH:steps' stages, overrides board_size
+    if curriculum:
+        curriculum = Curriculum(curriculum)
+        board_size = curriculum.board_size
 
-    # Initialise Pygame
+    # Initialise Pygame, only imported when a window is used
+    # The window is drawn by its own process, which is sent snapshots of the game
     if use_pygame:
-        pygame.init()
-        pygame.font.init()
-        pygame.display.set_caption("Snake")
-        win = pygame.display.set_mode((win_width, win_height))
+        import pygame
+        from render import RenderProcess, player_input, quit_requested
+        window = RenderProcess(win_width, win_height, frame)
         clock = pygame.time.Clock()
-        pygame.display.update()
+    else:
+        # Without a window Ctrl-C stops the loop at the end of the step, which then saves as Q does
+        interrupted = []
+        signal.signal(signal.SIGINT, lambda signum, stack: interrupted.append(signum))
 
     if use_conv:
-        input_dims = 11
+        input_dims = 2*view_radius + 1
         num_actions = 4
     else:
         input_dims = 9
         num_actions = 3
 
+    # FastSnake plays the same games as Snake, faster
+    Game = Snake
+    if fast:
+        from fast_snake import game_class
+        Game = game_class(fast, use_conv)
+
+    # Every game and the agent have their own random numbers, all seeded from the run seed
+    if seed is None:
+        seed = new_run_seed()
+    print(f'Run seed: {seed}')
+    game_seeds = GameSeeds(seed)
+    recorder = TrajectoryWriter(record, use_conv, win_width, win_height, view_radius) if record else None
+
     # Initialise loop objects
-    snake = Snake(gamemode, win_width, win_height, use_conv)
-    DQN = DeepQNetwork(input_dims, num_actions, reset_weights)
+    game_seed = game_seeds.next()
+    snake = Game(gamemode, win_width, win_height, use_conv, rng=random.Random(game_seed),
+                 board_size=board_size, view_radius=view_radius)
+    played = []     # Actions of the current game, for the recorder
+    metrics = Metrics(metrics_path, metrics_port)
+    profiler = Profiler(profile, skip=1000) if profile else None
+    DQN = DeepQNetwork(input_dims, num_actions, reset_weights, capacity=capacity, replay_dir=replay_dir,
+                       prioritized=prioritized, seed=derive_seed(seed, 'agent'), metrics=metrics, conv=use_conv,
+                       compact_replay=compact_replay, polyak=polyak)
+    DQN.numpy_inference = numpy_inference
+    if replay_ratio:
+        DQN.start_learner(replay_ratio)
     action = 1
-    mini_memory = []      
+    gate = PassThroughGate() if prioritized else ReplayGate(rng=DQN.rng)
     scores = []   
     counter = 0     
     count_time = time.time()     
-    percent_apple = 0
-    percent_lose = 0   
+    percent_apple = DQN.memory.reward_percent(1)
+    percent_lose = DQN.memory.reward_percent(-1)   
     exploit = not train 
     explore = False
 
     print("Before loop --- %s seconds ---" % (time.time() - start_time))
 
     while run:
+        metrics.tick()
+        if profiler:
+            profiler.tick()
         # Outputs data while training 
         counter += 1
         if counter % 50_000 == 5000 and train:
-            rewards = [item[3] for item in DQN.memory]
-            percent_apple = round(rewards.count(1) * 100/len(rewards), 1)
-            percent_lose =  round(rewards.count(-1) * 100/len(rewards), 1)
-            percent_closer =  round(rewards.count(0.05) * 100/len(rewards), 1)
-            percent_further =  round(rewards.count(0) * 100/len(rewards), 1)
+            percent_closer = DQN.memory.reward_percent(0.05)
+            percent_further = DQN.memory.reward_percent(0)
             print(f'Apples: {percent_apple}%, Loses: {percent_lose}%, Closer: {percent_closer}%, Further: {percent_further}%')
             print(f'Epsilon: {round(DQN.e, 3)}, Memory Length: {len(DQN.memory)}, Push Count: {DQN.push_count}')
             DQN.save_data()
@@ -98,50 +170,57 @@ def main(gamemode=1, train=False, reset_weights=False, use_pygame=True, use_conv
         
 
         if use_pygame:
-            events = pygame.event.get()
-            if display:
+            events = window.get_events()
+            # A player always plays at the frame rate, as does the DQN while not training
+            # While the DQN trains the game runs flat out and the window shows the latest frame
+            if display and (gamemode == 0 or not train):
                 clock.tick(frame)
 
         if snake.alive:
             # Get action depending on gamemode (player or DQN)
-            if gamemode == 0:
-                action = snake.player_input(events)
-            elif gamemode == 1:
-                action = DQN.get_action(snake.state, exploit, explore)
-
-            snake.move(action)
-            snake.update_board()
-            if use_conv:
-                snake.update_state_conv()
-            else:
-                snake.update_state()
+            with metrics.timer('action'):
+                if gamemode == 0:
+                    action = player_input(snake, events)
+                elif gamemode == 1:
+                    action = DQN.get_action(snake.state, exploit, explore)
+
+            with metrics.timer('env_step'):
+                snake.move(action)
+            played.append(action)
+            with metrics.timer('state'):
+                snake.update_board()
+                if use_conv:
+                    snake.update_state_conv()
+                else:
+                    snake.update_state()
+            metrics.count('env_steps')
+            if curriculum:
+                curriculum.count()
+            if not snake.alive:
+                metrics.count('episodes')
+                metrics.observe('score', snake.score)
+                metrics.gauge('epsilon', getattr(DQN, 'e', None))
+                metrics.gauge('memory_size', len(DQN.memory))
+                metrics.gauge('push_count', DQN.push_count)
+                metrics.gauge('board_width', snake.game_width_blocks)
+                metrics.gauge('board_height', snake.game_height_blocks)
+                if recorder:
+                    recorder.write(game_seed, snake.score, played, (snake.game_width_blocks, snake.game_height_blocks))
 
             # Add a higer weight to experiences near death or reward (reducing sparse rewards)
             # Also maintain percentage for apples and deaths between thresholds to combat 'catastrophic forgetting'
             # Dont add to memory if died because stuck in cycle (move_counter > 1000)
             if train and snake.move_counter < 1000:
                 experience = snake.get_experience()
-                reward = experience[3]
-
-                # if apple or death add events leading to this to replay memory
-                if (reward == 1 and percent_apple < 8) or (reward == -1 and percent_lose < 8):
-                    mini_memory.append(experience)
-                    for exp in mini_memory[-8:]:
-                        DQN.push_to_memory(exp)
-                        DQN.train()
-                    mini_memory = []
-                # Also rarely add events randomly
-                elif random.random() < 0.05 and min(percent_apple, percent_lose) > 5:
-                    DQN.push_to_memory(experience)
+                for exp in gate.filter(experience, percent_apple, percent_lose):
+                    DQN.push_to_memory(exp)
                     DQN.train()
-                else: 
-                    if len(mini_memory) > 8:
-                        mini_memory = []
-                    mini_memory.append(experience)
+                percent_apple = DQN.memory.reward_percent(1)
+                percent_lose = DQN.memory.reward_percent(-1)
 
         if display and use_pygame:
-            snake.draw(win)
-            pygame.display.update()
+            with metrics.timer('render'):
+                window.publish(snake, force=not train)
 
         # Restart game if snake dies (wait for R if player input)
         if not snake.alive:
@@ -151,28 +230,28 @@ def main(gamemode=1, train=False, reset_weights=False, use_pygame=True, use_conv
                         if event.key == pygame.K_r:
                             # Re initiliase game
                             print(f'Score: {snake.score}')
-                            snake = Snake(gamemode, win_width, win_height, use_conv)
+                            game_seed = game_seeds.next()
+                            snake = Game(gamemode, win_width, win_height, use_conv, rng=random.Random(game_seed),
+                                         board_size=board_size, view_radius=view_radius)
+                            played = []
                             action = 1
             elif gamemode == 1: # DQN
                 if (not train) or exploit:
                     scores.append(snake.score)
                     print(f'Score: {snake.score}    Average: {sum(scores)//len(scores)}')
-                snake = Snake(gamemode, win_width, win_height, use_conv)
+                if curriculum and curriculum.advance():
+                    board_size = curriculum.board_size
+                game_seed = game_seeds.next()
+                snake = Game(gamemode, win_width, win_height, use_conv, rng=random.Random(game_seed),
+                             board_size=board_size, view_radius=view_radius)
+                played = []
                 action = 1
-                if DQN.push_count > DQN.capacity/2 and train:
-                    if random.random() < 0.1:
-                        exploit = True
-                        explore = False
-                    elif random.random() < 0.2:
-                        exploit = False
-                        explore = True
-                    else:
-                        exploit = False
-                        explore = False
+                if train:
+                    exploit, explore = DQN.game_mode(exploit, explore)
 
         if use_pygame:
             # Toggle between training and testing using T on keyboard
-            # Toggle on and off display using D on keyboard (to improve speed)
+            # Toggle on and off display using D on keyboard
             for event in events:
                 if event.type == pygame.KEYDOWN:
                     if event.key == pygame.K_t:
@@ -183,24 +262,169 @@ def main(gamemode=1, train=False, reset_weights=False, use_pygame=True, use_conv
                         display = False if display else True
                         print('Toggle Display')
 
-            # End game using Q on keyboard or red cross
-            for event in events: 
-                if event.type == pygame.KEYDOWN or event.type == pygame.QUIT:
-                    if event.key == pygame.K_q or event.type == pygame.QUIT:
-                        DQN.save_data()
-                        filename = 'Scores.pkl'
-                        object_to_save = scores
-                        with open(f'{filename}', 'wb') as file:
-                            pickle.dump(object_to_save, file)
-                        run = False
-                        quit()
+        # End game using Q on keyboard or red cross, or Ctrl-C without a window
+        if (quit_requested(events) if use_pygame else interrupted):
+            if use_pygame:
+                window.close()
+            DQN.stop_learner()
+            DQN.save_data(block=True)
+            if recorder:
+                recorder.close()
+            if curriculum:
+                curriculum.report()
+            metrics.close()
+            filename = 'Scores.pkl'
+            object_to_save = scores
+            with open(f'{filename}', 'wb') as file:
+                pickle.dump(object_to_save, file)
+            run = False
+            quit()
+
+
+def main_parallel(num_games, train=False, reset_weights=False, use_conv=False, capacity=100_000, replay_dir=None,
+                  prioritized=False, seed=None, metrics_path=None, metrics_port=None, profile=0, board_size=None,
+                  view_radius=5, curriculum=None, compact_replay=None, replay_ratio=None, polyak=None,
+                  numpy_inference=False):
+    # Headless version of main for the AI agent which plays num_games games in lockstep
+    # Runs until Ctrl-C
+    win_width = 1000
+    win_height = 600
+    # With a curriculum all games move to the next board together, games in progress are dropped
+    if curriculum:
+        curriculum = Curriculum(curriculum)
+        board_size = curriculum.board_size
+    if use_conv:
+        input_dims = 2*view_radius + 1
+        num_actions = 4
+    else:
+        input_dims = 9
+        num_actions = 3
+
+    if seed is None:
+        seed = new_run_seed()
+    print(f'Run seed: {seed}')
+    games_rng = random.Random(derive_seed(seed, 'games'))
+    games = VectorSnake(num_games, win_width, win_height, use_conv, rng=games_rng, board_size=board_size,
+                        view_radius=view_radius)
+    metrics = Metrics(metrics_path, metrics_port)
+    profiler = Profiler(profile, skip=1000) if profile else None
+    DQN = DeepQNetwork(input_dims, num_actions, reset_weights, capacity=capacity, replay_dir=replay_dir,
+                       prioritized=prioritized, seed=derive_seed(seed, 'agent'), metrics=metrics, conv=use_conv,
+                       compact_replay=compact_replay, polyak=polyak)
+    DQN.numpy_inference = numpy_inference
+    if replay_ratio:
+        DQN.start_learner(replay_ratio)
+    trainer = ParallelTrainer(DQN, games, train)
+    scores = []
+    counter = 0
+    count_time = time.time()
+    print_every = max(1, 50_000//num_games)
+
+    try:
+        while True:
+            metrics.tick()
+            if profiler:
+                profiler.tick()
+            # Outputs data while training, about every 50k moves as in main
+            counter += 1
+            if counter % print_every == 0 and train and len(DQN.memory):
+                print(f'Apples: {trainer.percent_apple}%, Loses: {trainer.percent_lose}%')
+                print(f'Epsilon: {round(DQN.e, 3)}, Memory Length: {len(DQN.memory)}, Push Count: {DQN.push_count}')
+                DQN.save_data()
+                print('Time between prints: %s' % round(time.time() - count_time, 0))
+                count_time = time.time()
+
+            ended, greedy = trainer.step()
+            metrics.count('env_steps', num_games)
+            if curriculum:
+                curriculum.count(num_games)
+
+            # Games that died have already been restarted by VectorSnake
+            for i, was_greedy in zip(ended, greedy):
+                metrics.count('episodes')
+                metrics.observe('score', games.final_scores[i])
+                if was_greedy:
+                    scores.append(games.final_scores[i])
+                    print(f'Score: {games.final_scores[i]}    Average: {sum(scores)//len(scores)}')
+            metrics.gauge('epsilon', getattr(DQN, 'e', None))
+            metrics.gauge('memory_size', len(DQN.memory))
+            metrics.gauge('push_count', DQN.push_count)
+            metrics.gauge('board_width', games.game_width_blocks)
+            metrics.gauge('board_height', games.game_height_blocks)
+
+            if curriculum and curriculum.advance():
+                games = VectorSnake(num_games, win_width, win_height, use_conv, rng=games_rng,
+                                    board_size=curriculum.board_size, view_radius=view_radius)
+                trainer.games = games
+    except KeyboardInterrupt:
+        if curriculum:
+            curriculum.report()
+        metrics.close()
+        DQN.stop_learner()
+        DQN.save_data(block=True)
+        with open('Scores.pkl', 'wb') as file:
+            pickle.dump(scores, file)
 
 
 if __name__ == "__main__":
-    # Check for inputs
-    if len(sys.argv) > 1:
-        _, gamemode, train, reset_weights = sys.argv
-        main(int(gamemode), bool(int(train)), bool(int(reset_weights)))
+    # Check for inputs, else run with default parameters
+    parser = argparse.ArgumentParser(description='Play and train snake')
+    parser.add_argument('gamemode', nargs='?', type=int, default=1, help='0 = human input, 1 = AI agent input')
+    parser.add_argument('train', nargs='?', type=int, default=0, help='1 = train the DQN')
+    parser.add_argument('reset_weights', nargs='?', type=int, default=0, help='1 = reset weights to retrain')
+    parser.add_argument('--conv', action='store_true', help='use the convolutional DQN')
+    parser.add_argument('--actors', type=int, default=0, help='train headless with this many actor processes')
+    parser.add_argument('--sync-every', type=int, default=100, help='learner train steps between weight syncs to actors')
+    parser.add_argument('--parallel-games', type=int, default=0, help='play this many games at once, headless')
+    parser.add_argument('--capacity', type=int, default=100_000, help='replay memory capacity')
+    parser.add_argument('--replay-dir', help='keep the replay memory in memory-mapped files in this directory')
+    parser.add_argument('--prioritized', action='store_true', help='use prioritized replay instead of ReplayGate')
+    parser.add_argument('--fast', action='store_true', help='play FastSnake, with --actors or a single game')
+    parser.add_argument('--seed', type=int, help='run seed, a new one is drawn and printed if not given')
+    parser.add_argument('--record', help='record every game to this trajectory file, single game only')
+    parser.add_argument('--metrics', help='write phase timings and counters to this .jsonl or .csv file')
+    parser.add_argument('--metrics-port', type=int, help='serve metrics as Prometheus text on this port')
+    parser.add_argument('--profile', type=int, default=0, help='profile this many loop iterations with cProfile')
+    parser.add_argument('--board', type=parse_board_size, help='board size in blocks as WxH, default fits the window')
+    parser.add_argument('--view-radius', type=int, default=5, help='the conv state is the 2R+1 square around the head')
+    parser.add_argument('--curriculum', nargs='+', metavar='WxH:steps', help='board sizes to train on in turn')
+    parser.add_argument('--compact-replay', type=float, nargs='?', const=2.0, metavar='N',
+                        help='store each observation once, in a ring of N observations per experience')
+    parser.add_argument('--replay-ratio', type=float, help='train on a background thread, sampling N experiences per push')
+    parser.add_argument('--polyak', type=float, help='soft update the target network by this fraction every train step')
+    parser.add_argument('--numpy', action='store_true', help='choose greedy actions with NumPy instead of TensorFlow')
+    parser.add_argument('--headless', action='store_true', help='play a single game without a window, Ctrl-C to stop')
+    args = parser.parse_args()
+    if args.headless and args.gamemode == 0:
+        parser.error('--headless needs gamemode 1, a player needs the window')
+    if args.record and (args.actors > 0 or args.parallel_games > 0):
+        parser.error('--record only records a single game, not --actors or --parallel-games')
+    # Options the multi-process learner would ignore
+    if args.actors > 0:
+        if args.gamemode == 0 or not args.train:
+            parser.error('--actors trains the AI agent, use gamemode 1 and train 1')
+        for name in ('numpy', 'profile'):
+            if getattr(args, name):
+                parser.error(f'--{name} is not supported with --actors')
+    elif args.parallel_games > 0 and args.gamemode == 0:
+        parser.error('--parallel-games plays the AI agent, use gamemode 1')
+
+    if args.actors > 0:
+        from distributed import train_distributed
+        train_distributed(args.actors, args.sync_every, bool(args.reset_weights), args.conv,
+                          capacity=args.capacity, replay_dir=args.replay_dir, prioritized=args.prioritized,
+                          fast=args.fast, seed=args.seed, metrics_path=args.metrics, metrics_port=args.metrics_port,
+                          board_size=args.board, view_radius=args.view_radius, curriculum=args.curriculum,
+                          compact_replay=args.compact_replay, replay_ratio=args.replay_ratio, polyak=args.polyak)
+    elif args.parallel_games > 0:
+        main_parallel(args.parallel_games, bool(args.train), bool(args.reset_weights), args.conv,
+                      args.capacity, args.replay_dir, args.prioritized, args.seed, args.metrics, args.metrics_port,
+                      args.profile, args.board, args.view_radius, args.curriculum, args.compact_replay,
+                      args.replay_ratio, args.polyak, args.numpy)
     else:
-        # Else run with default parameters
-        main()
+        main(args.gamemode, bool(args.train), bool(args.reset_weights), use_pygame=not args.headless,
+             use_conv=args.conv, capacity=args.capacity, replay_dir=args.replay_dir, prioritized=args.prioritized,
+             fast=args.fast, seed=args.seed, record=args.record, metrics_path=args.metrics,
+             metrics_port=args.metrics_port, profile=args.profile, board_size=args.board, view_radius=args.view_radius,
+             curriculum=args.curriculum, compact_replay=args.compact_replay, replay_ratio=args.replay_ratio,
+             polyak=args.polyak, numpy_inference=args.numpy)
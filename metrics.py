@@ -0,0 +1,272 @@
+import cProfile
+import csv
+import io
+import json
+import os
+import pstats
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+'''
+Timers, counters and profiling for the training loop
+
+Metrics keeps the time spent in each phase of the loop and the number of calls, counters (games
+played), gauges (epsilon) and averaged values (score, loss). Once every interval seconds, on
+tick(), the values since the last row are written as one row to a rotating .jsonl or .csv file.
+Totals since the start are served as Prometheus text at http://localhost:<port>/metrics.
+Without a file or port nothing is written and timers do nothing.
+
+    metrics = Metrics('metrics.jsonl', port=8000)
+    with metrics.timer('env_step'):
+        snake.move(action)
+    metrics.count('episodes')
+    metrics.tick()
+
+Profiler runs cProfile over a number of loop iterations and writes the stats to a file, viewable
+with pstats or snakeviz. For sampling profiles of a whole run use py-spy on the running process
+(py-spy record -o profile.svg --pid <pid>), which needs nothing from this module.
+'''
+
+# Phases of the training loop, in order, so CSV columns are the same in every file
+PHASES = ('env_step', 'state', 'action', 'push', 'sample', 'train', 'target_sync', 'render')
+COUNTERS = ('episodes', 'env_steps', 'train_steps')
+GAUGES = ('epsilon', 'memory_size', 'push_count', 'board_width', 'board_height')
+AVERAGES = ('score', 'loss')
+
+
+class PhaseTimer:
+    # Adds the time spent inside a with block to a phase, reused for every call
+    __slots__ = ('metrics', 'phase', 'start')
+
+    def __init__(self, metrics, phase):
+        self.metrics = metrics
+        self.phase = phase
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.metrics.phase_seconds[self.phase] += time.perf_counter() - self.start
+        self.metrics.phase_calls[self.phase] += 1
+
+
+class NullTimer:
+    # Timer of Metrics with nowhere to write to
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class Metrics:
+    def __init__(self, path=None, port=None, interval=10, max_bytes=10_000_000, backups=3):
+        # path: .jsonl or .csv file a row is written to every interval seconds, rotated once
+        # larger than max_bytes keeping backups old files
+        # port: serve totals as Prometheus text on this port
+        self.timers = {}
+        self.phase_seconds = defaultdict(float)
+        self.phase_calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.gauges = {}
+        self.sums = defaultdict(float)
+        self.samples = defaultdict(int)
+        self.interval = interval
+        self.start_time = time.time()
+        self.last_row_time = self.start_time
+        self.last_row = {}  # Totals at the last row, rows hold the change since then
+        self.writer = RotatingWriter(path, max_bytes, backups) if path else None
+        self.server = serve_prometheus(self, port) if port else None
+        self.enabled = bool(path or port)
+
+    def timer(self, phase):
+        if not self.enabled:
+            return NULL_TIMER
+        timer = self.timers.get(phase)
+        if timer is None:
+            timer = self.timers[phase] = PhaseTimer(self, phase)
+        return timer
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def observe(self, name, value):
+        # Value averaged over each row, e.g. the score of every game
+        self.sums[name] += value
+        self.samples[name] += 1
+
+    def totals(self):
+        # Everything since the start as flat names
+        # Also called from the Prometheus thread, list() copies the keys in one step under the GIL
+        totals = {}
+        for phase in PHASES + tuple(p for p in list(self.phase_seconds) if p not in PHASES):
+            totals[f'{phase}_seconds'] = self.phase_seconds.get(phase, 0.0)
+            totals[f'{phase}_calls'] = self.phase_calls.get(phase, 0)
+        for name in COUNTERS + tuple(c for c in list(self.counters) if c not in COUNTERS):
+            totals[name] = self.counters.get(name, 0)
+        for name in AVERAGES + tuple(a for a in list(self.sums) if a not in AVERAGES):
+            totals[f'{name}_sum'] = self.sums.get(name, 0.0)
+            totals[f'{name}_count'] = self.samples.get(name, 0)
+        return totals
+
+    def tick(self):
+        # Call once per loop iteration, writes a row every interval seconds
+        now = time.time()
+        if self.writer is None or now - self.last_row_time < self.interval:
+            return
+        self.write_row(now)
+
+    def write_row(self, now=None):
+        now = now or time.time()
+        totals = self.totals()
+        change = {key: value - self.last_row.get(key, 0) for key, value in totals.items()}
+        elapsed = now - self.last_row_time
+        row = {'time': round(now, 3), 'elapsed': round(elapsed, 3)}
+        for key in totals:
+            if key.endswith('_seconds'):
+                phase = key[:-len('_seconds')]
+                calls = change[f'{phase}_calls']
+                # Share of the interval spent in the phase and mean time per call
+                row[f'{phase}_percent'] = round(100*change[key]/elapsed, 2)
+                row[f'{phase}_ms'] = round(1e3*change[key]/calls, 4) if calls else None
+            elif key.endswith('_sum'):
+                name = key[:-len('_sum')]
+                samples = change[f'{name}_count']
+                row[name] = change[key]/samples if samples else None
+            elif not key.endswith('_calls') and not key.endswith('_count'):
+                row[key] = change[key]
+        for name in GAUGES + tuple(g for g in self.gauges if g not in GAUGES):
+            row[name] = self.gauges.get(name)
+        self.writer.write(row)
+        self.last_row = totals
+        self.last_row_time = now
+
+    def close(self):
+        if self.writer is not None:
+            self.write_row()
+            self.writer.close()
+        if self.server is not None:
+            self.server.shutdown()
+
+
+class RotatingWriter:
+    # Writes rows as JSON lines or CSV (by the file extension), moving the file to path.1, path.2 ...
+    # once it is larger than max_bytes. CSV columns are those of the first row of each file
+    def __init__(self, path, max_bytes, backups):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.csv = path.endswith('.csv')
+        self.open()
+
+    def open(self):
+        self.file = open(self.path, 'a', newline='')
+        self.csv_writer = None
+
+    def write(self, row):
+        if self.csv:
+            if self.csv_writer is None:
+                self.csv_writer = csv.DictWriter(self.file, fieldnames=list(row), extrasaction='ignore')
+                if self.file.tell() == 0:
+                    self.csv_writer.writeheader()
+            self.csv_writer.writerow(row)
+        else:
+            self.file.write(json.dumps(row) + '\n')
+        self.file.flush()
+        if self.file.tell() > self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{i}'):
+                os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+        if self.backups > 0:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+        self.open()
+
+    def close(self):
+        self.file.close()
+
+
+def prometheus_text(metrics):
+    # Totals in the Prometheus text exposition format, one block per metric
+    totals = metrics.totals()
+    seconds = ['# TYPE snake_phase_seconds_total counter']
+    calls = ['# TYPE snake_phase_calls_total counter']
+    others = []
+    for key, value in totals.items():
+        if key.endswith('_seconds'):
+            seconds.append(f'snake_phase_seconds_total{{phase="{key[:-len("_seconds")]}"}} {value}')
+        elif key.endswith('_calls'):
+            calls.append(f'snake_phase_calls_total{{phase="{key[:-len("_calls")]}"}} {value}')
+        elif key.endswith('_sum') or key.endswith('_count'):
+            others += [f'# TYPE snake_{key} counter', f'snake_{key} {value}']
+        else:
+            others += [f'# TYPE snake_{key}_total counter', f'snake_{key}_total {value}']
+    for name, value in list(metrics.gauges.items()):
+        if value is not None:
+            others += [f'# TYPE snake_{name} gauge', f'snake_{name} {value}']
+    return '\n'.join(seconds + calls + others) + '\n'
+
+
+def serve_prometheus(metrics, port):
+    # Serves /metrics from a daemon thread, returns the server
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = prometheus_text(metrics).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class Profiler:
+    # Profiles the loop with cProfile for iterations ticks after the first skip (warm up, numba
+    # and TensorFlow compiling), then writes the stats to path and prints the functions with the
+    # most cumulative time
+    def __init__(self, iterations, path='profile.prof', top=25, skip=0):
+        self.iterations = iterations
+        self.path = path
+        self.top = top
+        self.ticks = -skip
+        self.profile = None
+
+    def tick(self):
+        if self.ticks < 0 or self.ticks > self.iterations:
+            self.ticks += self.ticks < 0
+            return
+        if self.ticks == 0:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        elif self.ticks == self.iterations:
+            self.profile.disable()
+            self.profile.dump_stats(self.path)
+            output = io.StringIO()
+            pstats.Stats(self.profile, stream=output).sort_stats('cumulative').print_stats(self.top)
+            print(output.getvalue())
+            print(f'Profile of {self.iterations} iterations written to {self.path}')
+        self.ticks += 1
@@ -0,0 +1,61 @@
+import numpy as np
+from replay import ReplayGate, PassThroughGate
+'''
+Training on many games in lockstep
+
+ParallelTrainer runs the loop of main.py --parallel-games, which sweep.py and benchmark.py per
+train with as well: every step chooses the actions of all the games of a VectorSnake with one
+DQN call and moves them, pushes the experiences that pass each game's ReplayGate and trains once
+per push. Each restarted game then picks its exploit/explore mode as main does
+(DeepQNetwork.game_mode), so every caller trains under the same regime.
+
+    trainer = ParallelTrainer(DQN, VectorSnake(64, 1000, 600, False))
+    while True:
+        ended, greedy = trainer.step()
+'''
+
+
+class ParallelTrainer:
+    def __init__(self, DQN, games, train=True, gates=None):
+        # games: VectorSnake, replaced by the caller to change board size
+        # train: push experiences and train, otherwise every game is played greedily
+        # gates: one ReplayGate per game, by default a PassThroughGate each with prioritized replay
+        self.DQN = DQN
+        self.games = games
+        self.train = train
+        if gates is None:
+            gates = [PassThroughGate() if DQN.prioritized else ReplayGate(rng=DQN.rng) for _ in range(games.num_games)]
+        self.gates = gates
+        self.percent_apple = DQN.memory.reward_percent(1)
+        self.percent_lose = DQN.memory.reward_percent(-1)
+        self.exploit = np.full(games.num_games, not train)
+        self.explore = np.zeros(games.num_games, dtype=bool)
+
+    def step(self):
+        # Moves every game once. Returns the games that ended, restarted by VectorSnake with their
+        # final scores in games.final_scores, and whether each was played greedily
+        DQN = self.DQN
+        games = self.games
+        states = games.states
+        with DQN.metrics.timer('action'):
+            actions = DQN.get_actions(states, self.exploit, self.explore)
+        # VectorSnake builds the states as part of the move
+        with DQN.metrics.timer('env_step'):
+            next_states, rewards, alives = games.move(actions)
+
+        # Dont add to memory if died because stuck in cycle (move_counter > 1000)
+        if self.train:
+            for i in np.flatnonzero(games.final_move_counters < 1000):
+                experience = [states[i], actions[i], next_states[i], rewards[i], alives[i]]
+                for exp in self.gates[i].filter(experience, self.percent_apple, self.percent_lose):
+                    DQN.push_to_memory(exp)
+                    DQN.train()
+                self.percent_apple = DQN.memory.reward_percent(1)
+                self.percent_lose = DQN.memory.reward_percent(-1)
+
+        ended = np.flatnonzero(~alives)
+        greedy = self.exploit[ended].copy()
+        if self.train:
+            for i in ended:
+                self.exploit[i], self.explore[i] = DQN.game_mode(self.exploit[i], self.explore[i])
+        return ended, greedy
@@ -0,0 +1,215 @@
+import argparse
+import random
+import sys
+import numpy as np
+from snake import Snake, parse_board_size
+from fast_snake import FastSnake, njit
+from vector_snake import VectorSnake
+'''
+Parity check of FastSnake, VectorSnake and the incremental boards against the reference Snake
+
+Games are recorded by playing the reference Snake from seeds seed, seed + 1, ... with a simple
+policy that heads for the apple and avoids dying, sometimes moving at random, so games cover
+long bodies, deaths and timeouts. The recorded actions are then replayed on FastSnake from the
+same seeds and every state, reward, alive flag, score, head and apple is compared exactly.
+
+--engine picks what is checked:
+
+    fast            FastSnake, with the python and/or numba kernel (--backend)
+    vector          VectorSnake playing one game, its state, reward and alive flag after every move
+    incremental     Snake painting only the blocks that change (incremental=True for the MLP state,
+                    always for conv) against Snake repainting the whole board after every move,
+                    comparing the board as well
+
+Action sequences can be saved with --save and replayed later with --load.
+
+Usage:  python parity.py [--games 200] [--seed 0] [--conv] [--engine fast|vector|incremental]
+                         [--backend python|numba|both] [--board WxH] [--view-radius 5] [--save actions.npz | --load actions.npz]
+'''
+
+win_width = 1000
+win_height = 600
+
+
+def policy(state, conv, rng):
+    # Greedy towards the apple, avoiding blocks next to the head, with 5% random moves
+    state = np.asarray(state)
+    if conv:
+        c = state.shape[0]//2
+        moves = [(0, -1), (1, 0), (0, 1), (-1, 0)]
+        order = list(rng.permutation(4))
+        apples = np.argwhere(state == 1)
+        if len(apples) and rng.random() > 0.05:
+            ax, ay = apples[0]
+            order.sort(key=lambda d: abs(c + moves[d][0] - ax) + abs(c + moves[d][1] - ay))
+        safe = [d for d in order if state[c + moves[d][0], c + moves[d][1]] != -1]
+        return int(safe[0] if safe else order[0])
+    apple_direc = state[7]
+    if abs(apple_direc) < 0.25:
+        order = [1, 0, 2]
+    else:
+        order = [2, 1, 0] if apple_direc > 0 else [0, 1, 2]
+    if rng.random() < 0.05:
+        order = list(rng.permutation(order))
+    # Blocks straight ahead, right and left, a value of -0.95 is a wall or body one block away
+    ahead = {0: state[5], 1: state[0], 2: state[2]}
+    safe = [action for action in order if ahead[action] > -0.94]
+    return int(safe[0] if safe else order[0])
+
+
+def record_game(seed, conv, board_size=None, view_radius=5):
+    # Actions of one reference game played by policy
+    rng = np.random.default_rng(seed)
+    random.seed(seed)
+    snake = Snake(1, win_width, win_height, conv, board_size=board_size, view_radius=view_radius)
+    actions = []
+    while snake.alive:
+        action = policy(snake.state, conv, rng)
+        actions.append(action)
+        snake.move(action)
+        snake.update_board()
+        if conv:
+            snake.update_state_conv()
+        else:
+            snake.update_state()
+    return actions
+
+
+def play(game, seed, actions, conv, board=False):
+    # Replay actions on a new game made by game(), returns what is seen after every move
+    # board: add a copy of the board to what is seen
+    random.seed(seed)
+    snake = game()
+
+    def seen():
+        return (np.array(snake.state, dtype=np.float64), snake.reward, snake.alive, snake.score,
+                list(snake.pos), list(snake.apple)) + ((snake.board.copy(),) if board else ())
+
+    trajectory = [seen()]
+    for action in actions:
+        snake.move(action)
+        snake.update_board()
+        if conv:
+            snake.update_state_conv()
+        else:
+            snake.update_state()
+        trajectory.append(seen())
+    return trajectory
+
+
+def play_vector(seed, actions, conv, board_size=None, view_radius=5):
+    # Replay actions on one game of a VectorSnake, returns the state, reward and alive flag after every move
+    random.seed(seed)
+    games = VectorSnake(1, win_width, win_height, conv, board_size=board_size, view_radius=view_radius)
+    trajectory = [(games.states[0].copy(), 0, True)]
+    for action in actions:
+        states, rewards, alives = games.move([action])
+        trajectory.append((states[0], rewards[0], alives[0]))
+    return trajectory
+
+
+def repainting_snake(conv, board_size=None, view_radius=5):
+    # Snake as it was before the incremental boards, repainting the whole board in update_board
+    snake = Snake(1, win_width, win_height, conv, board_size=board_size, view_radius=view_radius)
+    snake.paint_blocks = False
+    return snake
+
+
+def first_difference(seed, reference, trajectory, names):
+    # None if the trajectories match on every move, else a description of the first difference
+    for move, (expected, actual) in enumerate(zip(reference, trajectory)):
+        for name, a, b in zip(names, expected, actual):
+            if not np.array_equal(a, b):
+                if name == 'board':
+                    # The first cell that differs rather than the whole board
+                    cell = tuple(int(i) for i in np.argwhere(a != b)[0])
+                    return f'seed {seed} move {move}: board{list(cell)} {b[cell]} != {a[cell]}'
+                return f'seed {seed} move {move}: {name} {b} != {a}'
+    return None
+
+
+def check_game(seed, actions, conv, use_numba, board_size=None, view_radius=5):
+    # Returns None if FastSnake matches Snake on every move, else a description of the first difference
+    reference = play(lambda: Snake(1, win_width, win_height, conv, board_size=board_size, view_radius=view_radius),
+                     seed, actions, conv)
+    fast = play(lambda: FastSnake(1, win_width, win_height, conv, use_numba, board_size=board_size,
+                                  view_radius=view_radius), seed, actions, conv)
+    return first_difference(seed, reference, fast, ('state', 'reward', 'alive', 'score', 'head', 'apple'))
+
+
+def check_vector_game(seed, actions, conv, board_size=None, view_radius=5):
+    # As check_game for a VectorSnake of one game
+    reference = play(lambda: Snake(1, win_width, win_height, conv, board_size=board_size, view_radius=view_radius),
+                     seed, actions, conv)
+    vector = play_vector(seed, actions, conv, board_size, view_radius)
+    return first_difference(seed, reference, vector, ('state', 'reward', 'alive'))
+
+
+def check_incremental_game(seed, actions, conv, board_size=None, view_radius=5):
+    # As check_game for the incremental board against the repainted one, the board included
+    reference = play(lambda: repainting_snake(conv, board_size, view_radius), seed, actions, conv, board=True)
+    incremental = play(lambda: Snake(1, win_width, win_height, conv, incremental=not conv, board_size=board_size,
+                                     view_radius=view_radius), seed, actions, conv, board=True)
+    return first_difference(seed, reference, incremental,
+                            ('state', 'reward', 'alive', 'score', 'head', 'apple', 'board'))
+
+
+def save_actions(path, seeds, games):
+    np.savez(path, seeds=np.array(seeds), **{f'game_{i}': np.array(actions) for i, actions in enumerate(games)})
+
+
+def load_actions(path):
+    with np.load(path) as data:
+        seeds = data['seeds'].tolist()
+        games = [data[f'game_{i}'].tolist() for i in range(len(seeds))]
+    return seeds, games
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check FastSnake, VectorSnake or the incremental boards against '
+                                                 'Snake on recorded games')
+    parser.add_argument('--games', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first game, game i uses seed + i')
+    parser.add_argument('--conv', action='store_true')
+    parser.add_argument('--engine', choices=['fast', 'vector', 'incremental'], default='fast')
+    parser.add_argument('--backend', choices=['python', 'numba', 'both'], default='both', help='FastSnake kernel')
+    parser.add_argument('--board', type=parse_board_size, help='board size in blocks as WxH, default fits the window')
+    parser.add_argument('--view-radius', type=int, default=5)
+    parser.add_argument('--save', help='save the recorded actions to this .npz file')
+    parser.add_argument('--load', help='replay the actions saved in this .npz file instead of recording')
+    args = parser.parse_args()
+
+    if args.load:
+        seeds, games = load_actions(args.load)
+    else:
+        seeds = list(range(args.seed, args.seed + args.games))
+        games = [record_game(seed, args.conv, args.board, args.view_radius) for seed in seeds]
+        if args.save:
+            save_actions(args.save, seeds, games)
+
+    # Name and check of every engine to compare
+    if args.engine == 'vector':
+        checks = [('vector', check_vector_game)]
+    elif args.engine == 'incremental':
+        checks = [('incremental', check_incremental_game)]
+    else:
+        backends = {'python': [False], 'numba': [True], 'both': [False, True]}[args.backend]
+        if njit is None and True in backends:
+            print('numba is not installed, checking the python backend only')
+            backends = [False]
+        checks = [('numba' if use_numba else 'python',
+                   lambda seed, actions, conv, board_size, view_radius, use_numba=use_numba:
+                   check_game(seed, actions, conv, use_numba, board_size, view_radius))
+                  for use_numba in backends]
+    moves = sum(len(actions) for actions in games)
+    failed = False
+    for name, check in checks:
+        failures = 0
+        for seed, actions in zip(seeds, games):
+            error = check(seed, actions, args.conv, args.board, args.view_radius)
+            if error:
+                failures += 1
+                print(f'{name}: {error}')
+        print(f'{name}: {len(games) - failures} of {len(games)} games match, {moves} moves')
+        failed = failed or failures > 0
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,111 @@
+import argparse
+import os
+import numpy as np
+'''
+Greedy play without TensorFlow
+
+NumpyPolicy runs the forward pass of the DQN's network (the MLP or the conv network) with NumPy
+only, from the weights of a checkpoint or of an exported .npz, so playing and evaluating a trained
+agent does not need TensorFlow installed or imported. Its Q values match the Keras model to float32
+round off (see python benchmark.py policy).
+
+The export is a flat .npz of float32 arrays, kernel_<i> and bias_<i> for layer i in order, and
+format, the version of the export. A conv layer has a 4-D kernel (3, 3, in, out) as Keras stores
+it, the layers after it are dense and the conv output is flattened before the first of them.
+
+    python policy.py export [--checkpoint checkpoints/mlp] [--conv] [--view-radius 5] [--output policy.npz]
+    python evaluate.py --checkpoint policy.npz --numpy
+
+DeepQNetwork.get_action and get_actions use a NumpyPolicy of the current weights once
+numpy_inference is set (main.py --numpy), rebuilt whenever the network has trained since.
+'''
+
+FORMAT_VERSION = 1
+
+
+def export_weights(weights, path):
+    # Writes model.get_weights() as an export
+    arrays = {'format': np.array(FORMAT_VERSION)}
+    for i in range(0, len(weights), 2):
+        arrays[f'kernel_{i//2}'] = np.asarray(weights[i], dtype=np.float32)
+        arrays[f'bias_{i//2}'] = np.asarray(weights[i + 1], dtype=np.float32)
+    np.savez(path, **arrays)
+
+
+def read_export(path):
+    # Weights of an export in the order of model.get_weights()
+    with np.load(path) as data:
+        if int(data['format']) > FORMAT_VERSION:
+            raise ValueError(f'{path} has format version {int(data["format"])}, newer than {FORMAT_VERSION}')
+        weights = []
+        for i in range(sum(name.startswith('kernel_') for name in data.files)):
+            weights += [data[f'kernel_{i}'], data[f'bias_{i}']]
+    return weights
+
+
+class NumpyPolicy:
+    def __init__(self, weights):
+        # weights: list of arrays as returned by model.get_weights()
+        weights = [np.ascontiguousarray(w, dtype=np.float32) for w in weights]
+        self.conv_layers = []
+        self.dense_layers = []
+        for kernel, bias in zip(weights[::2], weights[1::2]):
+            if kernel.ndim == 4:
+                # Patches of a 3x3 window are flattened row, column, channel, as the kernel
+                size, _, inputs, outputs = kernel.shape
+                self.conv_layers.append((kernel.reshape(size*size*inputs, outputs), bias, size))
+            else:
+                self.dense_layers.append((kernel, bias))
+        self.conv = bool(self.conv_layers)
+        self.num_actions = len(self.dense_layers[-1][1])
+
+    def convolve(self, x):
+        # 'same' padded convolutions with relu, x is (batch, height, width, channels)
+        for kernel, bias, size in self.conv_layers:
+            pad = size//2
+            padded = np.pad(x, ((0, 0), (pad, pad), (pad, pad), (0, 0)))
+            windows = np.lib.stride_tricks.sliding_window_view(padded, (size, size), axis=(1, 2))
+            # (batch, height, width, channels, size, size) to rows of (size, size, channels)
+            patches = windows.transpose(0, 1, 2, 4, 5, 3).reshape(*x.shape[:3], -1)
+            x = patches @ kernel
+            x += bias
+            np.maximum(x, 0, out=x)
+        return x.reshape(len(x), -1)
+
+    def q_values(self, states):
+        # Q values of a batch of states, (batch, 9) or (batch, size, size), or of one state
+        x = np.asarray(states, dtype=np.float32)
+        single = self.conv and x.ndim == 2
+        if self.conv:
+            x = self.convolve((x[None] if single else x)[..., None])
+        last = len(self.dense_layers) - 1
+        for i, (kernel, bias) in enumerate(self.dense_layers):
+            x = x.dot(kernel)
+            x += bias
+            if i < last:
+                np.maximum(x, 0, out=x)
+        return x[0] if single else x
+
+    def act(self, state):
+        return int(np.argmax(self.q_values(state)))
+
+    def acts(self, states):
+        return np.argmax(self.q_values(states), axis=1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export a trained snake DQN for NumPy inference')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export', help='write the weights of a checkpoint as a flat .npz')
+    export_parser.add_argument('--checkpoint', help='defaults to checkpoints/mlp, or checkpoints/conv with --conv')
+    export_parser.add_argument('--conv', action='store_true')
+    export_parser.add_argument('--view-radius', type=int, default=5, help='view radius of the conv network')
+    export_parser.add_argument('--output', default='policy.npz')
+    args = parser.parse_args()
+
+    from DQN import checkpoint_name
+    from evaluate import load_weights
+    path = args.checkpoint or os.path.join('checkpoints', checkpoint_name(args.conv, 2*args.view_radius + 1))
+    weights = load_weights(path)
+    export_weights(weights, args.output)
+    print(f'Exported {len(weights)//2} layers, {sum(w.size for w in weights)} parameters, from {path} to {args.output}')
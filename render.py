@@ -0,0 +1,229 @@
+import multiprocessing as mp
+import queue
+import time
+import pygame
+'''
+Drawing and keyboard input for the snake game
+The simulation in snake.py never imports pygame, only the code that shows a window uses this module
+
+RenderProcess shows the window from its own process so drawing never slows the simulation down.
+The simulation publishes Snapshots of the game, at most fps a second, and the render process
+draws the latest one at its own frame rate and sends keyboard and window events back.
+'''
+
+
+class Renderer:
+    # Draws a Snake (or a Snapshot of one) onto a pygame window
+    # Everything that does not change during a game (background, outline, chequer board and the
+    # quit hint) is drawn once onto a cached surface which is blitted at the start of every frame
+    def __init__(self):
+        self.init_fonts = False
+        self.c1 = (73, 181, 49) # snake colours
+        self.c2 = (53, 151, 49)
+        self.flash = 0
+        self.background = None
+        self.background_key = None
+        self.score_text = None
+        self.score_text_value = None
+
+    def draw_background(self, snake, win):
+        grey = (49, 61, 78)
+        blue = (39, 50, 62)
+        black = (70, 70, 70)
+        white = (240, 240, 240)
+        block_size = snake.block_size
+        # Background colour
+        pygame.draw.rect(win, black, (0, 0, snake.win_width, snake.win_height))
+        # Draw outline
+        o_w = 4 # Outline width
+        pygame.draw.rect(win, white, (snake.game_x - o_w, snake.game_y - o_w, snake.game_width + 2*o_w, snake.game_height + 2*o_w))
+        # Chequer board
+        i = 0
+        for x in range(snake.game_width_blocks):
+            # Uncomment below to change chequer from lines
+            # i += 1
+            for y in range(snake.game_height_blocks):
+                colour = (grey if i % 2 ==0 else blue)
+                pygame.draw.rect(win, colour, (snake.game_x+x*block_size, snake.game_y+y*block_size, block_size, block_size))
+                i += 1
+        text = self.FONT.render(f"Press Q to quit", 1, white)
+        win.blit(text, (snake.win_width - 250, 20))
+
+    def draw(self, snake, win):
+        white = (240, 240, 240)
+        red = (255, 10, 10)
+        block_size = snake.block_size
+        if not self.init_fonts:
+            self.FONT = pygame.font.SysFont("comicsans", 40)
+            self.FONT_BIG = pygame.font.SysFont("comicsans", 90)
+            self.init_fonts = True
+        # Backgrounds, redrawn onto the cache only when the window or board changes
+        key = (snake.win_width, snake.win_height, snake.game_x, snake.game_y, snake.game_width_blocks,
+               snake.game_height_blocks, block_size)
+        if key != self.background_key:
+            self.background = pygame.Surface((snake.win_width, snake.win_height))
+            self.draw_background(snake, self.background)
+            self.background_key = key
+        win.blit(self.background, (0, 0))
+
+        # Draw snake
+        body = snake.body
+        head = len(body) - 1
+        for i, block in enumerate(body):
+            colour = self.c2 if i == head else self.c1
+            pygame.draw.rect(win, colour, (snake.game_x+block[0]*block_size, snake.game_y+block[1]*block_size, block_size, block_size))
+
+        # Draw apple
+        x = snake.apple[0]
+        y = snake.apple[1]
+        pygame.draw.rect(win, red, (snake.game_x+x*block_size, snake.game_y+y*block_size, block_size, block_size))
+        # Score text, only rendered again when the score changes
+        if snake.score != self.score_text_value:
+            self.score_text = self.FONT.render(f"Score: {snake.score}", 1, white)
+            self.score_text_value = snake.score
+        win.blit(self.score_text, (45, 20))
+
+        self.flash += 1
+        if snake.alive == False and not self.flash % 6 == 0:
+            font_size1 = self.FONT_BIG.size('GAME OVER')
+            text = self.FONT_BIG.render('GAME OVER', 1, red)
+            x = (snake.win_width - font_size1[0])//2
+            y = (snake.win_height - font_size1[1])//2
+            win.blit(text, (x, y))
+
+            font_size2 = self.FONT.size('Press R to restart')
+            text = self.FONT.render('Press R to restart', 1, red)
+            x = (snake.win_width - font_size2[0])//2
+            y = (snake.win_height - font_size2[1])//2 + font_size1[1]
+            win.blit(text, (x, y))
+
+
+class Snapshot:
+    # What Renderer.draw reads of a game, copied so the game can carry on while it is drawn
+    geometry = ('block_size', 'win_width', 'win_height', 'game_x', 'game_y', 'game_width', 'game_height',
+                'game_width_blocks', 'game_height_blocks')
+
+    def __init__(self, snake):
+        for name in self.geometry:
+            setattr(self, name, getattr(snake, name))
+        self.body = [list(block) for block in snake.body]
+        self.apple = list(snake.apple)
+        self.score = snake.score
+        self.alive = snake.alive
+
+
+class Event:
+    # Keyboard or window event sent back from the render process, with the attributes of a pygame event
+    def __init__(self, type, key=None):
+        self.type = type
+        self.key = key
+
+
+def render_loop(snapshots, events, win_width, win_height, fps):
+    # Runs in the render process until it receives None
+    pygame.init()
+    pygame.font.init()
+    pygame.display.set_caption("Snake")
+    win = pygame.display.set_mode((win_width, win_height))
+    renderer = Renderer()
+    clock = pygame.time.Clock()
+    snapshot = None
+    while True:
+        for event in pygame.event.get():
+            if event.type in (pygame.QUIT, pygame.KEYDOWN):
+                events.put(Event(event.type, getattr(event, 'key', None)))
+        # Only the latest snapshot is drawn
+        try:
+            while True:
+                snapshot = snapshots.get_nowait()
+                if snapshot is None:
+                    pygame.quit()
+                    return
+        except queue.Empty:
+            pass
+        if snapshot is not None:
+            renderer.draw(snapshot, win)
+            pygame.display.update()
+        clock.tick(fps)
+
+
+class RenderProcess:
+    # Window in its own process, showing the latest game published at fps frames a second
+    def __init__(self, win_width, win_height, fps=15):
+        context = mp.get_context('spawn')
+        self.snapshots = context.Queue(maxsize=1)
+        self.events = context.Queue()
+        self.interval = 1/fps
+        self.last_publish = 0
+        self.process = context.Process(target=render_loop, args=(self.snapshots, self.events, win_width, win_height, fps),
+                                       daemon=True)
+        self.process.start()
+
+    def publish(self, snake, force=False):
+        # Send a snapshot of the game unless one was sent less than a frame ago (or force)
+        now = time.perf_counter()
+        if not force and now - self.last_publish < self.interval:
+            return
+        self.last_publish = now
+        # Replace a snapshot the renderer has not picked up yet
+        try:
+            self.snapshots.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            self.snapshots.put_nowait(Snapshot(snake))
+        except queue.Full:
+            pass
+
+    def get_events(self):
+        # Events since the last call
+        events = []
+        try:
+            while True:
+                events.append(self.events.get_nowait())
+        except queue.Empty:
+            return events
+
+    def close(self):
+        try:
+            self.snapshots.get_nowait()
+        except queue.Empty:
+            pass
+        self.snapshots.put(None)
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+def player_input(snake, events):
+    # Only used if gamemode == 0
+    direction = snake.direction
+    for event in events:
+        if event.type == pygame.KEYDOWN:
+            if event.key == pygame.K_UP:
+                direction = 0
+            if event.key == pygame.K_RIGHT:
+                direction = 1
+            if event.key == pygame.K_DOWN:
+                direction = 2
+            if event.key == pygame.K_LEFT:
+                direction = 3
+
+    previous_direction = snake.direction
+    if (previous_direction + direction) % 2 == 1:   # Sum is odd
+        diff = previous_direction - direction
+        if diff == 3 or diff == -1:
+            action = 1 # right
+        if diff == -3 or diff == 1:
+            action = -1 # left
+    else:
+        action = 0  # Continue
+
+    action += 1 # To match NN output
+    return action
+
+
+def quit_requested(events):
+    # The red cross or Q on the keyboard
+    return any(event.type == pygame.QUIT or (event.type == pygame.KEYDOWN and event.key == pygame.K_q)
+               for event in events)
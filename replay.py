@@ -0,0 +1,543 @@
+import json
+import mmap
+import os
+import random
+import uuid
+from collections import Counter
+import numpy as np
+
+
+class ReplayMemory:
+    # Fixed capacity circular buffer of experiences
+    # Each field of an experience (state, action, next state, reward, alive) lives in its own
+    # preallocated array so pushing is O(1) and a batch is gathered with one index per field
+    def __init__(self, capacity, rng=None):
+        self.capacity = capacity
+        self.position = 0   # Slot the next experience is written to
+        self.size = 0
+        self.allocated = False
+        self.rng = np.random.default_rng() if rng is None else rng
+        # Number of experiences in memory with each reward, kept up to date as experiences are
+        # pushed and overwritten so reward percentages never need a scan of the memory
+        self.reward_counts = Counter()
+
+    share_loaded_arrays = True
+
+    def __len__(self):
+        return self.size
+
+    def allocate(self, state):
+        # Arrays are created on the first push once the state shape is known
+        for name, shape, dtype in field_layout(np.shape(state)):
+            setattr(self, name, self.new_array(name, (self.capacity,) + shape, dtype))
+        self.allocated = True
+
+    def new_array(self, name, shape, dtype):
+        return np.zeros(shape, dtype=dtype)
+
+    def push(self, experience):
+        # Saves an experience, overwriting the oldest once full, and returns the slot used
+        state, action, next_state, reward, alive = experience
+        if not self.allocated:
+            self.allocate(state)
+        i = self.position
+        if self.size == self.capacity:
+            self.reward_counts[float(self.rewards[i])] -= 1
+        self.states[i] = state
+        self.actions[i] = action
+        self.next_states[i] = next_state
+        self.rewards[i] = reward
+        self.reward_counts[float(self.rewards[i])] += 1
+        self.alives[i] = alive
+        self.position = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        return i
+
+    def sample(self, batch_size):
+        # Uniformly sample batch_size distinct experiences
+        # Returns arrays of states, actions, next_states, rewards and alives
+        indices = self.rng.choice(self.size, batch_size, replace=False)
+        return self.gather(indices)
+
+    def reward_percent(self, reward):
+        # Percentage of the experiences in memory with this reward, to 1 decimal place
+        if self.size == 0:
+            return 0
+        return round(self.reward_counts[reward]*100/self.size, 1)
+
+    def count_rewards(self):
+        # Recount reward_counts from the stored rewards, after loading
+        values, counts = np.unique(self.rewards[:self.size], return_counts=True)
+        self.reward_counts = Counter(dict(zip(values.tolist(), counts.tolist())))
+
+    def gather(self, indices):
+        return (self.states[indices], self.actions[indices], self.next_states[indices],
+                self.rewards[indices], self.alives[indices])
+
+    @property
+    def nbytes(self):
+        # Memory used by the preallocated arrays
+        if not self.allocated:
+            return 0
+        return sum(getattr(self, name).nbytes for name in FIELDS)
+
+    def arrays(self):
+        # The filled part of each field, in slot order
+        if not self.allocated:
+            return {}
+        return {name: getattr(self, name)[:self.size] for name in FIELDS}
+
+    def load(self, arrays, position):
+        # Fill this (empty) buffer with the fields returned by arrays()
+        # A full buffer of the same capacity uses the given arrays as they are (e.g. memory-mapped
+        # from a checkpoint) unless share_loaded_arrays is False, otherwise they are copied
+        if not arrays:
+            return
+        size = len(arrays['actions'])
+        if size > self.capacity:
+            raise ValueError(f'Cannot load {size} experiences into a memory of capacity {self.capacity}')
+        if size < self.capacity:
+            # Oldest first, so a larger buffer fills up before overwriting the oldest experiences
+            arrays = oldest_first(arrays, position)
+        arrays = expand_observations(arrays)
+        for name in FIELDS:
+            array = arrays[name]
+            if size < self.capacity or not self.share_loaded_arrays:
+                array = self.new_array(name, (self.capacity,) + array.shape[1:], array.dtype)
+                array[:size] = arrays[name]
+            setattr(self, name, array)
+        self.size = size
+        # Fill the rest of a larger buffer before overwriting anything
+        self.position = position % self.capacity if size == self.capacity else size
+        self.allocated = True
+        self.count_rewards()
+
+    @classmethod
+    def from_list(cls, experiences, capacity, rng=None):
+        # Build a buffer from the list of experiences saved by older versions
+        memory = cls(capacity, rng)
+        for experience in experiences:
+            memory.push(experience)
+        return memory
+
+
+class MemmapReplayMemory(ReplayMemory):
+    # ReplayMemory with each field in a .npy file in directory, mapped into memory with numpy.memmap
+    # Only the pages touched by pushes and sampled batches are held in RAM so the capacity is limited
+    # by disk space rather than memory. Any files already in directory are overwritten
+    # memory.json in directory records the generation of the files (a new id each time they are
+    # created), how many times they have been flushed and whether anything was pushed since the last
+    # flush. A checkpoint records the generation and flush count it saved so it is only restored
+    # while the files still hold that memory
+    share_loaded_arrays = False
+
+    def __init__(self, capacity, directory, rng=None):
+        super().__init__(capacity, rng)
+        self.directory = directory
+        self.generation = None
+        self.flushes = 0
+        self.clean = False
+
+    def allocate(self, state):
+        super().allocate(state)
+        self.new_generation()
+
+    def load(self, arrays, position):
+        super().load(arrays, position)
+        if self.allocated:
+            self.new_generation()
+
+    def new_generation(self):
+        self.generation = uuid.uuid4().hex
+        self.flushes = 0
+        self.clean = False
+        self.write_info()
+
+    def write_info(self):
+        path = os.path.join(self.directory, 'memory.json')
+        with open(path + '.tmp', 'w') as file:
+            json.dump({'generation': self.generation, 'flushes': self.flushes, 'clean': self.clean}, file)
+        os.replace(path + '.tmp', path)
+
+    def push(self, experience):
+        # The first push after a flush marks the files as changed since
+        if self.clean:
+            self.clean = False
+            self.write_info()
+        return super().push(experience)
+
+    def new_array(self, name, shape, dtype):
+        os.makedirs(self.directory, exist_ok=True)
+        array = np.lib.format.open_memmap(os.path.join(self.directory, name + '.npy'), mode='w+',
+                                          dtype=dtype, shape=shape)
+        advise_random(array)
+        return array
+
+    def sample(self, batch_size):
+        # Gathering in slot order reads the files front to back
+        indices = np.sort(self.rng.choice(self.size, batch_size, replace=False))
+        return self.gather(indices)
+
+    def flush(self):
+        if self.allocated:
+            for name in FIELDS:
+                getattr(self, name).flush()
+            self.flushes += 1
+            self.clean = True
+            self.write_info()
+
+    @classmethod
+    def open(cls, directory, capacity, position, size, rng=None, generation=None, flushes=None):
+        # Reopen the files of an existing memory, with the position and size it was saved with
+        # generation and flushes: as recorded by the checkpoint, None for checkpoints saved before them
+        memory = cls(capacity, directory, rng)
+        if size == 0:
+            return memory
+        if generation is not None:
+            info_path = os.path.join(directory, 'memory.json')
+            info = None
+            if os.path.exists(info_path):
+                with open(info_path) as file:
+                    info = json.load(file)
+            if info != {'generation': generation, 'flushes': flushes, 'clean': True}:
+                raise ValueError(f'The replay memory in {directory} has changed since this checkpoint was saved, '
+                                 'only the newest checkpoint of a run can be restored with a memory-mapped memory')
+            memory.generation = generation
+            memory.flushes = flushes
+            memory.clean = True
+        for name in FIELDS:
+            array = np.load(os.path.join(directory, name + '.npy'), mmap_mode='r+')
+            advise_random(array)
+            if len(array) != capacity:
+                raise ValueError(f'{directory} holds a memory of capacity {len(array)}, not {capacity}')
+            setattr(memory, name, array)
+        memory.position = position
+        memory.size = size
+        memory.allocated = True
+        memory.count_rewards()
+        return memory
+
+
+class CompactReplayMemory(ReplayMemory):
+    # ReplayMemory storing each observation once, in a ring of its own, in the smallest dtype that
+    # holds it exactly: conv views (-1, 0 or 1 on every block) as int8, MLP states as float32
+    # An experience keeps the serial number of its state's observation, its next state is always the
+    # observation after it. Consecutive moves of one game share an observation, the next state of one
+    # being the state of the next, so it is only stored once. Batches hold the same float32 values
+    # as ReplayMemory's
+    # The ring holds observations_per_experience*capacity observations. With 2 (the most an
+    # experience can add) it never runs out and holds the same experiences as ReplayMemory. With less
+    # the oldest experiences are dropped early once their observations are overwritten, so len()
+    # can be below capacity when few pushes follow on from the last
+    # Serial numbers are stored as int32 modulo serial_wrap, a multiple of the ring size, so an
+    # experience takes 4 bytes for its observation instead of 8
+    def __init__(self, capacity, rng=None, observations_per_experience=2.0):
+        super().__init__(capacity, rng)
+        self.observation_capacity = max(2, int(observations_per_experience*capacity))
+        self.serial_wrap = serial_wrap(self.observation_capacity)
+        self.observation_count = 0  # Serial number of the next observation written
+        self.evicted = 0    # Experiences dropped before being overwritten
+
+    def allocate(self, state):
+        for name, shape, dtype in compact_field_layout(np.shape(state), self.capacity, self.observation_capacity):
+            setattr(self, name, self.new_array(name, shape, dtype))
+        # Checking every observation would double the time of a push, conv views come from the board
+        if self.observations.dtype == np.int8 and not np.isin(state, (-1, 0, 1)).all():
+            raise ValueError('Conv observations must only hold the values -1, 0 and 1')
+        self.allocated = True
+
+    def add_observation(self, observation):
+        # Writes an observation to the ring, dropping the oldest experiences that still use its slot
+        serial = self.observation_count
+        while self.size:
+            oldest = (self.position - self.size) % self.capacity
+            if (serial - int(self.observation_ids[oldest])) % self.serial_wrap < self.observation_capacity:
+                break
+            self.reward_counts[float(self.rewards[oldest])] -= 1
+            self.size -= 1
+            self.evicted += 1
+        self.observations[serial % self.observation_capacity] = observation
+        self.observation_count += 1
+        return serial
+
+    def push(self, experience):
+        state, action, next_state, reward, alive = experience
+        if not self.allocated:
+            self.allocate(state)
+        # The state is the last next state pushed when this move follows on from the last
+        state = np.asarray(state, dtype=self.observations.dtype)
+        last = self.observation_count - 1
+        if last >= 0 and self.observations[last % self.observation_capacity].tobytes() == state.tobytes():
+            serial = last
+        else:
+            serial = self.add_observation(state)
+        self.add_observation(next_state)
+        i = self.position
+        if self.size == self.capacity:
+            self.reward_counts[float(self.rewards[i])] -= 1
+        self.observation_ids[i] = serial % self.serial_wrap
+        self.actions[i] = action
+        self.rewards[i] = reward
+        self.reward_counts[float(self.rewards[i])] += 1
+        self.alives[i] = alive
+        self.position = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        return i
+
+    def sample(self, batch_size):
+        # The slots in use are the last size pushed, which are 0 to size - 1 as in ReplayMemory
+        # unless experiences have been dropped early
+        indices = self.rng.choice(self.size, batch_size, replace=False)
+        if self.size < self.capacity:
+            indices = (self.position - self.size + indices) % self.capacity
+        return self.gather(indices)
+
+    def gather(self, indices):
+        serials = self.observation_ids[indices]
+        return (self.observations[serials % self.observation_capacity].astype(np.float32),
+                self.actions[indices].astype(np.int64),
+                self.observations[(serials + 1) % self.observation_capacity].astype(np.float32),
+                self.rewards[indices], self.alives[indices])
+
+    @property
+    def nbytes(self):
+        if not self.allocated:
+            return 0
+        return sum(getattr(self, name).nbytes for name in COMPACT_FIELDS)
+
+    def arrays(self):
+        # The filled part of the ring and of each experience field, in slot order
+        if not self.allocated:
+            return {}
+        slots = np.arange(self.size)
+        if self.size < self.capacity:
+            slots = (self.position - self.size + slots) % self.capacity
+        arrays = {name: getattr(self, name)[slots] for name in COMPACT_FIELDS if name != 'observations'}
+        arrays['observations'] = self.observations[:min(self.observation_count, self.observation_capacity)]
+        return arrays
+
+    def load(self, arrays, position):
+        # Pushes the experiences of arrays() from either memory oldest first, sharing observations again
+        if not arrays:
+            return
+        arrays = expand_observations(oldest_first(arrays, position))
+        for experience in zip(*(arrays[name] for name in FIELDS)):
+            self.push(experience)
+
+
+def oldest_first(arrays, position):
+    # arrays() of a memory saved at position, rolled so the oldest experience comes first
+    # A full ring's oldest experience is at position, a ReplayMemory that is not full has position
+    # equal to its size. CompactReplayMemory serial numbers rise with every push, modulo serial_wrap
+    if 'observation_ids' in arrays:
+        ids = arrays['observation_ids'].astype(np.int64)
+        wrap = serial_wrap(len(arrays['observations']))
+        # Ages relative to the first experience, the live serials span less than half the wrap
+        oldest = int(np.argmin((ids - ids[0] + wrap//2) % wrap))
+    else:
+        oldest = position % len(arrays['actions'])
+    if oldest == 0:
+        return arrays
+    # The observation ring of a CompactReplayMemory is not one row per experience
+    return {name: array if name == 'observations' else np.roll(array, -oldest, axis=0)
+            for name, array in arrays.items()}
+
+
+def serial_wrap(observation_capacity):
+    # Largest multiple of the ring size whose serial numbers, plus one, fit in an int32
+    return (np.iinfo(np.int32).max//observation_capacity)*observation_capacity
+
+
+def expand_observations(arrays):
+    # Fields of a CompactReplayMemory as ReplayMemory fields, other arrays are returned as they are
+    if 'observations' not in arrays:
+        return arrays
+    observations = arrays['observations']
+    serials = arrays['observation_ids'] % len(observations)
+    return {'states': observations[serials].astype(np.float32), 'actions': arrays['actions'].astype(np.int64),
+            'next_states': observations[(serials + 1) % len(observations)].astype(np.float32),
+            'rewards': arrays['rewards'], 'alives': arrays['alives']}
+
+
+class SumTree:
+    # Binary tree in an array where every node holds the sum of its two children, so the sum of
+    # all leaves is at the root (node 1) and any leaf can be updated or found from a prefix sum in
+    # O(log n). The number of leaves is rounded up to a power of two so all leaves are at one depth
+    def __init__(self, capacity):
+        self.leaves = 1 << max(0, (capacity - 1).bit_length())
+        self.tree = np.zeros(2*self.leaves)
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def get(self, indices):
+        return self.tree[np.asarray(indices) + self.leaves]
+
+    def set(self, index, value):
+        # Update a single leaf
+        node = index + self.leaves
+        self.tree[node] = value
+        node //= 2
+        while node:
+            self.tree[node] = self.tree[2*node] + self.tree[2*node + 1]
+            node //= 2
+
+    def update(self, indices, values):
+        # Update many leaves, recomputing each affected node once per level
+        nodes = np.asarray(indices) + self.leaves
+        self.tree[nodes] = values
+        while nodes[0] > 1:
+            nodes = np.unique(nodes//2)
+            self.tree[nodes] = self.tree[2*nodes] + self.tree[2*nodes + 1]
+
+    def find(self, values):
+        # Index of the leaf whose range of the running sum contains each value
+        nodes = np.ones(len(values), dtype=np.int64)
+        values = np.array(values, dtype=np.float64)
+        while nodes[0] < self.leaves:
+            left = self.tree[2*nodes]
+            right = values >= left
+            values -= np.where(right, left, 0)
+            nodes = 2*nodes + right
+        return nodes - self.leaves
+
+
+class PrioritizedReplayMemory(ReplayMemory):
+    # Prioritized experience replay (Schaul et al. 2016)
+    # Experiences are sampled in proportion to priority**alpha, the priority being the absolute TD
+    # error from the last time the experience was trained on plus epsilon. New experiences get the
+    # highest priority seen so far so each is trained on soon after it is pushed. The bias from
+    # non-uniform sampling is corrected by importance sampling weights, with an exponent beta that
+    # rises from beta_start to 1 over beta_steps batches
+    def __init__(self, capacity, rng=None, alpha=0.6, beta_start=0.4, beta_steps=100_000, epsilon=0.01):
+        super().__init__(capacity, rng)
+        self.alpha = alpha
+        self.beta_start = beta_start
+        self.beta_steps = beta_steps
+        self.epsilon = epsilon
+        self.tree = SumTree(capacity)
+        self.max_priority = 1.0
+        self.num_samples = 0
+
+    @property
+    def beta(self):
+        return min(1.0, self.beta_start + (1 - self.beta_start)*self.num_samples/self.beta_steps)
+
+    def push(self, experience):
+        i = super().push(experience)
+        self.tree.set(i, self.max_priority**self.alpha)
+        return i
+
+    def sample_indices(self, batch_size):
+        # Returns the slots of a batch and their importance sampling weights
+        # One slot is drawn from each of batch_size equal ranges of the total priority
+        total = self.tree.total
+        values = (np.arange(batch_size) + self.rng.random(batch_size))*total/batch_size
+        indices = np.minimum(self.tree.find(values), self.size - 1)
+        probabilities = self.tree.get(indices)/total
+        weights = (self.size*probabilities)**-self.beta
+        self.num_samples += 1
+        return indices, (weights/weights.max()).astype(np.float32)
+
+    def sample(self, batch_size):
+        indices, _ = self.sample_indices(batch_size)
+        return self.gather(indices)
+
+    def update_priorities(self, indices, td_errors):
+        priorities = np.abs(td_errors) + self.epsilon
+        self.max_priority = max(self.max_priority, float(priorities.max()))
+        self.tree.update(indices, priorities**self.alpha)
+
+    def arrays(self):
+        arrays = super().arrays()
+        if arrays:
+            arrays['priorities'] = self.tree.get(np.arange(self.size))
+        return arrays
+
+    def load(self, arrays, position):
+        if arrays and len(arrays['actions']) < self.capacity:
+            # Rolled as super().load rolls the experiences, so the priorities stay with them
+            arrays = oldest_first(arrays, position)
+            position = len(arrays['actions'])
+        super().load(arrays, position)
+        if arrays:
+            # Experiences saved without priorities start at the maximum
+            priorities = arrays.get('priorities', np.full(self.size, self.max_priority**self.alpha))
+            self.tree.update(np.arange(self.size), priorities)
+            self.max_priority = max(self.max_priority, float(np.max(priorities))**(1/self.alpha))
+
+
+def advise_random(array):
+    # Batches are sampled at random so reading ahead of each page only fills RAM with
+    # experiences that will not be used
+    if hasattr(mmap, 'MADV_RANDOM') and getattr(array, '_mmap', None) is not None:
+        array._mmap.madvise(mmap.MADV_RANDOM)
+
+
+# Names of the arrays holding each field of an experience
+FIELDS = ('states', 'actions', 'next_states', 'rewards', 'alives')
+
+
+def field_layout(state_shape):
+    # Name, shape (excluding the capacity axis) and dtype of each field
+    # States are stored as float32 which is the precision the network trains at anyway
+    return [('states', state_shape, np.float32),
+            ('actions', (), np.int64),
+            ('next_states', state_shape, np.float32),
+            ('rewards', (), np.float64),
+            ('alives', (), bool)]
+
+
+# Arrays of CompactReplayMemory, the observation ring and the fields of each experience
+COMPACT_FIELDS = ('observations', 'observation_ids', 'actions', 'rewards', 'alives')
+
+
+def compact_field_layout(state_shape, capacity, observation_capacity):
+    # Name, full shape and dtype of each array of CompactReplayMemory
+    # Conv views only hold -1, 0 and 1, MLP states are kept at the float32 the network trains at
+    observation_dtype = np.int8 if len(state_shape) == 2 else np.float32
+    return [('observations', (observation_capacity,) + state_shape, observation_dtype),
+            ('observation_ids', (capacity,), np.int32),
+            ('actions', (capacity,), np.int8),
+            ('rewards', (capacity,), np.float64),
+            ('alives', (capacity,), bool)]
+
+
+class PassThroughGate:
+    # Gate that pushes every experience, used with prioritized replay which handles sparse rewards itself
+    def filter(self, experience, percent_apple, percent_lose):
+        return [experience]
+
+
+class ReplayGate:
+    # Decides which experiences are pushed to replay memory, to combat sparse rewards and
+    # 'catastrophic forgetting'. The experiences leading up to an apple or death are pushed
+    # together while their share of memory is below threshold percent, other experiences are
+    # only pushed occasionally once apples and deaths both make up more than min_percent
+    def __init__(self, threshold=8, min_percent=5, sample_rate=0.05, history=8, rng=None):
+        # rng: random.Random deciding which other experiences are pushed, the random module if None
+        self.rng = random if rng is None else rng
+        self.threshold = threshold
+        self.min_percent = min_percent
+        self.sample_rate = sample_rate
+        self.history = history
+        self.mini_memory = []
+
+    def filter(self, experience, percent_apple, percent_lose):
+        # Returns the list of experiences to push to memory
+        reward = experience[3]
+        if (reward == 1 and percent_apple < self.threshold) or (reward == -1 and percent_lose < self.threshold):
+            # if apple or death add events leading to this to replay memory
+            self.mini_memory.append(experience)
+            experiences = self.mini_memory[-self.history:]
+            self.mini_memory = []
+            return experiences
+        elif self.rng.random() < self.sample_rate and min(percent_apple, percent_lose) > self.min_percent:
+            # Also rarely add events randomly
+            return [experience]
+        else:
+            if len(self.mini_memory) > self.history:
+                self.mini_memory = []
+            self.mini_memory.append(experience)
+            return []
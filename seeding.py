@@ -0,0 +1,45 @@
+import random
+import zlib
+import numpy as np
+'''
+Seeds for reproducible runs
+
+A run is reproduced from one run seed. Every game and every agent gets its own random number
+generators, seeded from the run seed and a name (e.g. 'game', actor 2, game 17), so the random
+numbers one game or agent draws never depend on how many others there are or in what order they run.
+
+Games take a random.Random (Snake(..., rng=...)) so a game is replayed exactly from its seed and
+its actions (see trajectory.py). Agents take a seed (DeepQNetwork(..., seed=...)) from which their
+python and numpy generators and the TensorFlow weight initialisation are seeded.
+'''
+
+
+def new_run_seed():
+    # Seed for a run started without one, printed so the run can be repeated
+    return random.SystemRandom().randrange(2**32)
+
+
+def derive_seed(run_seed, *keys):
+    # 64 bit seed named by keys (ints or strings) under run_seed
+    entropy = [run_seed] + [key if isinstance(key, int) else zlib.crc32(key.encode()) for key in keys]
+    return int(np.random.SeedSequence(entropy).generate_state(1, np.uint64)[0])
+
+
+class GameSeeds:
+    # Seeds of the games played one after another by one environment
+    def __init__(self, run_seed, *keys):
+        self.run_seed = run_seed
+        self.keys = keys
+        self.count = 0
+
+    def next(self):
+        seed = derive_seed(self.run_seed, 'game', *self.keys, self.count)
+        self.count += 1
+        return seed
+
+
+def seed_tensorflow(seed):
+    # Weight initialisation, Keras keeps one global seed (this also seeds the random module and
+    # np.random, which nothing that takes an rng or seed draws from)
+    import tensorflow as tf
+    tf.keras.utils.set_random_seed(seed % 2**31)
@@ -1,40 +1,69 @@
 import random
 import copy
 import numpy as np
-import pygame
 import math
+from collections import deque
+from bisect import bisect_left, bisect_right, insort
+
+
+def layout(game, win_width, win_height, board_size=None):
+    # Sets the board size in blocks and where the board is drawn in a win_width x win_height window
+    # board_size is (width, height) in blocks, by default as many 30 pixel blocks as fit in the
+    # window inside a 40 pixel border. Given a board size the blocks are scaled to fit instead
+    game.win_width = win_width
+    game.win_height = win_height
+    game.border = 40
+    if board_size is None:
+        game.block_size = 30
+        game.game_width_blocks = (win_width - game.border*2)//game.block_size
+        game.game_height_blocks = (win_height - game.border*2)//game.block_size
+    else:
+        game.game_width_blocks, game.game_height_blocks = board_size
+        game.block_size = max(1, min((win_width - game.border*2)//game.game_width_blocks,
+                                     (win_height - game.border*2)//game.game_height_blocks))
+    if game.game_width_blocks < 3 or game.game_height_blocks < 1:
+        raise ValueError(f'Board of {game.game_width_blocks}x{game.game_height_blocks} blocks is too small for a snake')
+    game.game_width = game.game_width_blocks*game.block_size
+    game.game_height = game.game_height_blocks*game.block_size
+    game.game_x = (win_width - game.game_width)//2
+    game.game_y = (win_height - game.game_height)//2 + game.border//2
+
+
+def parse_board_size(text):
+    # '20x12' to (20, 12)
+    width, height = text.lower().split('x')
+    return int(width), int(height)
 
 
 class Snake:
-    def __init__(self, gamemode, win_width, win_height, conv):
-        self.win_width = win_width
-        self.win_height = win_height
-        self.block_size = 30
-        self.border = 40
-        self.game_width_blocks = (self.win_width - self.border*2)//self.block_size
-        self.game_height_blocks = (self.win_height - self.border*2)//self.block_size
-        self.game_width = self.game_width_blocks*self.block_size
-        self.game_height = self.game_height_blocks*self.block_size
-        self.game_x = (self.win_width - self.game_width)//2
-        self.game_y = (self.win_height - self.game_height)//2 + self.border//2
+    def __init__(self, gamemode, win_width, win_height, conv, incremental=False, rng=None, board_size=None,
+                 view_radius=5):
+        # rng: random.Random the game draws its start and apples from, the random module if None
+        # board_size: (width, height) in blocks, by default set by the window size (see layout)
+        # view_radius: the conv state is the (2*view_radius + 1) square around the head
+        self.rng = random if rng is None else rng
+        layout(self, win_width, win_height, board_size)
         self.gamemode = gamemode
-        self.init_fonts = False
-        self.c1 = (73, 181, 49) # snake colours
-        self.c2 = (53, 151, 49)
-        self.pos = [random.randint(2, self.game_width_blocks-1), random.randint(0, self.game_height_blocks-1)]   # x, y
+        self.pos = [self.rng.randint(2, self.game_width_blocks-1), self.rng.randint(0, self.game_height_blocks-1)]   # x, y
         self.direction = 1  # Global direction, 0 = north, 1 = east, 2 = south, 3 = west
         b = copy.deepcopy(self.pos)
         b1 = [b[0]-1, b[1]]
         b2 = [b[0]-2, b[1]]
-        self.body = [b2, b1, b]    # Head is at the end of the list
-        self.apple = [random.randint(0, self.game_width_blocks-1), random.randint(0, self.game_height_blocks-1)]
+        self.body = deque([b2, b1, b])    # Head is at the end of the list
+        self.apple = [self.rng.randint(0, self.game_width_blocks-1), self.rng.randint(0, self.game_height_blocks-1)]
         self.score = 0
         self.alive = True
-        self.flash = 0
         self.reward = 0
-        self.board_border = 5 + 2   # CNN view radius plus 2
+        self.view_radius = view_radius
+        self.board_border = view_radius + 2   # CNN view radius plus 2
         self.board = -1*np.ones([self.game_width_blocks+self.board_border*2, self.game_height_blocks+self.board_border*2])
-        self.update_board()
+        # In incremental mode move() only repaints the cells that change and the rays in update_state
+        # are read from sorted lists of the non-empty cells on each row, column and diagonal
+        # The conv game always paints only the cells that change, its state is a window of the board
+        self.incremental = incremental
+        self.paint_blocks = incremental or conv
+        self.repaint_board()
+        self.rebuild_free_blocks()
         self.apple_distance = self.get_distance_to_apple()
         self.move_counter = 0
         self.conv = conv
@@ -74,21 +103,17 @@ class Snake:
             elif self.direction == 3:
                 self.pos[0] -=1
 
-            # Check for apple
-            if self.pos == self.apple:
-                keep_looping = True
-                while keep_looping: # Wait for break
-                    keep_looping = False
-                    new_apple_pos = [random.randint(0, self.game_width_blocks-1), random.randint(0, self.game_height_blocks-1)]
-                    if new_apple_pos in self.body:
-                        keep_looping = True
-
-                self.apple = new_apple_pos 
+            # Check for apple (a new one is placed once the head has moved)
+            ate = self.pos == self.apple
+            if ate:
                 self.reward = 1
                 self.move_counter = 0
                 self.score += 1
             else:
-                self.body.pop(0)    # Remove zeroth index (the end of tail)
+                tail = self.body.popleft()    # Remove the end of tail
+                self.free_block(tail)
+                if self.paint_blocks:
+                    self.set_block(tail, 1 if tail == self.apple else 0)
                 # Calc reward (give small reward for moving closer to apple)
                 if not self.conv:
                     self.prev_apple_distance = self.apple_distance
@@ -98,30 +123,74 @@ class Snake:
                     else:
                         self.reward = 0
                 else:
-                    self.update_board()
-                    self.update_state_conv()
-                    if 1 in self.state:
-                        self.reward = 0.05                            
+                    # Apple in view, the only block of the board that is 1
+                    dx = abs(self.pos[0] - self.apple[0])
+                    dy = abs(self.pos[1] - self.apple[1])
+                    if max(dx, dy) <= self.view_radius:
+                        self.reward = 0.05
                     else:
                         self.reward = 0
 
-            # Check for collision with body
-            for block in self.body:
-                if block == self.pos:
-                    self.alive = False
-                    self.reward = -1
-
-            # Check for collision with wall
-            if not 0<=self.pos[0]<self.game_width_blocks or not 0<=self.pos[1]<self.game_height_blocks:
+            # Check for collision with wall then body
+            in_game = 0<=self.pos[0]<self.game_width_blocks and 0<=self.pos[1]<self.game_height_blocks
+            if not in_game or self.block_taken(self.pos):
                 self.alive = False
                 self.reward = -1
+            else:
+                self.take_block(self.pos)
 
             self.body.append(copy.copy(self.pos))   # Add new position to body list
+            if ate:
+                self.place_apple()
+            if self.paint_blocks:
+                self.set_block(self.pos, 1 if self.pos == self.apple else -1)
             self.move_counter += 1
             if self.move_counter > 1000:
                 self.alive = False
 
+    def rebuild_free_blocks(self):
+        # Blocks not covered by the body, as a list to draw apples from plus the index of every
+        # block in that list (-1 if covered) so blocks are taken and freed in O(1)
+        # Blocks are numbered x*game_height_blocks + y
+        self.free_blocks = list(range(self.game_width_blocks*self.game_height_blocks))
+        self.free_index = list(range(self.game_width_blocks*self.game_height_blocks))
+        for block in self.body:
+            self.take_block(block)
+
+    def block_taken(self, block):
+        return self.free_index[block[0]*self.game_height_blocks + block[1]] == -1
+
+    def take_block(self, block):
+        # Swap the last free block into this one's place
+        n = block[0]*self.game_height_blocks + block[1]
+        i = self.free_index[n]
+        last = self.free_blocks.pop()
+        if last != n:
+            self.free_blocks[i] = last
+            self.free_index[last] = i
+        self.free_index[n] = -1
+
+    def free_block(self, block):
+        n = block[0]*self.game_height_blocks + block[1]
+        self.free_index[n] = len(self.free_blocks)
+        self.free_blocks.append(n)
+
+    def place_apple(self):
+        # Draw the new apple from the blocks not covered by the body
+        if not self.free_blocks:
+            self.alive = False  # The snake fills the board
+            return
+        n = self.free_blocks[self.rng.randrange(len(self.free_blocks))]
+        self.apple = [n // self.game_height_blocks, n % self.game_height_blocks]
+        if self.paint_blocks:
+            self.set_block(self.apple, 1)
+
     def update_board(self):
+        # In incremental mode and for the conv game move() keeps the board up to date
+        if not self.paint_blocks:
+            self.repaint_board()
+
+    def repaint_board(self):
         # Reset board
         b = self.board_border
         self.board[b:-b,b:-b] = 0
@@ -134,6 +203,47 @@ class Snake:
         y = self.apple[1] + b
         self.board[x, y] = 1
 
+        if self.incremental:
+            # Sorted positions of the non-empty blocks along every line a ray can travel
+            # Rows and columns are indexed by y and x, diagonals by x - y and x + y
+            w = self.game_width_blocks
+            h = self.game_height_blocks
+            self.rows = [[] for _ in range(h)]
+            self.cols = [[] for _ in range(w)]
+            self.diagonals = [[] for _ in range(w + h - 1)]
+            self.anti_diagonals = [[] for _ in range(w + h - 1)]
+            for x in range(w):
+                for y in range(h):
+                    if self.board[x + b, y + b] != 0:
+                        self.add_to_lines(x, y)
+
+    def set_block(self, block, value):
+        # Paint one block of the board, keeping the lines of non-empty blocks in step
+        x, y = block
+        if not (0 <= x < self.game_width_blocks and 0 <= y < self.game_height_blocks):
+            return  # Outside the game the board is always -1
+        b = self.board_border
+        previous = self.board[x + b, y + b]
+        self.board[x + b, y + b] = value
+        if not self.incremental:
+            return
+        if previous == 0 and value != 0:
+            self.add_to_lines(x, y)
+        elif previous != 0 and value == 0:
+            self.remove_from_lines(x, y)
+
+    def add_to_lines(self, x, y):
+        insort(self.rows[y], x)
+        insort(self.cols[x], y)
+        insort(self.diagonals[x - y + self.game_height_blocks - 1], x)
+        insort(self.anti_diagonals[x + y], x)
+
+    def remove_from_lines(self, x, y):
+        self.rows[y].remove(x)
+        self.cols[x].remove(y)
+        self.diagonals[x - y + self.game_height_blocks - 1].remove(x)
+        self.anti_diagonals[x + y].remove(x)
+
     def get_distance_to_apple(self):
         dx = abs(self.pos[0] - self.apple[0])
         dy = abs(self.pos[1] - self.apple[1])
@@ -157,7 +267,8 @@ class Snake:
         x_max = x + radius
         y_min = y - radius
         y_max = y + radius
-        state = self.board[x_min:x_max+1, y_min:y_max+1]
+        # Copied, a view of the board would change with it and previous_state with it
+        state = self.board[x_min:x_max+1, y_min:y_max+1].copy()
         self.state = state
 
     def update_state(self):
@@ -165,25 +276,28 @@ class Snake:
         # It see in 7 directions (no point seeing behind) plus angle to apple and snake length
         # The states (distance to objects) will be calculated globally then 
         # reordered to suit the local decision of the snake
-        x = self.pos[0] + self.board_border
-        y = self.pos[1] + self.board_border
-        state = []
-        inc_directions = [[0, -1], [1, -1], [1, 0], [1, 1], [0, 1], [-1, 1], [-1, 0], [-1, -1]]
-        # Global: [N, NE, E, SE, S, SW, W, NW]
-        for inc_i, inc_j in inc_directions:
-            i = 0
-            j = 0
-            while True:     # Wait for break
-                i += inc_i  # Value to increment i by to determine search direction
-                j += inc_j
-                block_value = self.board[x + i, y + j]
-                if block_value != 0:
-                    distance = max([abs(i), abs(j)])
-                    if distance > 20: 
-                        distance = 20
-                    state_value = block_value*(1 - distance/20)
-                    state.append(state_value)
-                    break
+        if self.incremental:
+            state = self.cast_rays()
+        else:
+            x = self.pos[0] + self.board_border
+            y = self.pos[1] + self.board_border
+            state = []
+            inc_directions = [[0, -1], [1, -1], [1, 0], [1, 1], [0, 1], [-1, 1], [-1, 0], [-1, -1]]
+            # Global: [N, NE, E, SE, S, SW, W, NW]
+            for inc_i, inc_j in inc_directions:
+                i = 0
+                j = 0
+                while True:     # Wait for break
+                    i += inc_i  # Value to increment i by to determine search direction
+                    j += inc_j
+                    block_value = self.board[x + i, y + j]
+                    if block_value != 0:
+                        distance = max([abs(i), abs(j)])
+                        if distance > 20: 
+                            distance = 20
+                        state_value = block_value*(1 - distance/20)
+                        state.append(state_value)
+                        break
 
         # Convert state list from global to local
         # Local: [F, FR, R, BR, B, BL, L, FL]
@@ -213,92 +327,48 @@ class Snake:
         self.state = state
 
 
-    def player_input(self, events):
-        # Only used if gamemode == 0
-        direction = self.direction
-        for event in events:
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_UP:
-                    direction = 0
-                if event.key == pygame.K_RIGHT:
-                    direction = 1
-                if event.key == pygame.K_DOWN:
-                    direction = 2
-                if event.key == pygame.K_LEFT:
-                    direction = 3
-
-        previous_direction = self.direction
-        if (previous_direction + direction) % 2 == 1:   # Sum is odd
-            diff = previous_direction - direction
-            if diff == 3 or diff == -1:
-                action = 1 # right
-            if diff == -3 or diff == 1:
-                action = -1 # left
-        else:
-            action = 0  # Continue
-
-        action += 1 # To match NN output
-        return action
-        
-
-    def draw(self, win):
-        # Draw backgrounds
-        grey = (49, 61, 78)
-        blue = (39, 50, 62)
-        black = (70, 70, 70)
-        white = (240, 240, 240)
-        red = (255, 10, 10)
-        block_size = self.block_size
-        if not self.init_fonts:
-            self.FONT = pygame.font.SysFont("comicsans", 40)
-            self.FONT_BIG = pygame.font.SysFont("comicsans", 90)
-            self.init_fonts = True
-        # Background colour
-        pygame.draw.rect(win, black, (0, 0, self.win_width, self.win_height))
-        # Draw outline
-        o_w = 4 # Outline width
-        pygame.draw.rect(win, white, (self.game_x - o_w, self.game_y - o_w, self.game_width + 2*o_w, self.game_height + 2*o_w))
-        # Chequer board
-        i = 0
-        for x in range(self.game_width_blocks):
-            # Uncomment below to change chequer from lines
-            # i += 1
-            for y in range(self.game_height_blocks):
-                colour = (grey if i % 2 ==0 else blue)
-                pygame.draw.rect(win, colour, (self.game_x+x*block_size, self.game_y+y*block_size, block_size, block_size))
-                i += 1
-
-        # Draw snake
-        for i, block in enumerate(self.body):
-            x = block[0]
-            y = block[1]
-
-            if i == len(self.body) - 1:
-                colour = self.c2
+    def cast_rays(self):
+        # Gives the same values as walking the rays in update_state but finds the nearest
+        # non-empty block by searching the sorted lines through the head
+        # Global: [N, NE, E, SE, S, SW, W, NW]
+        x, y = self.pos
+        w = self.game_width_blocks
+        h = self.game_height_blocks
+        b = self.board_border
+        row = self.rows[y] if 0 <= y < h else []
+        col = self.cols[x] if 0 <= x < w else []
+        d = x - y + h - 1
+        diagonal = self.diagonals[d] if 0 <= d < w + h - 1 else []
+        a = x + y
+        anti_diagonal = self.anti_diagonals[a] if 0 <= a < w + h - 1 else []
+        # Line, position of the head along the line and direction for each ray
+        rays = [(col, y, 0, -1), (anti_diagonal, x, 1, -1), (row, x, 1, 0), (diagonal, x, 1, 1),
+                (col, y, 0, 1), (anti_diagonal, x, -1, 1), (row, x, -1, 0), (diagonal, x, -1, -1)]
+        state = []
+        for line, p, inc_i, inc_j in rays:
+            # The ray always stops at the wall, the first block outside the game
+            distance = min(self.steps_to_wall(x, inc_i, w), self.steps_to_wall(y, inc_j, h))
+            step = inc_i if inc_i != 0 else inc_j
+            if step > 0:
+                i = bisect_right(line, p)
+                if i < len(line):
+                    distance = min(distance, line[i] - p)
             else:
-                colour = self.c1
-            pygame.draw.rect(win, colour, (self.game_x+x*block_size, self.game_y+y*block_size, block_size, block_size))
-
-        # Draw apple
-        x = self.apple[0]
-        y = self.apple[1]
-        pygame.draw.rect(win, red, (self.game_x+x*block_size, self.game_y+y*block_size, block_size, block_size))
-        # Score text
-        text = self.FONT.render(f"Score: {self.score}", 1, white)
-        win.blit(text, (45, 20))
-        text = self.FONT.render(f"Press Q to quit", 1, white)
-        win.blit(text, (self.win_width - 250, 20))
-
-        self.flash += 1
-        if self.alive == False and not self.flash % 6 == 0:
-            font_size1 = self.FONT_BIG.size('GAME OVER')
-            text = self.FONT_BIG.render('GAME OVER', 1, red)
-            x = (self.win_width - font_size1[0])//2
-            y = (self.win_height - font_size1[1])//2
-            win.blit(text, (x, y))
-
-            font_size2 = self.FONT.size('Press R to restart')
-            text = self.FONT.render('Press R to restart', 1, red)
-            x = (self.win_width - font_size2[0])//2
-            y = (self.win_height - font_size2[1])//2 + font_size1[1]
-            win.blit(text, (x, y))
+                i = bisect_left(line, p) - 1
+                if i >= 0:
+                    distance = min(distance, p - line[i])
+            block_value = self.board[x + inc_i*distance + b, y + inc_j*distance + b]
+            if distance > 20:
+                distance = 20
+            state.append(block_value*(1 - distance/20))
+        return state
+
+    def steps_to_wall(self, position, inc, size):
+        # Steps along one axis until leaving 0 <= position < size
+        if inc > 0:
+            return max(size - position, 1)
+        elif inc < 0:
+            return max(position + 1, 1)
+        elif 0 <= position < size:
+            return math.inf     # Never leaves along this axis
+        return 1
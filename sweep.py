@@ -0,0 +1,266 @@
+import argparse
+import csv
+import itertools
+import json
+import math
+import multiprocessing as mp
+import os
+import random
+import sys
+import time
+from seeding import derive_seed
+from snake import parse_board_size
+'''
+Hyperparameter sweeps
+
+Runs one headless training run (a trial) for each point of a grid, or for random draws from the
+given ranges, each in its own process pinned to one core with TensorFlow and BLAS limited to one
+thread, so trials on different cores do not slow each other down. A trial trains like main.py
+--parallel-games and every eval_every environment steps plays eval_games greedy games with the
+NumPy forward pass (policy.py). It stops once the best score has not improved by min_delta for
+patience evaluations, on reaching target, or after env_steps. Results are printed as one table,
+best first, and written to --output as .json or .csv.
+
+The sweep is a JSON file of settings, all optional, and parameters:
+
+    {
+        "method": "grid",                   grid, or random for trials draws
+        "trials": 20,
+        "seeds": 1,                         trials of each point, the same seeds for every point
+        "seed": 0,
+        "env_steps": 200000, "num_games": 16, "eval_every": 10000, "eval_games": 20,
+        "patience": 5, "min_delta": 0.1, "target": null,
+        "conv": false, "board": null, "view_radius": 5,
+        "parameters": {
+            "batch_size": [64, 256, 512],
+            "e_decay": {"log_uniform": [1e-6, 1e-4]},
+            "gate_threshold": [4, 8, 12]
+        }
+    }
+
+A parameter is a list of values, or for random search a range {"uniform": [a, b]},
+{"log_uniform": [a, b]} or {"int": [a, b]} (a grid takes the ends of a range). The parameters are
+the DeepQNetwork arguments batch_size, e_start, e_end, e_decay, future_discount,
+update_target_every, capacity, double_dqn, huber, prioritized and polyak, and the
+ReplayGate arguments as gate_threshold, gate_min_percent, gate_sample_rate and gate_history.
+
+Usage:  python sweep.py sweep.json [--cores 0 1 2 3] [--output results.csv] [--log-dir sweeps]
+'''
+
+SETTINGS = {
+    'method': 'grid',
+    'trials': 10,
+    'seeds': 1,
+    'seed': 0,
+    'env_steps': 200_000,
+    'num_games': 16,
+    'eval_every': 10_000,
+    'eval_games': 20,
+    'patience': 5,
+    'min_delta': 0.1,
+    'target': None,
+    'conv': False,
+    'board': None,
+    'view_radius': 5,
+}
+AGENT_PARAMETERS = ('batch_size', 'e_start', 'e_end', 'e_decay', 'future_discount', 'update_target_every')
+NETWORK_PARAMETERS = ('capacity', 'double_dqn', 'huber', 'prioritized', 'polyak')
+GATE_PARAMETERS = ('gate_threshold', 'gate_min_percent', 'gate_sample_rate', 'gate_history')
+
+
+def load_sweep(path):
+    # Settings with defaults filled in and the parameters, checked against the known names
+    with open(path) as file:
+        sweep = json.load(file)
+    parameters = sweep.pop('parameters', {})
+    unknown = set(sweep) - set(SETTINGS)
+    unknown |= set(parameters) - set(AGENT_PARAMETERS + NETWORK_PARAMETERS + GATE_PARAMETERS)
+    if unknown:
+        raise ValueError(f'Unknown settings or parameters in {path}: {", ".join(sorted(unknown))}')
+    if sweep.get('method', 'grid') not in ('grid', 'random'):
+        raise ValueError(f'Sweep method must be grid or random, not {sweep["method"]}')
+    return {**SETTINGS, **sweep}, parameters
+
+
+def draw(spec, rng):
+    # One value of a parameter for random search
+    if isinstance(spec, list):
+        return rng.choice(spec)
+    (kind, (low, high)), = spec.items()
+    if kind == 'uniform':
+        return rng.uniform(low, high)
+    if kind == 'log_uniform':
+        return math.exp(rng.uniform(math.log(low), math.log(high)))
+    if kind == 'int':
+        return rng.randint(low, high)
+    raise ValueError(f'Unknown range {kind}, expected uniform, log_uniform or int')
+
+
+def points(settings, parameters):
+    # Parameter values of every point of the sweep
+    if settings['method'] == 'random':
+        rng = random.Random(derive_seed(settings['seed'], 'sweep'))
+        return [{name: draw(spec, rng) for name, spec in parameters.items()} for _ in range(settings['trials'])]
+    values = [spec if isinstance(spec, list) else list(next(iter(spec.values()))) for spec in parameters.values()]
+    return [dict(zip(parameters, combination)) for combination in itertools.product(*values)]
+
+
+def limit_threads(threads=1):
+    # Before numpy or TensorFlow start their thread pools in a trial process
+    for variable in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS',
+                     'TF_NUM_INTEROP_THREADS'):
+        os.environ[variable] = str(threads)
+
+
+def start_worker(cores, log_dir):
+    # Pool initialiser, pins the worker to the next free core
+    core = cores.get()
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, {core})
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(1)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    start_worker.core = core
+    start_worker.log_dir = log_dir
+
+
+def run_trial(trial, point, params, settings, seed):
+    # Trains one DQN with params, returns the result row. The trial's output goes to its log file
+    log_dir = start_worker.log_dir
+    stdout = sys.stdout
+    with open(os.path.join(log_dir, f'trial_{trial}.log'), 'w') as log:
+        sys.stdout = log
+        try:
+            result = train_trial(params, settings, seed, os.path.join(log_dir, f'trial_{trial}'))
+        finally:
+            sys.stdout = stdout
+    return {'trial': trial, 'point': point, 'seed': seed, 'core': start_worker.core, **params, **result}
+
+
+def build_agent(params, settings, seed, checkpoint_dir):
+    # The DQN of a trial and the gate of each of its games. Every parameter is passed to the
+    # constructor, the fused train step is built with the discount it is given
+    from DQN import DeepQNetwork
+    from replay import ReplayGate, PassThroughGate
+    view_radius = settings['view_radius']
+    input_dims, num_actions = (2*view_radius + 1, 4) if settings['conv'] else (9, 3)
+    DQN = DeepQNetwork(input_dims, num_actions, True, fused_train=True, checkpoint_dir=checkpoint_dir,
+                       seed=derive_seed(seed, 'agent'), conv=settings['conv'],
+                       **{name: params[name] for name in AGENT_PARAMETERS + NETWORK_PARAMETERS if name in params})
+    gate_args = {name[len('gate_'):]: params[name] for name in GATE_PARAMETERS if name in params}
+    gates = [PassThroughGate() if DQN.prioritized else ReplayGate(rng=DQN.rng, **gate_args)
+             for _ in range(settings['num_games'])]
+    return DQN, gates
+
+
+def train_trial(params, settings, seed, checkpoint_dir):
+    # Training loop of main_parallel (parallel_training.py) without saving, with greedy evaluation and
+    # early stopping
+    from evaluate import play_games
+    from parallel_training import ParallelTrainer
+    from vector_snake import VectorSnake
+    conv = settings['conv']
+    view_radius = settings['view_radius']
+    board_size = parse_board_size(settings['board']) if settings['board'] else None
+    num_games = settings['num_games']
+    DQN, gates = build_agent(params, settings, seed, checkpoint_dir)
+    games = VectorSnake(num_games, 1000, 600, conv, rng=random.Random(derive_seed(seed, 'games')),
+                        board_size=board_size, view_radius=view_radius)
+    trainer = ParallelTrainer(DQN, games, gates=gates)
+    eval_seeds = range(10**6, 10**6 + settings['eval_games'])
+    steps = 0
+    curve = []
+    best_score, best_steps, since_best = -1.0, 0, 0
+    stopped = 'budget'
+    start = time.perf_counter()
+    while steps < settings['env_steps']:
+        trainer.step()
+        steps += num_games
+        if steps % settings['eval_every'] < num_games:
+            results = play_games(DQN.model.get_weights(), eval_seeds, conv, board_size=board_size,
+                                 view_radius=view_radius, numpy_inference=True)
+            score = sum(result['score'] for result in results)/len(results)
+            curve.append(round(score, 2))
+            print(f'{steps} env steps, {DQN.train_count} train steps, score {score:.2f}')
+            if score > best_score + settings['min_delta']:
+                best_score, best_steps, since_best = score, steps, 0
+            else:
+                since_best += 1
+            if settings['target'] is not None and score >= settings['target']:
+                stopped = 'target'
+                break
+            if since_best >= settings['patience']:
+                stopped = 'plateau'
+                break
+    return {'best_score': max(best_score, 0.0), 'best_env_steps': best_steps,
+            'final_score': curve[-1] if curve else None, 'env_steps': steps, 'train_steps': DQN.train_count,
+            'seconds': round(time.perf_counter() - start, 1), 'stopped': stopped, 'curve': curve}
+
+
+def run_sweep(settings, parameters, cores, log_dir):
+    # Runs every trial on a pool of one process per core, returns the results best first
+    trials = [(point, params, derive_seed(settings['seed'], 'trial', repeat))
+              for point, params in enumerate(points(settings, parameters)) for repeat in range(settings['seeds'])]
+    os.makedirs(log_dir, exist_ok=True)
+    print(f'{len(trials)} trials on {len(cores)} cores, logs in {log_dir}')
+    limit_threads()
+    context = mp.get_context('spawn')
+    free_cores = context.Queue()
+    for core in cores:
+        free_cores.put(core)
+    results = []
+    with context.Pool(len(cores), initializer=start_worker, initargs=(free_cores, log_dir)) as pool:
+        pending = [pool.apply_async(run_trial, (i, point, params, settings, seed))
+                   for i, (point, params, seed) in enumerate(trials)]
+        for job in pending:
+            result = job.get()
+            results.append(result)
+            print(f'Trial {result["trial"]} ({len(results)}/{len(trials)}): best score {result["best_score"]:.2f} '
+                  f'after {result["best_env_steps"]} env steps, {result["stopped"]}, {result["seconds"]:.0f} s')
+    return sorted(results, key=lambda result: -result['best_score']), list(parameters)
+
+
+def print_table(results, names):
+    columns = ['trial', 'point'] + names + ['best_score', 'best_env_steps', 'final_score', 'env_steps', 'stopped', 'seconds']
+    rows = [[format_value(result[column]) for column in columns] for result in results]
+    widths = [max(len(column), *(len(row[i]) for row in rows)) for i, column in enumerate(columns)]
+    print('  '.join(column.rjust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(value.rjust(width) for value, width in zip(row, widths)))
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return f'{value:.4g}'
+    return str(value)
+
+
+def write_results(path, results, settings):
+    # JSON holds the settings and every trial with its score curve, CSV one row per trial
+    if path.endswith('.csv'):
+        with open(path, 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=[key for key in results[0] if key != 'curve'], extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(results)
+    else:
+        with open(path, 'w') as file:
+            json.dump({'settings': settings, 'trials': results}, file, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Hyperparameter sweep of the snake DQN')
+    parser.add_argument('sweep', help='JSON file of settings and parameters')
+    parser.add_argument('--cores', type=int, nargs='+', help='cores to run trials on, one trial per core at a time, '
+                                                             'default all the cores this process may use')
+    parser.add_argument('--output', help='write the results to this .json or .csv file')
+    parser.add_argument('--log-dir', default='sweeps', help='directory of the log of every trial')
+    args = parser.parse_args()
+
+    settings, parameters = load_sweep(args.sweep)
+    cores = args.cores
+    if cores is None:
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    results, names = run_sweep(settings, parameters, cores, args.log_dir)
+    print_table(results, names)
+    if args.output:
+        write_results(args.output, results, settings)
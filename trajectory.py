@@ -0,0 +1,197 @@
+import argparse
+import random
+import struct
+import time
+import types
+import numpy as np
+from snake import layout
+'''
+Recording and replaying games
+
+A game is fully determined by its seed and its actions: Snake draws its start and apples from a
+random.Random seeded with the game seed (see seeding.py). Games are recorded to a binary file as
+
+    header      b'SNKT', format version, conv, window width, window height, view radius   (<4sBBHHB)
+    each game   seed, score, number of moves, board width, board height in blocks   (<QIIHH)
+                actions packed 4 to a byte, 2 bits each
+
+so a recorded game costs a quarter of a byte a move. Games of one file can be on different boards
+(see curriculum.py). Version 1 files, without view radius and board sizes, are still read: their
+games are on the board that fits the window with a view radius of 5. Games are replayed headless at full
+simulation speed on FastSnake, which plays the same games as Snake, and can be rendered to a GIF
+offline instead of during training.
+
+Usage:  python trajectory.py info games.snk
+        python trajectory.py replay games.snk [--reference]
+        python trajectory.py gif games.snk [--game 0] [--output game.gif] [--fps 15] [--scale 0.5]
+'''
+
+MAGIC = b'SNKT'
+FORMAT_VERSION = 2
+HEADER = struct.Struct('<4sBBHHB')
+GAME = struct.Struct('<QIIHH')
+HEADER_V1 = struct.Struct('<4sBBHH')
+GAME_V1 = struct.Struct('<QII')
+
+
+def window_board_size(win_width, win_height):
+    # Board size in blocks of a game made without board_size
+    board = types.SimpleNamespace()
+    layout(board, win_width, win_height)
+    return board.game_width_blocks, board.game_height_blocks
+
+
+def pack_actions(actions):
+    actions = np.asarray(actions, dtype=np.uint8)
+    padded = np.zeros(-(-len(actions)//4)*4, dtype=np.uint8)
+    padded[:len(actions)] = actions
+    quads = padded.reshape(-1, 4)
+    return (quads[:, 0] | quads[:, 1] << 2 | quads[:, 2] << 4 | quads[:, 3] << 6).tobytes()
+
+
+def unpack_actions(data, num_moves):
+    packed = np.frombuffer(data, dtype=np.uint8)
+    quads = np.stack([packed >> shift & 3 for shift in (0, 2, 4, 6)], axis=1)
+    return quads.reshape(-1)[:num_moves]
+
+
+class TrajectoryWriter:
+    # Appends games to a trajectory file, each game is flushed once written
+    def __init__(self, path, conv, win_width=1000, win_height=600, view_radius=5):
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, FORMAT_VERSION, int(conv), win_width, win_height, view_radius))
+        self.window_board = window_board_size(win_width, win_height)
+        self.games = 0
+
+    def write(self, seed, score, actions, board_size=None):
+        # board_size: (width, height) in blocks, None for the board that fits the window
+        width, height = board_size or self.window_board
+        self.file.write(GAME.pack(seed, score, len(actions), width, height))
+        self.file.write(pack_actions(actions))
+        self.file.flush()
+        self.games += 1
+
+    def close(self):
+        self.file.close()
+
+
+def read_trajectories(path):
+    # Returns the header as a dict and a list of (seed, score, actions, board_size) for every game
+    with open(path, 'rb') as file:
+        data = file.read()
+    magic, version, conv, win_width, win_height = HEADER_V1.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError(f'{path} is not a trajectory file')
+    if version > FORMAT_VERSION:
+        raise ValueError(f'{path} has format version {version}, newer than {FORMAT_VERSION}')
+    if version == 1:
+        header_struct, game_struct, view_radius = HEADER_V1, GAME_V1, 5
+    else:
+        header_struct, game_struct, view_radius = HEADER, GAME, HEADER.unpack_from(data)[-1]
+    header = {'conv': bool(conv), 'win_width': win_width, 'win_height': win_height, 'view_radius': view_radius}
+    window_board = window_board_size(win_width, win_height)
+    games = []
+    offset = header_struct.size
+    while offset + game_struct.size <= len(data):
+        seed, score, num_moves, *board_size = game_struct.unpack_from(data, offset)
+        offset += game_struct.size
+        end = offset + -(-num_moves//4)
+        if end > len(data):
+            break   # Last game was cut short while being written
+        games.append((seed, score, unpack_actions(data[offset:end], num_moves), tuple(board_size) or window_board))
+        offset = end
+    return header, games
+
+
+def replay(seed, actions, conv, win_width=1000, win_height=600, fast=True, board_size=None, view_radius=5):
+    # Yields the game before the first move and after every move
+    # fast plays FastSnake, otherwise the reference Snake
+    if fast:
+        from fast_snake import FastSnake as Game
+    else:
+        from snake import Snake as Game
+    snake = Game(1, win_width, win_height, conv, rng=random.Random(seed), board_size=board_size,
+                 view_radius=view_radius)
+    yield snake
+    for action in actions:
+        snake.move(int(action))
+        snake.update_board()
+        if conv:
+            snake.update_state_conv()
+        else:
+            snake.update_state()
+        yield snake
+
+
+def replay_all(path, fast=True):
+    # Replays every game in a file, returns the number of games whose score differs from the recording
+    # and the number of moves replayed
+    header, games = read_trajectories(path)
+    mismatches = 0
+    moves = 0
+    for seed, score, actions, board_size in games:
+        for snake in replay(seed, actions, header['conv'], header['win_width'], header['win_height'], fast,
+                            board_size, header['view_radius']):
+            pass
+        moves += len(actions)
+        if snake.score != score:
+            mismatches += 1
+            print(f'Game with seed {seed} scored {snake.score}, recorded {score}')
+    return mismatches, moves
+
+
+def render_gif(path, game, output, fps=15, scale=1.0):
+    # Renders one recorded game to a GIF without opening a window
+    import pygame
+    from PIL import Image
+    from render import Renderer
+    header, games = read_trajectories(path)
+    seed, score, actions, board_size = games[game]
+    pygame.font.init()
+    win = pygame.Surface((header['win_width'], header['win_height']))
+    renderer = Renderer()
+    size = (int(header['win_width']*scale), int(header['win_height']*scale))
+    frames = []
+    for snake in replay(seed, actions, header['conv'], header['win_width'], header['win_height'],
+                        board_size=board_size, view_radius=header['view_radius']):
+        renderer.draw(snake, win)
+        frames.append(Image.frombytes('RGB', win.get_size(), pygame.image.tobytes(win, 'RGB')).resize(size))
+    # Hold the game over screen for a second
+    for _ in range(fps):
+        renderer.draw(snake, win)
+        frames.append(Image.frombytes('RGB', win.get_size(), pygame.image.tobytes(win, 'RGB')).resize(size))
+    frames[0].save(output, save_all=True, append_images=frames[1:], duration=1000//fps, loop=0)
+    return len(frames)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Inspect, replay and render recorded snake games')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    info_parser = subparsers.add_parser('info', help='list the games in a file')
+    info_parser.add_argument('path')
+    replay_parser = subparsers.add_parser('replay', help='replay every game headless and check the scores')
+    replay_parser.add_argument('path')
+    replay_parser.add_argument('--reference', action='store_true', help='replay on Snake instead of FastSnake')
+    gif_parser = subparsers.add_parser('gif', help='render one game to a GIF')
+    gif_parser.add_argument('path')
+    gif_parser.add_argument('--game', type=int, default=0, help='index of the game in the file')
+    gif_parser.add_argument('--output', default='game.gif')
+    gif_parser.add_argument('--fps', type=int, default=15)
+    gif_parser.add_argument('--scale', type=float, default=0.5)
+    args = parser.parse_args()
+
+    if args.command == 'info':
+        header, games = read_trajectories(args.path)
+        print(f'{len(games)} games, conv: {header["conv"]}, window: {header["win_width"]}x{header["win_height"]}, '
+              f'view radius: {header["view_radius"]}')
+        for i, (seed, score, actions, (width, height)) in enumerate(games):
+            print(f'{i}: seed {seed}, score {score}, {len(actions)} moves, board {width}x{height}')
+    elif args.command == 'replay':
+        start = time.perf_counter()
+        mismatches, moves = replay_all(args.path, not args.reference)
+        elapsed = time.perf_counter() - start
+        print(f'{moves} moves replayed in {elapsed:.2f} s ({moves/elapsed:.0f} moves/s), {mismatches} scores differ')
+        raise SystemExit(1 if mismatches else 0)
+    else:
+        frames = render_gif(args.path, args.game, args.output, args.fps, args.scale)
+        print(f'Wrote {frames} frames to {args.output}')
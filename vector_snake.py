@@ -0,0 +1,233 @@
+import random
+import math
+import numpy as np
+from snake import layout
+
+
+class VectorSnake:
+    # Steps num_games independent Snake games in lockstep
+    # Every per-game quantity is held as an array with a leading num_games axis so a single call
+    # to move() advances all games at once. Rules, rewards and states follow snake.Snake exactly,
+    # including the order random numbers are drawn, so num_games=1 reproduces Snake under the same seed
+    # Dead games are restarted automatically at the end of move()
+    def __init__(self, num_games, win_width, win_height, conv, rng=None, board_size=None, view_radius=5):
+        # rng: random.Random all games draw their starts and apples from, the random module if None
+        self.rng = random if rng is None else rng
+        self.num_games = num_games
+        # board_size and view_radius as Snake
+        layout(self, win_width, win_height, board_size)
+        self.conv = conv
+        self.view_radius = view_radius
+        self.board_border = view_radius + 2   # CNN view radius plus 2
+        w = self.game_width_blocks + self.board_border*2
+        h = self.game_height_blocks + self.board_border*2
+        self.board = -1*np.ones([num_games, w, h])
+        # Number of body blocks on each cell, used for O(1) collision tests
+        self.occupancy = np.zeros([num_games, w, h], dtype=np.int32)
+        # Body is a ring buffer per game, the tail is at index tail and the head at tail + length - 1
+        self.body_capacity = self.game_width_blocks*self.game_height_blocks + 2
+        self.body = np.zeros([num_games, self.body_capacity, 2], dtype=np.int64)
+        # Blocks not covered by the body (numbered x*game_height_blocks + y) to draw apples from,
+        # with the index of every block in that list (-1 if covered), as in Snake
+        num_blocks = self.game_width_blocks*self.game_height_blocks
+        self.free_blocks = np.zeros([num_games, num_blocks], dtype=np.int64)
+        self.free_index = np.zeros([num_games, num_blocks], dtype=np.int64)
+        self.num_free = np.zeros(num_games, dtype=np.int64)
+        self.tail = np.zeros(num_games, dtype=np.int64)
+        self.length = np.zeros(num_games, dtype=np.int64)
+        self.pos = np.zeros([num_games, 2], dtype=np.int64)
+        self.apple = np.zeros([num_games, 2], dtype=np.int64)
+        self.direction = np.ones(num_games, dtype=np.int64)
+        self.score = np.zeros(num_games, dtype=np.int64)
+        self.alive = np.ones(num_games, dtype=bool)
+        self.reward = np.zeros(num_games)
+        self.move_counter = np.zeros(num_games, dtype=np.int64)
+        self.apple_distance = np.zeros(num_games, dtype=np.int64)
+        if conv:
+            size = 2*self.view_radius + 1
+            self.states = np.zeros([num_games, size, size])
+        else:
+            self.states = np.zeros([num_games, 9])
+        # Score and move counter of every game at the end of the last move (before any restart)
+        self.final_scores = np.zeros(num_games, dtype=np.int64)
+        self.final_move_counters = np.zeros(num_games, dtype=np.int64)
+        self.reset(np.arange(num_games))
+
+    def reset(self, indices):
+        # Start new games in the given slots, drawing random numbers in the same order as Snake.__init__
+        b = self.board_border
+        for i in indices:
+            x = self.rng.randint(2, self.game_width_blocks-1)
+            y = self.rng.randint(0, self.game_height_blocks-1)
+            apple = [self.rng.randint(0, self.game_width_blocks-1), self.rng.randint(0, self.game_height_blocks-1)]
+            self.pos[i] = [x, y]
+            self.apple[i] = apple
+            self.body[i, :3] = [[x-2, y], [x-1, y], [x, y]]
+            self.tail[i] = 0
+            self.length[i] = 3
+            self.occupancy[i] = 0
+            self.occupancy[i, x-2+b:x+1+b, y+b] = 1
+            self.free_blocks[i] = np.arange(self.free_blocks.shape[1])
+            self.free_index[i] = np.arange(self.free_blocks.shape[1])
+            self.num_free[i] = self.free_blocks.shape[1]
+            for block in self.body[i, :3]:
+                self.take_blocks(np.array([i]), np.array([block[0]*self.game_height_blocks + block[1]]))
+            self.board[i, b:-b, b:-b] = 0
+            self.board[i, x-2+b:x+1+b, y+b] = -1
+            self.board[i, apple[0]+b, apple[1]+b] = 1
+            self.direction[i] = 1
+            self.score[i] = 0
+            self.alive[i] = True
+            self.reward[i] = 0
+            self.move_counter[i] = 0
+            self.apple_distance[i] = abs(x - apple[0]) + abs(y - apple[1])
+        indices = np.asarray(indices, dtype=np.int64)
+        if len(indices):
+            self.states[indices] = self.observe(indices)
+
+    def move(self, actions):
+        # Advance every game by one action
+        # Returns the states after the move, the rewards and whether each game is still alive
+        # Games that died are then restarted, self.states holds the states to act on next
+        actions = np.asarray(actions, dtype=np.int64)
+        games = np.arange(self.num_games)
+        b = self.board_border
+        cap = self.body_capacity
+
+        # The input to the conv is global image so the output should be too
+        if self.conv:
+            self.direction = actions.copy()
+        else:
+            # Left (0), continue (1) and right (2) turn the global direction
+            self.direction = (self.direction + actions - 1) % 4
+        self.pos += DIRECTIONS[self.direction]
+        px = self.pos[:, 0]
+        py = self.pos[:, 1]
+
+        ate = (px == self.apple[:, 0]) & (py == self.apple[:, 1])
+        grow = games[ate]
+        shrink = games[~ate]
+
+        # Remove the tail of every snake that did not eat
+        tail = self.body[shrink, self.tail[shrink]]
+        self.occupancy[shrink, tail[:, 0]+b, tail[:, 1]+b] -= 1
+        self.free_blocks_of(shrink, tail[:, 0]*self.game_height_blocks + tail[:, 1])
+        self.tail[shrink] = (self.tail[shrink] + 1) % cap
+        self.length[shrink] -= 1
+
+        # Rewards for moving without eating
+        if not self.conv:
+            distance = np.abs(self.pos - self.apple).sum(axis=1)
+            closer = distance < self.apple_distance
+            self.reward = np.where(closer, 0.05, 0)
+            self.apple_distance = np.where(ate, self.apple_distance, distance)
+        else:
+            in_view = np.abs(self.pos - self.apple).max(axis=1) <= self.view_radius
+            self.reward = np.where(in_view, 0.05, 0)
+
+        self.reward[grow] = 1
+        self.move_counter[grow] = 0
+        self.score[grow] += 1
+
+        # Collisions with wall then body
+        hit_wall = (px < 0) | (px >= self.game_width_blocks) | (py < 0) | (py >= self.game_height_blocks)
+        hit_body = self.occupancy[games, px+b, py+b] > 0
+        dead = hit_body | hit_wall
+        self.alive[dead] = False
+        self.reward[dead] = -1
+
+        # Add the new head
+        self.body[games, (self.tail + self.length) % cap] = self.pos
+        self.length += 1
+        self.occupancy[games, px+b, py+b] += 1
+        took = games[~dead]
+        self.take_blocks(took, px[took]*self.game_height_blocks + py[took])
+
+        # New apples are drawn from the blocks not covered by the body, in game order
+        h = self.game_height_blocks
+        for i in grow:
+            if self.num_free[i] == 0:
+                self.alive[i] = False   # The snake fills the board
+                continue
+            n = self.free_blocks[i, self.rng.randrange(self.num_free[i])]
+            self.apple[i] = [n // h, n % h]
+        self.move_counter += 1
+        self.alive[self.move_counter > 1000] = False
+
+        # Repaint only the cells that changed, apples are painted last so they sit on top of the body
+        self.board[shrink, tail[:, 0]+b, tail[:, 1]+b] = np.where(self.occupancy[shrink, tail[:, 0]+b, tail[:, 1]+b] > 0, -1, 0)
+        self.board[games, px+b, py+b] = -1
+        self.board[games, self.apple[:, 0]+b, self.apple[:, 1]+b] = 1
+
+        states = self.observe(games)
+        rewards = self.reward.copy()
+        alives = self.alive.copy()
+        self.final_scores = self.score.copy()
+        self.final_move_counters = self.move_counter.copy()
+        self.states = states.copy()
+        self.reset(games[~alives])
+        return states, rewards, alives
+
+    def take_blocks(self, games, blocks):
+        # Remove one block per game from the free lists, swapping the last free block into its place
+        i = self.free_index[games, blocks]
+        self.num_free[games] -= 1
+        last = self.free_blocks[games, self.num_free[games]]
+        self.free_blocks[games, i] = last
+        self.free_index[games, last] = i
+        self.free_index[games, blocks] = -1
+
+    def free_blocks_of(self, games, blocks):
+        # Append one block per game to the free lists
+        self.free_index[games, blocks] = self.num_free[games]
+        self.free_blocks[games, self.num_free[games]] = blocks
+        self.num_free[games] += 1
+
+    def observe(self, indices):
+        # Compute the states of the given games from the current boards
+        if self.conv:
+            return self.observe_conv(indices)
+        x = self.pos[indices, 0] + self.board_border
+        y = self.pos[indices, 1] + self.board_border
+        board = self.board[indices]
+
+        # Walk all 8 rays at once, the padding guarantees a wall is hit before the steps run out
+        steps = np.arange(1, max(self.game_width_blocks, self.game_height_blocks) + 2)
+        xs = np.clip(x[:, None, None] + RAYS[None, :, 0, None]*steps, 0, board.shape[1]-1)
+        ys = np.clip(y[:, None, None] + RAYS[None, :, 1, None]*steps, 0, board.shape[2]-1)
+        values = board[np.arange(len(indices))[:, None, None], xs, ys]
+        first = np.argmax(values != 0, axis=2)
+        block_value = np.take_along_axis(values, first[:, :, None], axis=2)[:, :, 0]
+        distance = np.minimum(first + 1, 20)
+        state = block_value*(1 - distance/20)
+
+        # Convert from global [N, NE, E, SE, S, SW, W, NW] to local [F, FR, R, BR, B, BL, L, FL]
+        # then remove B
+        direction = self.direction[indices]
+        order = (np.arange(8)[None, :] + 2*direction[:, None]) % 8
+        state = np.take_along_axis(state, order, axis=1)[:, [0, 1, 2, 3, 5, 6, 7]]
+
+        # Angle to apple, +ve clockwise from ahead and continuous between -1 and 1
+        dx = self.apple[indices, 0] - self.pos[indices, 0]
+        dy = self.pos[indices, 1] - self.apple[indices, 1]
+        glob_angle = np.array([2*math.atan2(i, j)/math.pi for i, j in zip(dx.tolist(), dy.tolist())])
+        locl_angle = glob_angle - direction
+        locl_angle = np.where(locl_angle < -2, locl_angle + 4, locl_angle)
+        apple_direc = locl_angle/2
+
+        length = self.length[indices]/100
+        return np.concatenate([state, apple_direc[:, None], length[:, None]], axis=1)
+
+    def observe_conv(self, indices):
+        # Picture of the board within view_radius blocks of each head
+        r = self.view_radius
+        offsets = np.arange(-r, r+1)
+        xs = self.pos[indices, 0, None] + self.board_border + offsets
+        ys = self.pos[indices, 1, None] + self.board_border + offsets
+        return self.board[np.asarray(indices)[:, None, None], xs[:, :, None], ys[:, None, :]]
+
+
+# Global direction to (dx, dy), 0 = north, 1 = east, 2 = south, 3 = west
+DIRECTIONS = np.array([[0, -1], [1, 0], [0, 1], [-1, 0]])
+# Ray directions in global order [N, NE, E, SE, S, SW, W, NW]
+RAYS = np.array([[0, -1], [1, -1], [1, 0], [1, 1], [0, 1], [-1, 1], [-1, 0], [-1, -1]])